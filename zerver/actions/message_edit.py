@@ -22,6 +22,7 @@ from zerver.actions.message_send import (
 )
 from zerver.actions.uploads import check_attachment_reference_change
 from zerver.actions.user_topics import bulk_do_set_user_topic_visibility_policy
+from zerver.lib.cache import flush_first_unread_anchors, flush_unread_message_metadata
 from zerver.lib.exceptions import (
     JsonableError,
     MessageMoveError,
@@ -42,6 +43,7 @@ from zerver.lib.message import (
 )
 from zerver.lib.message_cache import update_message_cache
 from zerver.lib.queue import queue_json_publish
+from zerver.lib.soft_deactivation import add_missing_sparse_stream_messages_for_stream
 from zerver.lib.stream_subscription import get_active_subscriptions_for_stream_id
 from zerver.lib.stream_topic import StreamTopicTarget
 from zerver.lib.streams import (
@@ -559,6 +561,14 @@ def do_update_message(
         assert target_message.is_stream_message()
         assert stream_being_edited is not None
 
+        if stream_being_edited.has_deferred_user_messages:
+            # add_missing_sparse_stream_messages only looks for the
+            # deferred UserMessage rows of messages still in their
+            # original stream, so we create them before the messages
+            # leave it, and the code below then handles them like any
+            # other UserMessage rows.
+            add_missing_sparse_stream_messages_for_stream(stream_being_edited)
+
         edit_history_event["prev_stream"] = stream_being_edited.id
         edit_history_event["stream"] = new_stream.id
         event[ORIG_TOPIC] = orig_topic_name
@@ -757,6 +767,25 @@ def do_update_message(
     # freshly-fetched-from-the-database changed messages.
     changed_messages = save_changes_for_propagation_mode()
 
+    if topic_name is not None or new_stream is not None:
+        # Cached unread message data includes the topic and stream.
+        user_ids_with_moved_messages = list(
+            UserMessage.objects.filter(message_id__in=changed_message_ids)
+            .values_list("user_profile_id", flat=True)
+            .distinct()
+        )
+        transaction.on_commit(lambda: flush_unread_message_metadata(user_ids_with_moved_messages))
+
+        # Moving unread messages can make one of them the first unread
+        # message in a narrow for its new stream or topic.
+        user_ids_with_moved_unreads = list(
+            UserMessage.objects.filter(message_id__in=changed_message_ids)
+            .extra(where=[UserMessage.where_unread()])
+            .values_list("user_profile_id", flat=True)
+            .distinct()
+        )
+        transaction.on_commit(lambda: flush_first_unread_anchors(user_ids_with_moved_unreads))
+
     realm_id: Optional[int] = None
     if stream_being_edited is not None:
         realm_id = stream_being_edited.realm_id
@@ -10,6 +10,7 @@ from django.utils.timezone import now as timezone_now
 from django.utils.translation import gettext as _
 
 from analytics.lib.counts import COUNT_STATS, do_increment_logging_stat
+from zerver.lib.cache import flush_first_unread_anchors
 from zerver.lib.exceptions import JsonableError
 from zerver.lib.message import (
     bulk_access_messages,
@@ -17,6 +18,7 @@ from zerver.lib.message import (
     get_raw_unread_data,
 )
 from zerver.lib.queue import queue_json_publish
+from zerver.lib.soft_deactivation import add_missing_sparse_stream_messages
 from zerver.lib.stream_subscription import get_subscribed_stream_recipient_ids_for_user
 from zerver.lib.topic import filter_by_topic_name_via_message
 from zerver.lib.user_message import DEFAULT_HISTORICAL_FLAGS, create_historical_user_messages
@@ -38,6 +40,7 @@ def do_mark_all_as_read(
     user_profile: UserProfile, *, timeout: Optional[float] = None
 ) -> Optional[int]:
     start_time = time.monotonic()
+    add_missing_sparse_stream_messages(user_profile)
 
     # First, we clear mobile push notifications.  This is safer in the
     # event that the below logic times out and we're killed.
@@ -107,6 +110,8 @@ def do_mark_all_as_read(
 def do_mark_stream_messages_as_read(
     user_profile: UserProfile, stream_recipient_id: int, topic_name: Optional[str] = None
 ) -> int:
+    add_missing_sparse_stream_messages(user_profile)
+
     with transaction.atomic(savepoint=False):
         query = (
             UserMessage.select_for_update_query()
@@ -276,6 +281,10 @@ def do_update_message_flags(
     flagattr = getattr(UserMessage.flags, flag)
     flag_target = flagattr if is_adding else 0
 
+    # Messages in sparse streams that don't have a UserMessage row yet
+    # are unread, not historical.
+    add_missing_sparse_stream_messages(user_profile)
+
     with transaction.atomic(savepoint=False):
         if flag == "read" and not is_adding:
             # We have an invariant that all stream messages marked as
@@ -362,6 +371,11 @@ def do_update_message_flags(
         else:
             to_update.update(flags=F("flags").bitand(~flagattr))
 
+    if flag == "read" and not is_adding and count > 0:
+        # Marking messages as unread can move the first unread message
+        # earlier in any narrow.
+        transaction.on_commit(lambda: flush_first_unread_anchors([user_profile.id]))
+
     event = {
         "type": "update_message_flags",
         "op": operation,
@@ -1,3 +1,4 @@
+import copy
 import logging
 from collections import defaultdict
 from dataclasses import dataclass
@@ -9,6 +10,7 @@ from typing import (
     Callable,
     Collection,
     Dict,
+    FrozenSet,
     List,
     Optional,
     Sequence,
@@ -207,6 +209,11 @@ class ActiveUserDict(TypedDict):
     bot_type: Optional[int]
 
 
+# Messages in a batch that have the same sender, recipient, and topic,
+# and the same possible mentions, share a get_recipient_info result.
+RecipientInfoCacheKey = Tuple[int, Optional[str], int, FrozenSet[int], bool, bool]
+
+
 @dataclass
 class SentMessageResult:
     message_id: int
@@ -579,10 +586,15 @@ def build_message_send_dict(
     limit_unread_user_ids: Optional[Set[int]] = None,
     disable_external_notifications: bool = False,
     recipients_for_user_creation_events: Optional[Dict[UserProfile, Set[int]]] = None,
+    recipient_info_cache: Optional[Dict[RecipientInfoCacheKey, RecipientInfoResult]] = None,
 ) -> SendMessageRequest:
     """Returns a dictionary that can be passed into do_send_messages.  In
     production, this is always called by check_message, but some
     testing code paths call it directly.
+
+    Callers preparing a batch of messages to send together can pass
+    the same recipient_info_cache for each message, to avoid repeating
+    get_recipient_info's queries for messages to the same topic.
     """
     realm = message.realm
 
@@ -604,15 +616,30 @@ def build_message_send_dict(
     else:
         stream_topic = None
 
-    info = get_recipient_info(
-        realm_id=realm.id,
-        recipient=message.recipient,
-        sender_id=message.sender_id,
-        stream_topic=stream_topic,
-        possibly_mentioned_user_ids=mention_data.get_user_ids(),
-        possible_topic_wildcard_mention=mention_data.message_has_topic_wildcards(),
-        possible_stream_wildcard_mention=mention_data.message_has_stream_wildcards(),
+    recipient_info_cache_key: RecipientInfoCacheKey = (
+        message.recipient.id,
+        stream_topic.topic_name if stream_topic is not None else None,
+        message.sender_id,
+        frozenset(mention_data.get_user_ids()),
+        mention_data.message_has_topic_wildcards(),
+        mention_data.message_has_stream_wildcards(),
     )
+    if recipient_info_cache is not None and recipient_info_cache_key in recipient_info_cache:
+        # The caller modifies the sets in the result, so each message
+        # needs its own copy.
+        info = copy.deepcopy(recipient_info_cache[recipient_info_cache_key])
+    else:
+        info = get_recipient_info(
+            realm_id=realm.id,
+            recipient=message.recipient,
+            sender_id=message.sender_id,
+            stream_topic=stream_topic,
+            possibly_mentioned_user_ids=mention_data.get_user_ids(),
+            possible_topic_wildcard_mention=mention_data.message_has_topic_wildcards(),
+            possible_stream_wildcard_mention=mention_data.message_has_stream_wildcards(),
+        )
+        if recipient_info_cache is not None:
+            recipient_info_cache[recipient_info_cache_key] = copy.deepcopy(info)
 
     # Render our message_dicts.
     assert message.rendered_content is None
@@ -726,6 +753,7 @@ def create_user_messages(
     mark_as_read_user_ids: Set[int],
     limit_unread_user_ids: Optional[Set[int]],
     topic_participant_user_ids: Set[int],
+    sparse_user_messages: bool = False,
 ) -> List[UserMessageLite]:
     # These properties on the Message are set via
     # render_message_markdown by code in the Markdown inline patterns
@@ -757,6 +785,9 @@ def create_user_messages(
     #
     # See https://zulip.readthedocs.io/en/latest/subsystems/sending-messages.html#soft-deactivation
     # for details on this system.
+    #
+    # Streams with sparse_user_messages extend the same optimization to
+    # all of their subscribers; see add_missing_sparse_stream_messages.
     user_messages = []
     for user_profile_id in um_eligible_user_ids:
         flags = base_flags
@@ -775,7 +806,7 @@ def create_user_messages(
             flags |= UserMessage.flags.topic_wildcard_mentioned
 
         if (
-            user_profile_id in long_term_idle_user_ids
+            (sparse_user_messages or user_profile_id in long_term_idle_user_ids)
             and user_profile_id not in stream_push_user_ids
             and user_profile_id not in stream_email_user_ids
             and user_profile_id not in followed_topic_push_user_ids
@@ -883,6 +914,9 @@ def do_send_messages(
             mark_as_read_user_ids = send_request.muted_sender_user_ids
             mark_as_read_user_ids.update(mark_as_read)
 
+            sparse_user_messages = (
+                send_request.stream is not None and send_request.stream.sparse_user_messages
+            )
             user_messages = create_user_messages(
                 message=send_request.message,
                 rendering_result=send_request.rendering_result,
@@ -896,6 +930,7 @@ def do_send_messages(
                 mark_as_read_user_ids=mark_as_read_user_ids,
                 limit_unread_user_ids=send_request.limit_unread_user_ids,
                 topic_participant_user_ids=send_request.topic_participant_user_ids,
+                sparse_user_messages=sparse_user_messages,
             )
 
             for um in user_messages:
@@ -1400,6 +1435,39 @@ def check_send_message(
     return do_send_messages([message], mark_as_read=[sender.id] if read_by_sender else [])[0]
 
 
+def check_send_messages(
+    sender: UserProfile,
+    client: Client,
+    messages: Sequence[Tuple[Addressee, str]],
+    *,
+    read_by_sender: bool = False,
+) -> List[SentMessageResult]:
+    """Sends a batch of messages, each given as an (addressee, content)
+    pair, from a single sender.  Every message is checked before any
+    is sent, so either all of the messages are sent, or none are.
+
+    This is much cheaper than sending the messages one at a time when
+    many of them go to the same topic: messages to the same recipient
+    and topic share the database queries for their recipients'
+    subscriptions and notification settings, and all of their
+    UserMessage rows are inserted together.
+    """
+    mention_backend = MentionBackend(sender.realm_id)
+    recipient_info_cache: Dict[RecipientInfoCacheKey, RecipientInfoResult] = {}
+    send_requests = [
+        check_message(
+            sender,
+            client,
+            addressee,
+            message_content,
+            mention_backend=mention_backend,
+            recipient_info_cache=recipient_info_cache,
+        )
+        for addressee, message_content in messages
+    ]
+    return do_send_messages(send_requests, mark_as_read=[sender.id] if read_by_sender else [])
+
+
 def send_rate_limited_pm_notification_to_bot_owner(
     sender: UserProfile, realm: Realm, content: str
 ) -> None:
@@ -1621,6 +1689,7 @@ def check_message(
     mention_backend: Optional[MentionBackend] = None,
     limit_unread_user_ids: Optional[Set[int]] = None,
     disable_external_notifications: bool = False,
+    recipient_info_cache: Optional[Dict[RecipientInfoCacheKey, RecipientInfoResult]] = None,
 ) -> SendMessageRequest:
     """See
     https://zulip.readthedocs.io/en/latest/subsystems/sending-messages.html
@@ -1760,6 +1829,7 @@ def check_message(
         limit_unread_user_ids=limit_unread_user_ids,
         disable_external_notifications=disable_external_notifications,
         recipients_for_user_creation_events=recipients_for_user_creation_events,
+        recipient_info_cache=recipient_info_cache,
     )
 
     if (
@@ -1,8 +1,11 @@
 import time
 from datetime import datetime, timedelta
+from functools import partial
+from typing import List, Set, Tuple
 
 from django.conf import settings
-from django.db import transaction
+from django.db import connection, transaction
+from psycopg2.sql import SQL, Literal
 
 from zerver.actions.user_activity import update_user_activity_interval
 from zerver.lib.presence import (
@@ -86,33 +89,12 @@ def consolidate_client(client: Client) -> Client:
         return client
 
 
-@transaction.atomic(savepoint=False)
-def do_update_user_presence(
-    user_profile: UserProfile,
-    client: Client,
-    log_time: datetime,
-    status: int,
-    *,
-    force_send_update: bool = False,
-) -> None:
-    client = consolidate_client(client)
-
-    # If the user doesn't have a UserPresence row yet, we create one with
-    # sensible defaults. If we're getting a presence update, clearly the user
-    # at least connected, so last_connected_time should be set. last_active_time
-    # will depend on whether the status sent is idle or active.
-    defaults = dict(
-        last_active_time=None,
-        last_connected_time=log_time,
-        realm_id=user_profile.realm_id,
-    )
-    if status == UserPresence.LEGACY_STATUS_ACTIVE_INT:
-        defaults["last_active_time"] = log_time
-
-    (presence, created) = UserPresence.objects.get_or_create(
-        user_profile=user_profile,
-        defaults=defaults,
-    )
+def apply_presence_update(
+    presence: UserPresence, log_time: datetime, status: int
+) -> Tuple[List[str], bool]:
+    """Applies a presence update from a client to the in-memory
+    UserPresence object, returning the fields that changed and whether
+    the user has just come online."""
 
     # We initialize these values as a large delta so that if the user
     # was never active, we always treat the user as newly online.
@@ -144,14 +126,13 @@ def do_update_user_presence(
     # times per minute with multiple connected browser windows.
     # We also need to be careful not to wrongly "update" the timestamp if we actually already
     # have newer presence than the reported log_time.
-    if not created and time_since_last_connected_for_comparison > timedelta(
+    if time_since_last_connected_for_comparison > timedelta(
         seconds=settings.PRESENCE_UPDATE_MIN_FREQ_SECONDS
     ):
         presence.last_connected_time = log_time
         update_fields.append("last_connected_time")
     if (
-        not created
-        and status == UserPresence.LEGACY_STATUS_ACTIVE_INT
+        status == UserPresence.LEGACY_STATUS_ACTIVE_INT
         and time_since_last_active_for_comparison
         > timedelta(seconds=settings.PRESENCE_UPDATE_MIN_FREQ_SECONDS)
     ):
@@ -162,6 +143,41 @@ def do_update_user_presence(
             # last_connected_time >= last_active_time.
             presence.last_connected_time = log_time
             update_fields.append("last_connected_time")
+    return update_fields, became_online
+
+
+@transaction.atomic(savepoint=False)
+def do_update_user_presence(
+    user_profile: UserProfile,
+    client: Client,
+    log_time: datetime,
+    status: int,
+    *,
+    force_send_update: bool = False,
+) -> None:
+    client = consolidate_client(client)
+
+    # If the user doesn't have a UserPresence row yet, we create one with
+    # sensible defaults. If we're getting a presence update, clearly the user
+    # at least connected, so last_connected_time should be set. last_active_time
+    # will depend on whether the status sent is idle or active.
+    defaults = dict(
+        last_active_time=None,
+        last_connected_time=log_time,
+        realm_id=user_profile.realm_id,
+    )
+    if status == UserPresence.LEGACY_STATUS_ACTIVE_INT:
+        defaults["last_active_time"] = log_time
+
+    (presence, created) = UserPresence.objects.get_or_create(
+        user_profile=user_profile,
+        defaults=defaults,
+    )
+
+    # For a newly created row, both timestamps are already log_time
+    # (or None, for the last_active_time of an idle user), so this
+    # only changes anything for existing rows.
+    update_fields, became_online = apply_presence_update(presence, log_time, status)
     if len(update_fields) > 0:
         presence.save(update_fields=update_fields)
 
@@ -179,6 +195,93 @@ def do_update_user_presence(
         )
 
 
+@transaction.atomic(savepoint=False)
+def do_update_user_presences(presence_updates: List[Tuple[int, datetime, int]]) -> None:
+    """Applies a batch of (user_profile_id, log_time, status) presence
+    updates, in order, writing the resulting UserPresence rows in a
+    single query; this is what the user_presence queue worker uses.
+
+    The result is the same as calling do_update_user_presence for each
+    update, except that at most one presence event is sent per user,
+    with their final presence."""
+    user_ids = {user_id for user_id, log_time, status in presence_updates}
+    user_profiles = {
+        user_profile.id: user_profile
+        for user_profile in UserProfile.objects.select_related("realm").filter(id__in=user_ids)
+    }
+    presences = {
+        presence.user_profile_id: presence
+        for presence in UserPresence.objects.filter(user_profile_id__in=user_ids)
+    }
+
+    changed_user_ids: Set[int] = set()
+    notify_user_ids: Set[int] = set()
+    for user_id, log_time, status in presence_updates:
+        if user_id not in user_profiles:
+            # The user has been deleted since the update was queued.
+            continue
+        if user_id not in presences:
+            presences[user_id] = UserPresence(
+                user_profile=user_profiles[user_id],
+                realm_id=user_profiles[user_id].realm_id,
+                last_connected_time=log_time,
+                last_active_time=(
+                    log_time if status == UserPresence.LEGACY_STATUS_ACTIVE_INT else None
+                ),
+            )
+            changed_user_ids.add(user_id)
+            notify_user_ids.add(user_id)
+            continue
+
+        update_fields, became_online = apply_presence_update(presences[user_id], log_time, status)
+        if update_fields:
+            changed_user_ids.add(user_id)
+        if became_online:
+            notify_user_ids.add(user_id)
+
+    if not changed_user_ids:
+        return
+
+    # Each row locks its realm's PresenceSequence row (see migration
+    # 0526), so we write them in realm order to avoid deadlocks with
+    # concurrent writers.
+    rows = [
+        SQL("({},{},{},{})").format(
+            Literal(user_id),
+            Literal(presences[user_id].realm_id),
+            Literal(presences[user_id].last_connected_time),
+            Literal(presences[user_id].last_active_time),
+        )
+        for user_id in sorted(
+            changed_user_ids, key=lambda user_id: (presences[user_id].realm_id, user_id)
+        )
+    ]
+    # The timestamps only ever move forwards, so we use greatest() in
+    # case the row was updated since we read it.
+    query = SQL(
+        """
+        INSERT INTO zerver_userpresence
+            (user_profile_id, realm_id, last_connected_time, last_active_time)
+        VALUES {rows}
+        ON CONFLICT (user_profile_id) DO UPDATE SET
+            last_connected_time = greatest(
+                zerver_userpresence.last_connected_time, excluded.last_connected_time
+            ),
+            last_active_time = greatest(
+                zerver_userpresence.last_active_time, excluded.last_active_time
+            )
+        """
+    ).format(rows=SQL(", ").join(rows))
+    with connection.cursor() as cursor:
+        cursor.execute(query)
+
+    for user_id in notify_user_ids:
+        if not user_profiles[user_id].realm.presence_disabled:
+            transaction.on_commit(
+                partial(send_presence_changed, user_profiles[user_id], presences[user_id])
+            )
+
+
 def update_user_presence(
     user_profile: UserProfile,
     client: Client,
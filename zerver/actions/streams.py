@@ -20,6 +20,9 @@ from zerver.lib.cache import (
     cache_delete_many,
     cache_set,
     display_recipient_cache_key,
+    flush_first_unread_anchors,
+    flush_message_dict_cache,
+    flush_unread_message_metadata,
     to_dict_cache_key_id,
 )
 from zerver.lib.exceptions import JsonableError
@@ -268,12 +271,15 @@ def do_unarchive_stream(
 
     # Update caches
     cache_set(display_recipient_cache_key(stream.recipient_id), new_name)
-    messages = Message.objects.filter(
-        # Uses index: zerver_message_realm_recipient_id
-        realm_id=realm.id,
-        recipient_id=stream.recipient_id,
-    ).only("id")
-    cache_delete_many(to_dict_cache_key_id(message.id) for message in messages)
+    message_ids = list(
+        Message.objects.filter(
+            # Uses index: zerver_message_realm_recipient_id
+            realm_id=realm.id,
+            recipient_id=stream.recipient_id,
+        ).values_list("id", flat=True)
+    )
+    cache_delete_many(to_dict_cache_key_id(message_id) for message_id in message_ids)
+    flush_message_dict_cache(message_ids)
 
     # Unset the is_web_public and is_realm_public cache on attachments,
     # since the stream is now private.
@@ -322,6 +328,7 @@ def bulk_delete_cache_keys(message_ids_to_clear: List[int]) -> None:
 
         keys_to_delete = [to_dict_cache_key_id(message_id) for message_id in batch]
         cache_delete_many(keys_to_delete)
+        flush_message_dict_cache(batch)
 
         message_ids_to_clear = message_ids_to_clear[5000:]
 
@@ -378,6 +385,15 @@ def merge_streams(
         recipient=recipient_to_destroy,
     ).update(recipient=recipient_to_keep)
     bulk_delete_cache_keys(message_ids_to_clear)
+    # Only users who were ever subscribed to the stream being destroyed
+    # can have UserMessage rows for its messages, read or unread.
+    user_ids_with_moved_messages = list(
+        Subscription.objects.filter(recipient=recipient_to_destroy).values_list(
+            "user_profile_id", flat=True
+        )
+    )
+    transaction.on_commit(lambda: flush_unread_message_metadata(user_ids_with_moved_messages))
+    transaction.on_commit(lambda: flush_first_unread_anchors(user_ids_with_moved_messages))
 
     # Remove subscriptions to the old stream.
     if len(subs_to_deactivate) > 0:
@@ -809,6 +825,10 @@ def bulk_add_subscriptions(
         subs_to_add=subs_to_add,
         subs_to_activate=subs_to_activate,
     )
+    # Reactivating a muted subscription excludes its messages from
+    # the first unread message computation.
+    altered_user_ids = [user.id for user in altered_streams_dict]
+    transaction.on_commit(lambda: flush_first_unread_anchors(altered_user_ids))
 
     stream_dict = {stream.id: stream for stream in streams}
 
@@ -1079,6 +1099,11 @@ def bulk_remove_subscriptions(
         # Now since we have all log objects generated we can do a bulk insert
         RealmAuditLog.objects.bulk_create(all_subscription_logs)
 
+        # Deactivating a muted subscription stops its messages from being
+        # excluded from the first unread message computation.
+        removed_user_ids = {sub_info.user.id for sub_info in subs_to_deactivate}
+        transaction.on_commit(lambda: flush_first_unread_anchors(removed_user_ids))
+
     removed_sub_tuples = [(sub_info.user, sub_info.stream) for sub_info in subs_to_deactivate]
     send_subscription_remove_events(realm, users, streams, removed_sub_tuples)
 
@@ -1124,6 +1149,8 @@ def do_change_subscription_property(
     old_value = getattr(sub, database_property_name)
     setattr(sub, database_property_name, database_value)
     sub.save(update_fields=[database_property_name])
+    if database_property_name == "is_muted":
+        transaction.on_commit(lambda: flush_first_unread_anchors([user_profile.id]))
     event_time = timezone_now()
     RealmAuditLog.objects.create(
         realm=user_profile.realm,
@@ -1198,6 +1225,11 @@ def do_change_stream_permission(
     is_web_public: bool,
     acting_user: UserProfile,
 ) -> None:
+    if stream.sparse_user_messages and not history_public_to_subscribers:
+        # Without shared history, UserMessage rows control which
+        # messages each subscriber can access, so none can be deferred.
+        do_change_stream_sparse_user_messages(stream, False, acting_user=acting_user)
+
     old_invite_only_value = stream.invite_only
     old_history_public_to_subscribers_value = stream.history_public_to_subscribers
     old_is_web_public_value = stream.is_web_public
@@ -1439,18 +1471,21 @@ def do_rename_stream(stream: Stream, new_name: str, user_profile: UserProfile) -
 
     assert stream.recipient_id is not None
     recipient_id: int = stream.recipient_id
-    messages = Message.objects.filter(
-        # Uses index: zerver_message_realm_recipient_id
-        realm_id=stream.realm_id,
-        recipient_id=recipient_id,
-    ).only("id")
+    message_ids = list(
+        Message.objects.filter(
+            # Uses index: zerver_message_realm_recipient_id
+            realm_id=stream.realm_id,
+            recipient_id=recipient_id,
+        ).values_list("id", flat=True)
+    )
 
     cache_set(display_recipient_cache_key(recipient_id), stream.name)
 
     # Delete cache entries for everything else, which is cheaper and
     # clearer than trying to set them. display_recipient is the out of
     # date field in all cases.
-    cache_delete_many(to_dict_cache_key_id(message.id) for message in messages)
+    cache_delete_many(to_dict_cache_key_id(message_id) for message_id in message_ids)
+    flush_message_dict_cache(message_ids)
 
     # We want to key these updates by id, not name, since id is
     # the immutable primary key, and obviously name is not.
@@ -1632,6 +1667,51 @@ def do_change_stream_message_retention_days(
     )
 
 
+def do_change_stream_sparse_user_messages(
+    stream: Stream, sparse_user_messages: bool, *, acting_user: Optional[UserProfile]
+) -> None:
+    # This is a backend-only setting, so there's no event to send.
+    assert stream.recipient_id is not None
+    assert stream.is_history_public_to_subscribers() or not sparse_user_messages
+    old_value = stream.sparse_user_messages
+
+    with transaction.atomic():
+        stream.sparse_user_messages = sparse_user_messages
+        update_fields = ["sparse_user_messages"]
+        # Unless some rows are still deferred from when the mode was
+        # last on, which the subscriptions already track, every message
+        # sent so far has all of its UserMessage rows.
+        if sparse_user_messages and not stream.has_deferred_user_messages:
+            stream.has_deferred_user_messages = True
+            update_fields.append("has_deferred_user_messages")
+            Subscription.objects.filter(recipient_id=stream.recipient_id).update(
+                last_materialized_message_id=get_last_message_id()
+            )
+        stream.save(update_fields=update_fields)
+        RealmAuditLog.objects.create(
+            realm=stream.realm,
+            acting_user=acting_user,
+            modified_stream=stream,
+            event_type=RealmAuditLog.STREAM_PROPERTY_CHANGED,
+            event_time=timezone_now(),
+            extra_data={
+                RealmAuditLog.OLD_VALUE: old_value,
+                RealmAuditLog.NEW_VALUE: sparse_user_messages,
+                "property": "sparse_user_messages",
+            },
+        )
+
+        if not sparse_user_messages and stream.has_deferred_user_messages:
+            # New messages now get all of their UserMessage rows.  The
+            # deferred ones may be for thousands of subscribers, so we
+            # create them in the background; until then, they are still
+            # created on demand.
+            queue_event_on_commit(
+                "deferred_work",
+                {"type": "materialize_sparse_stream_messages", "stream_id": stream.id},
+            )
+
+
 def do_change_stream_group_based_setting(
     stream: Stream,
     setting_name: str,
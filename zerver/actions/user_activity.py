@@ -1,4 +1,8 @@
+from collections import defaultdict
 from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from django.db import connection, transaction
 
 from zerver.lib.queue import queue_json_publish
 from zerver.lib.timestamp import datetime_to_timestamp
@@ -29,6 +33,68 @@ def do_update_user_activity_interval(user_profile: UserProfile, log_time: dateti
     )
 
 
+@transaction.atomic(savepoint=False)
+def do_update_user_activity_intervals(activity_updates: List[Tuple[int, datetime]]) -> None:
+    """Applies a batch of (user_profile_id, log_time) activity updates,
+    as the user_activity_interval queue worker does.
+
+    The result is the same as calling do_update_user_activity_interval
+    for each update in time order, but the updates for each user are
+    merged in memory, so the whole batch takes one query to read each
+    user's latest interval, and at most one UPDATE and one INSERT."""
+    log_times_by_user_id: Dict[int, List[datetime]] = defaultdict(list)
+    for user_id, log_time in activity_updates:
+        log_times_by_user_id[user_id].append(log_time)
+
+    # This also skips users who have been deleted since the update
+    # was queued.
+    query = """
+        SELECT zerver_userprofile.id, latest.id, latest.start, latest."end"
+        FROM zerver_userprofile
+        LEFT JOIN LATERAL (
+            SELECT id, start, "end"
+            FROM zerver_useractivityinterval
+            WHERE user_profile_id = zerver_userprofile.id
+            ORDER BY "end" DESC
+            LIMIT 1
+        ) AS latest ON true
+        WHERE zerver_userprofile.id = ANY(%s)
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(query, [list(log_times_by_user_id)])
+        rows = cursor.fetchall()
+
+    updated_intervals: Dict[int, UserActivityInterval] = {}
+    new_intervals: List[UserActivityInterval] = []
+    for user_id, interval_id, start, end in rows:
+        last: Optional[UserActivityInterval] = None
+        if interval_id is not None:
+            last = UserActivityInterval(
+                id=interval_id, user_profile_id=user_id, start=start, end=end
+            )
+
+        for log_time in sorted(log_times_by_user_id[user_id]):
+            effective_end = log_time + UserActivityInterval.MIN_INTERVAL_LENGTH
+            if last is not None and log_time <= last.end and effective_end >= last.start:
+                last.end = max(last.end, effective_end)
+                last.start = min(last.start, log_time)
+                if last.id is not None:
+                    updated_intervals[last.id] = last
+                continue
+
+            interval = UserActivityInterval(
+                user_profile_id=user_id, start=log_time, end=effective_end
+            )
+            new_intervals.append(interval)
+            if last is None or interval.end > last.end:
+                last = interval
+
+    if updated_intervals:
+        UserActivityInterval.objects.bulk_update(updated_intervals.values(), ["start", "end"])
+    if new_intervals:
+        UserActivityInterval.objects.bulk_create(new_intervals)
+
+
 def update_user_activity_interval(user_profile: UserProfile, log_time: datetime) -> None:
     event = {"user_profile_id": user_profile.id, "time": datetime_to_timestamp(log_time)}
     queue_json_publish("user_activity_interval", event)
@@ -7,6 +7,7 @@ import secrets
 import sys
 import time
 import traceback
+from collections import OrderedDict
 from functools import _lru_cache_wrapper, lru_cache, wraps
 from typing import (
     TYPE_CHECKING,
@@ -44,6 +45,7 @@ logger = logging.getLogger()
 remote_cache_time_start = 0.0
 remote_cache_total_time = 0.0
 remote_cache_total_requests = 0
+local_cache_total_hits = 0
 
 
 def get_remote_cache_time() -> float:
@@ -54,6 +56,12 @@ def get_remote_cache_requests() -> int:
     return remote_cache_total_requests
 
 
+def get_local_cache_hits() -> int:
+    """The number of objects served from a LocalCache, which are not
+    counted as remote cache requests."""
+    return local_cache_total_hits
+
+
 def remote_cache_stats_start() -> None:
     global remote_cache_time_start
     remote_cache_time_start = time.time()
@@ -331,6 +339,98 @@ CacheItemT = TypeVar("CacheItemT")
 CompressedItemT = TypeVar("CompressedItemT")
 
 
+class LocalCache(Generic[ObjKT, CompressedItemT]):
+    """A size-bounded, per-process LRU cache in front of the remote
+    cache, for objects that are read far more often than they change;
+    see the local_cache argument of generic_bulk_cached_fetch.
+
+    Since the objects can be changed by any process, each entry is
+    tagged with an epoch token stored in the remote cache, which is
+    shared by a group of objects (see epoch_key_function), and is
+    only used while that token is unchanged.  Code that changes the
+    objects must call flush_epochs after updating the remote cache.
+    This way, validating a page of objects only requires fetching a
+    few small epoch tokens, rather than the objects themselves.
+    """
+
+    def __init__(
+        self,
+        epoch_key_function: Callable[[ObjKT], str],
+        max_size: Callable[[], int],
+        timeout: int,
+    ) -> None:
+        self.epoch_key_function = epoch_key_function
+        self.max_size = max_size
+        self.timeout = timeout
+        self.entries: "OrderedDict[str, Tuple[str, CompressedItemT]]" = OrderedDict()
+
+    def is_enabled(self) -> bool:
+        if self.max_size() > 0:
+            return True
+        self.entries.clear()
+        return False
+
+    def get_many(
+        self, cache_keys: Dict[ObjKT, str]
+    ) -> Tuple[Dict[str, Tuple[CompressedItemT]], Dict[str, str]]:
+        """Returns the cached objects, in the format returned by
+        safe_cache_get_many, and the epoch of each cache key, which
+        must be passed to set_many for any objects fetched from the
+        database."""
+        global local_cache_total_hits
+
+        epoch_keys = {
+            key: self.epoch_key_function(object_id) for object_id, key in cache_keys.items()
+        }
+        # We must read the epochs before the objects themselves; an
+        # object changed after we read its epoch will thus be tagged
+        # with an outdated epoch, rather than the reverse.
+        current_epochs = safe_cache_get_many(list(set(epoch_keys.values())))
+        new_epochs = {
+            epoch_key: secrets.token_hex(8)
+            for epoch_key in set(epoch_keys.values())
+            if epoch_key not in current_epochs
+        }
+        if new_epochs:
+            # An epoch that was evicted may have been replaced in the
+            # meantime, so we must not treat a missing one as a value.
+            safe_cache_set_many(new_epochs, timeout=self.timeout)
+            current_epochs.update(new_epochs)
+        epochs = {key: current_epochs[epoch_key] for key, epoch_key in epoch_keys.items()}
+
+        cached_objects: Dict[str, Tuple[CompressedItemT]] = {}
+        for key, epoch in epochs.items():
+            entry = self.entries.get(KEY_PREFIX + key)
+            if entry is not None and entry[0] == epoch:
+                self.entries.move_to_end(KEY_PREFIX + key)
+                cached_objects[key] = (entry[1],)
+        local_cache_total_hits += len(cached_objects)
+
+        needed_keys = [key for key in epochs if key not in cached_objects]
+        if needed_keys:
+            remote_objects: Dict[str, Tuple[CompressedItemT]] = safe_cache_get_many(needed_keys)
+            self.set_many(remote_objects, epochs)
+            cached_objects.update(remote_objects)
+        return cached_objects, epochs
+
+    def set_many(self, items: Dict[str, Tuple[CompressedItemT]], epochs: Dict[str, str]) -> None:
+        max_size = self.max_size()
+        for key, (value,) in items.items():
+            self.entries[KEY_PREFIX + key] = (epochs[key], value)
+            self.entries.move_to_end(KEY_PREFIX + key)
+        while len(self.entries) > max_size:
+            self.entries.popitem(last=False)
+
+    def flush_epochs(self, object_ids: Iterable[ObjKT]) -> None:
+        cache_set_many(
+            {
+                epoch_key: secrets.token_hex(8)
+                for epoch_key in {self.epoch_key_function(object_id) for object_id in object_ids}
+            },
+            timeout=self.timeout,
+        )
+
+
 # Required arguments are as follows:
 # * object_ids: The list of object ids to look up
 # * cache_key_function: object_id => cache key
@@ -344,6 +444,8 @@ CompressedItemT = TypeVar("CompressedItemT")
 # * cache_transformer: Function mapping an object from database =>
 #   value for cache (in case the values that we're caching are some
 #   function of the objects, not the objects themselves)
+# Optional arguments:
+# * local_cache: A LocalCache to check before the remote cache
 def generic_bulk_cached_fetch(
     cache_key_function: Callable[[ObjKT], str],
     query_function: Callable[[List[ObjKT]], Iterable[ItemT]],
@@ -353,6 +455,7 @@ def generic_bulk_cached_fetch(
     setter: Callable[[CacheItemT], CompressedItemT],
     id_fetcher: Callable[[ItemT], ObjKT],
     cache_transformer: Callable[[ItemT], CacheItemT],
+    local_cache: Optional[LocalCache[ObjKT, CompressedItemT]] = None,
 ) -> Dict[ObjKT, CacheItemT]:
     if len(object_ids) == 0:
         # Nothing to fetch.
@@ -362,9 +465,18 @@ def generic_bulk_cached_fetch(
     for object_id in object_ids:
         cache_keys[object_id] = cache_key_function(object_id)
 
-    cached_objects_compressed: Dict[str, Tuple[CompressedItemT]] = safe_cache_get_many(
-        [cache_keys[object_id] for object_id in object_ids],
-    )
+    if local_cache is not None and not local_cache.is_enabled():
+        # Skip fetching the epochs, which only serve the local cache.
+        local_cache = None
+
+    epochs: Dict[str, str] = {}
+    cached_objects_compressed: Dict[str, Tuple[CompressedItemT]]
+    if local_cache is not None:
+        cached_objects_compressed, epochs = local_cache.get_many(cache_keys)
+    else:
+        cached_objects_compressed = safe_cache_get_many(
+            [cache_keys[object_id] for object_id in object_ids],
+        )
 
     cached_objects = {key: extractor(val[0]) for key, val in cached_objects_compressed.items()}
     needed_ids = [
@@ -385,6 +497,8 @@ def generic_bulk_cached_fetch(
         cached_objects[key] = item
     if len(items_for_remote_cache) > 0:
         safe_cache_set_many(items_for_remote_cache)
+        if local_cache is not None:
+            local_cache.set_many(items_for_remote_cache, epochs)
     return {
         object_id: cached_objects[cache_keys[object_id]]
         for object_id in object_ids
@@ -642,6 +756,10 @@ def realm_text_description_cache_key(realm: "Realm") -> str:
     return f"realm_text_description:{realm.string_id}"
 
 
+def sparse_stream_recipient_ids_cache_key(realm_id: int) -> str:
+    return f"sparse_stream_recipient_ids:{realm_id}"
+
+
 # Called by models/streams.py to flush the stream cache whenever we save a stream
 # object.
 def flush_stream(
@@ -654,6 +772,9 @@ def flush_stream(
 
     stream = instance
 
+    if update_fields is None or "has_deferred_user_messages" in update_fields:
+        cache_delete(sparse_stream_recipient_ids_cache_key(stream.realm_id))
+
     if update_fields is None or (
         "name" in update_fields
         and UserProfile.objects.filter(
@@ -683,13 +804,191 @@ def to_dict_cache_key(message: "Message", realm_id: Optional[int] = None) -> str
     return to_dict_cache_key_id(message.id)
 
 
+# Each process keeps recently fetched encoded message dicts in memory,
+# so that repeatedly fetched pages of messages don't need to transfer
+# and unpickle them from memcached.  Messages share an epoch token per
+# block of MESSAGE_DICT_EPOCH_BLOCK_SIZE message IDs; blocks of old
+# messages, which is where most of the scrollback is, rarely change.
+MESSAGE_DICT_EPOCH_BLOCK_SIZE = 1000
+
+
+def message_dict_epoch_cache_key(message_id: int) -> str:
+    return f"message_dict_epoch:{message_id // MESSAGE_DICT_EPOCH_BLOCK_SIZE}"
+
+
+message_dict_local_cache: LocalCache[int, bytes] = LocalCache(
+    message_dict_epoch_cache_key,
+    max_size=lambda: settings.MESSAGE_DICT_LOCAL_CACHE_SIZE,
+    timeout=3600 * 24,
+)
+
+
+def flush_message_dict_cache(message_ids: Iterable[int]) -> None:
+    """Called after changing or deleting the cached message dicts for
+    these messages in memcached, so that other processes stop using
+    their local copies of them."""
+    message_dict_local_cache.flush_epochs(message_ids)
+
+
+# Cache of the Message fields needed to compute a user's unread
+# messages data; see get_unread_message_rows.
+UNREAD_MESSAGE_METADATA_CACHE_TIMEOUT = 3600 * 24
+# Only the metadata for each user's most recent unread messages is
+# cached, which keeps the cached value well under memcached's 1 MB
+# item size limit even with long topic names.
+UNREAD_MESSAGE_METADATA_CACHE_MAX_MESSAGES = 5000
+
+
+def unread_message_metadata_cache_key(user_profile_id: int) -> str:
+    return f"unread_message_metadata:{user_profile_id}"
+
+
+def unread_message_metadata_epoch_cache_key(user_profile_id: int) -> str:
+    return f"unread_message_metadata_epoch:{user_profile_id}"
+
+
+def get_unread_message_metadata_epoch(user_profile_id: int) -> str:
+    key = unread_message_metadata_epoch_cache_key(user_profile_id)
+    cached = cache_get(key)
+    if cached is not None:
+        return cached[0]
+    # If the epoch was evicted, the user's cached metadata may predate
+    # a move, so we must pick a new one rather than treating a missing
+    # epoch as a value.
+    epoch = secrets.token_hex(8)
+    cache_set(key, epoch, timeout=UNREAD_MESSAGE_METADATA_CACHE_TIMEOUT)
+    return epoch
+
+
+def flush_unread_message_metadata(user_profile_ids: Iterable[int]) -> None:
+    """Called whenever messages that these users have UserMessage rows
+    for move to a different topic or stream, which are the cached
+    fields that can change.  This includes read messages, since they
+    may still be in the cache if they are later marked as unread."""
+    cache_set_many(
+        {
+            unread_message_metadata_epoch_cache_key(user_profile_id): secrets.token_hex(8)
+            for user_profile_id in user_profile_ids
+        },
+        timeout=UNREAD_MESSAGE_METADATA_CACHE_TIMEOUT,
+    )
+
+
+# Cache of each user's first unread message ID in the narrows they
+# have recently opened; see find_first_unread_anchor.
+FIRST_UNREAD_ANCHORS_CACHE_TIMEOUT = 3600 * 24
+
+
+def first_unread_anchors_cache_key(user_profile_id: int) -> str:
+    return f"first_unread_anchors:{user_profile_id}"
+
+
+def first_unread_anchors_epoch_cache_key(user_profile_id: int) -> str:
+    return f"first_unread_anchors_epoch:{user_profile_id}"
+
+
+def get_first_unread_anchors(user_profile_id: int) -> Tuple[str, Dict[str, int]]:
+    """Returns the user's cached first unread anchors, keyed by narrow,
+    along with the epoch that set_first_unread_anchors must store them
+    under.  The epoch is read before the caller queries the database,
+    so that anchors computed concurrently with a flush are discarded."""
+    anchors_key = first_unread_anchors_cache_key(user_profile_id)
+    epoch_key = first_unread_anchors_epoch_cache_key(user_profile_id)
+    cached = cache_get_many([anchors_key, epoch_key])
+
+    epoch = cached.get(epoch_key)
+    if epoch is None:
+        epoch = secrets.token_hex(8)
+        cache_set_many({epoch_key: epoch}, timeout=FIRST_UNREAD_ANCHORS_CACHE_TIMEOUT)
+
+    value = cached.get(anchors_key)
+    if value is None or value["epoch"] != epoch:
+        return epoch, {}
+    return epoch, value["anchors"]
+
+
+def set_first_unread_anchors(user_profile_id: int, epoch: str, anchors: Dict[str, int]) -> None:
+    cache_set_many(
+        {first_unread_anchors_cache_key(user_profile_id): dict(epoch=epoch, anchors=anchors)},
+        timeout=FIRST_UNREAD_ANCHORS_CACHE_TIMEOUT,
+    )
+
+
+def flush_first_unread_anchors(user_profile_ids: Iterable[int]) -> None:
+    """Called whenever an earlier message may have become the first
+    unread message in some narrow for these users: marking messages as
+    unread, moving unread messages to a different topic or stream,
+    soft reactivation adding missing UserMessage rows, and changes to
+    which streams and topics are muted."""
+    cache_set_many(
+        {
+            first_unread_anchors_epoch_cache_key(user_profile_id): secrets.token_hex(8)
+            for user_profile_id in user_profile_ids
+        },
+        timeout=FIRST_UNREAD_ANCHORS_CACHE_TIMEOUT,
+    )
+
+
+# Cache of recently rendered message content; see do_convert.  Each
+# realm has an epoch token, which is replaced whenever a change to
+# the realm's linkifiers, custom emoji, or alert words may change how
+# the same content would render.
+MARKDOWN_RENDERING_CACHE_TIMEOUT = 3600 * 24
+
+
+def markdown_rendering_cache_key(rendering_inputs_hash: str) -> str:
+    return f"markdown_rendering:{rendering_inputs_hash}"
+
+
+def markdown_rendering_epoch_cache_key(realm_id: int) -> str:
+    return f"markdown_rendering_epoch:{realm_id}"
+
+
+def get_cached_markdown_rendering(realm_id: int, rendering_inputs_hash: str) -> Tuple[str, Any]:
+    """Returns the cached rendering for the given inputs, or None,
+    along with the epoch that set_cached_markdown_rendering must store
+    a new rendering under.  Renderings are stored along with their
+    epoch, rather than keyed by it, so that we can fetch both in a
+    single round trip."""
+    rendering_key = markdown_rendering_cache_key(rendering_inputs_hash)
+    epoch_key = markdown_rendering_epoch_cache_key(realm_id)
+    cached = cache_get_many([rendering_key, epoch_key])
+
+    epoch = cached.get(epoch_key)
+    if epoch is None:
+        epoch = secrets.token_hex(8)
+        cache_set_many({epoch_key: epoch}, timeout=MARKDOWN_RENDERING_CACHE_TIMEOUT)
+
+    value = cached.get(rendering_key)
+    if value is None or value["epoch"] != epoch:
+        return epoch, None
+    return epoch, value["rendering"]
+
+
+def set_cached_markdown_rendering(rendering_inputs_hash: str, epoch: str, rendering: Any) -> None:
+    key = markdown_rendering_cache_key(rendering_inputs_hash)
+    cache_set_many(
+        {key: dict(epoch=epoch, rendering=rendering)}, timeout=MARKDOWN_RENDERING_CACHE_TIMEOUT
+    )
+
+
+def flush_markdown_rendering_cache_for_realm(realm_id: int) -> None:
+    cache_set_many(
+        {markdown_rendering_epoch_cache_key(realm_id): secrets.token_hex(8)},
+        timeout=MARKDOWN_RENDERING_CACHE_TIMEOUT,
+    )
+
+
 def open_graph_description_cache_key(content: bytes, request_url: str) -> str:
     return f"open_graph_description_path:{hashlib.sha1(request_url.encode()).hexdigest()}"
 
 
-def flush_message(*, instance: "Message", **kwargs: object) -> None:
+def flush_message(*, instance: "Message", created: bool = False, **kwargs: object) -> None:
     message = instance
     cache_delete(to_dict_cache_key_id(message.id))
+    # A new message can't have been cached by any process yet.
+    if not created:
+        flush_message_dict_cache([message.id])
 
 
 def flush_submessage(*, instance: "SubMessage", **kwargs: object) -> None:
@@ -698,6 +997,7 @@ def flush_submessage(*, instance: "SubMessage", **kwargs: object) -> None:
     # parent messages
     message_id = submessage.message_id
     cache_delete(to_dict_cache_key_id(message_id))
+    flush_message_dict_cache([message_id])
 
 
 class IgnoreUnhashableLruCacheWrapper(Generic[ParamT, ReturnT]):
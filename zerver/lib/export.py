@@ -10,6 +10,7 @@ import glob
 import logging
 import os
 import shutil
+import signal
 import subprocess
 import tempfile
 from contextlib import suppress
@@ -95,6 +96,14 @@ class MessagePartial(TypedDict):
 
 
 MESSAGE_BATCH_CHUNK_SIZE = 1000
+# The number of rows of a table which write_table_data serializes at
+# a time.
+TABLE_DATA_WRITE_CHUNK_SIZE = 1000
+
+# Written once all the message partials have been written, so that the
+# export_usermessage_batch processes, which start working on the
+# partials as they appear, know when to stop looking for more.
+MESSAGE_PARTIALS_DONE_FILENAME = "messages.partials-done"
 
 ALL_ZULIP_TABLES = {
     "analytics_fillstate",
@@ -143,6 +152,7 @@ ALL_ZULIP_TABLES = {
     "zerver_preregistrationrealm",
     "zerver_preregistrationuser",
     "zerver_preregistrationuser_streams",
+    "zerver_presencesequence",
     "zerver_pushdevicetoken",
     "zerver_reaction",
     "zerver_realm",
@@ -161,6 +171,7 @@ ALL_ZULIP_TABLES = {
     "zerver_scheduledmessagenotificationemail",
     "zerver_service",
     "zerver_stream",
+    "zerver_streamtopic",
     "zerver_submessage",
     "zerver_subscription",
     "zerver_useractivity",
@@ -225,6 +236,12 @@ NON_EXPORTED_TABLES = {
     "zerver_archivedreaction",
     "zerver_archivedsubmessage",
     "zerver_archivetransaction",
+    # Topic summaries are maintained by database triggers on
+    # zerver_message, and are rebuilt as the messages are imported.
+    "zerver_streamtopic",
+    # Presence update ids are assigned by a database trigger on
+    # zerver_userpresence, and start over as presence is imported.
+    "zerver_presencesequence",
     # Social auth tables are not needed post-export, since we don't
     # use any of this state outside of a direct authentication flow.
     "social_auth_association",
@@ -384,7 +401,28 @@ def write_table_data(output_file: str, data: Dict[str, Any]) -> None:
 
     assert output_file.endswith(".json")
 
-    write_data_to_file(output_file, data)
+    # Rather than serializing all of the tables in one go, which for a
+    # large realm means holding a second, serialized copy of all of
+    # them in memory, we write each table a chunk of rows at a time,
+    # with one row per line.  See write_data_to_file for the options.
+    with open(output_file, "wb") as f:
+        f.write(b"{")
+        for i, (table_name, rows) in enumerate(data.items()):
+            if i > 0:
+                f.write(b",")
+            f.write(b"\n  " + orjson.dumps(table_name) + b": [")
+            for j in range(0, len(rows), TABLE_DATA_WRITE_CHUNK_SIZE):
+                if j > 0:
+                    f.write(b",")
+                f.write(
+                    b",".join(
+                        b"\n    " + orjson.dumps(row, option=orjson.OPT_PASSTHROUGH_DATETIME)
+                        for row in rows[j : j + TABLE_DATA_WRITE_CHUNK_SIZE]
+                    )
+                )
+            f.write(b"\n  ]")
+        f.write(b"\n}\n")
+    logging.info("Finished writing %s", output_file)
 
 
 def write_records_json_file(output_dir: str, records: List[Dict[str, Any]]) -> None:
@@ -1105,8 +1143,12 @@ def custom_fetch_realm_audit_logs_for_user(response: TableData, context: Context
 
 
 def fetch_reaction_data(response: TableData, message_ids: Set[int]) -> None:
-    query = Reaction.objects.filter(message_id__in=list(message_ids))
-    response["zerver_reaction"] = make_raw(list(query))
+    # Rather than one query with every exported message ID, fetch the
+    # reactions a chunk of messages at a time.
+    rows: List[Record] = []
+    for message_id_chunk in chunkify(sorted(message_ids), MESSAGE_BATCH_CHUNK_SIZE):
+        rows += make_raw(Reaction.objects.filter(message_id__in=message_id_chunk).order_by("id"))
+    response["zerver_reaction"] = rows
 
 
 def custom_fetch_huddle_objects(response: TableData, context: Context) -> None:
@@ -1444,8 +1486,11 @@ def write_message_partials(
             realm_id=realm.id,
         )
 
-        # And write the data.
-        write_data_to_file(message_filename, output)
+        # And write the data.  The export_usermessage_batch processes
+        # may already be running, so we write under a temporary name
+        # and rename, to avoid them picking up a half-written file.
+        write_data_to_file(message_filename + ".tmp", output)
+        os.rename(message_filename + ".tmp", message_filename)
         dump_file_id += 1
 
 
@@ -1959,52 +2004,67 @@ def do_export_realm(
 
     sanity_check_output(response)
 
-    # We (sort of) export zerver_message rows here.  We write
-    # them to .partial files that are subsequently fleshed out
-    # by parallel processes to add in zerver_usermessage data.
-    # This is for performance reasons, of course.  Some installations
-    # have millions of messages.
-    logging.info("Exporting .partial files messages")
-    message_ids = export_partial_message_files(
-        realm,
-        response,
-        output_dir=output_dir,
-        public_only=public_only,
-        consent_message_id=consent_message_id,
+    # Start parallel jobs to export the UserMessage objects; they
+    # process the message partials as we write them below, and keep
+    # running while we export the other tables and the uploaded files.
+    user_message_pids = launch_user_message_subprocesses(
+        threads=threads, output_dir=output_dir, consent_message_id=consent_message_id
     )
-    logging.info("%d messages were exported", len(message_ids))
 
-    # zerver_reaction
-    zerver_reaction: TableData = {}
-    fetch_reaction_data(response=zerver_reaction, message_ids=message_ids)
-    response.update(zerver_reaction)
+    message_partials_done_path = os.path.join(output_dir, MESSAGE_PARTIALS_DONE_FILENAME)
+    try:
+        # We (sort of) export zerver_message rows here.  We write
+        # them to .partial files that are subsequently fleshed out
+        # by parallel processes to add in zerver_usermessage data.
+        # This is for performance reasons, of course.  Some installations
+        # have millions of messages.
+        logging.info("Exporting .partial files messages")
+        message_ids = export_partial_message_files(
+            realm,
+            response,
+            output_dir=output_dir,
+            public_only=public_only,
+            consent_message_id=consent_message_id,
+        )
+        logging.info("%d messages were exported", len(message_ids))
+        with open(message_partials_done_path, "x"):
+            pass
 
-    # Override the "deactivated" flag on the realm
-    if export_as_active is not None:
-        response["zerver_realm"][0]["deactivated"] = not export_as_active
+        # zerver_reaction
+        zerver_reaction: TableData = {}
+        fetch_reaction_data(response=zerver_reaction, message_ids=message_ids)
+        response.update(zerver_reaction)
 
-    # Write realm data
-    export_file = os.path.join(output_dir, "realm.json")
-    write_table_data(output_file=export_file, data=response)
+        # Override the "deactivated" flag on the realm
+        if export_as_active is not None:
+            response["zerver_realm"][0]["deactivated"] = not export_as_active
 
-    # Write analytics data
-    export_analytics_tables(realm=realm, output_dir=output_dir)
+        # Write realm data
+        export_file = os.path.join(output_dir, "realm.json")
+        write_table_data(output_file=export_file, data=response)
 
-    # zerver_attachment
-    attachments = export_attachment_table(
-        realm=realm,
-        output_dir=output_dir,
-        message_ids=message_ids,
-        scheduled_message_ids=exportable_scheduled_message_ids,
-    )
+        # Write analytics data
+        export_analytics_tables(realm=realm, output_dir=output_dir)
 
-    logging.info("Exporting uploaded files and avatars")
-    export_uploads_and_avatars(realm, attachments=attachments, user=None, output_dir=output_dir)
+        # zerver_attachment
+        attachments = export_attachment_table(
+            realm=realm,
+            output_dir=output_dir,
+            message_ids=message_ids,
+            scheduled_message_ids=exportable_scheduled_message_ids,
+        )
 
-    # Start parallel jobs to export the UserMessage objects.
-    launch_user_message_subprocesses(
-        threads=threads, output_dir=output_dir, consent_message_id=consent_message_id
-    )
+        logging.info("Exporting uploaded files and avatars")
+        export_uploads_and_avatars(realm, attachments=attachments, user=None, output_dir=output_dir)
+    except BaseException:
+        # The subprocesses would otherwise keep waiting for message
+        # partials which will never be written.
+        for pid in user_message_pids:
+            os.kill(pid, signal.SIGTERM)
+        raise
+    finally:
+        wait_for_user_message_subprocesses(user_message_pids)
+    os.unlink(message_partials_done_path)
 
     logging.info("Finished exporting %s", realm.string_id)
     create_soft_link(source=output_dir, in_progress=False)
@@ -2061,7 +2121,7 @@ def create_soft_link(source: Path, in_progress: bool = True) -> None:
 
 def launch_user_message_subprocesses(
     threads: int, output_dir: Path, consent_message_id: Optional[int] = None
-) -> None:
+) -> Dict[int, int]:
     logging.info("Launching %d PARALLEL subprocesses to export UserMessage rows", threads)
     pids = {}
 
@@ -2071,6 +2131,7 @@ def launch_user_message_subprocesses(
             "export_usermessage_batch",
             f"--path={output_dir}",
             f"--thread={shard_id}",
+            "--wait-for-partials",
         ]
         if consent_message_id is not None:
             arguments.append(f"--consent-message-id={consent_message_id}")
@@ -2078,9 +2139,14 @@ def launch_user_message_subprocesses(
         process = subprocess.Popen(arguments)
         pids[process.pid] = shard_id
 
-    while pids:
-        pid, status = os.wait()
-        shard = pids.pop(pid)
+    return pids
+
+
+def wait_for_user_message_subprocesses(pids: Dict[int, int]) -> None:
+    # We wait for each of our subprocesses specifically, rather than
+    # for any child process, which may not be one of them.
+    for pid, shard in pids.items():
+        _, status = os.waitpid(pid, 0)
         print(f"Shard {shard} finished, status {status}")
 
 
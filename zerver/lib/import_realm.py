@@ -2,6 +2,7 @@ import logging
 import os
 import shutil
 from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass
 from datetime import datetime, timezone
 from mimetypes import guess_type
 from typing import Any, Dict, List, Optional, Set, Tuple
@@ -26,6 +27,7 @@ from zerver.lib.bulk_create import bulk_set_users_or_streams_recipient_fields
 from zerver.lib.export import DATE_FIELDS, Field, Path, Record, TableData, TableName
 from zerver.lib.markdown import markdown_convert
 from zerver.lib.markdown import version as markdown_version
+from zerver.lib.markdown.pool import MarkdownRenderingJob, MarkdownRenderingPool
 from zerver.lib.message import get_last_message_id
 from zerver.lib.push_notifications import sends_notifications_directly
 from zerver.lib.remote_server import maybe_enqueue_audit_log_upload
@@ -37,7 +39,7 @@ from zerver.lib.upload.base import BadImageError, sanitize_name
 from zerver.lib.upload.s3 import get_bucket
 from zerver.lib.user_counts import realm_user_count_by_role
 from zerver.lib.user_groups import create_system_user_groups_for_realm
-from zerver.lib.user_message import UserMessageLite, bulk_insert_ums
+from zerver.lib.user_message import UserMessageLite, copy_insert_ums
 from zerver.lib.utils import generate_api_key, process_list_in_batches
 from zerver.lib.zulip_update_announcements import send_zulip_update_announcements
 from zerver.models import (
@@ -303,12 +305,19 @@ def fix_customprofilefield(data: TableData) -> None:
 
 
 def fix_message_rendered_content(
-    realm: Realm, sender_map: Dict[int, Record], messages: List[Record]
+    realm: Realm,
+    sender_map: Dict[int, Record],
+    messages: List[Record],
+    rendering_pool: Optional[MarkdownRenderingPool] = None,
 ) -> None:
     """
     This function sets the rendered_content of all the messages
     after the messages have been imported from a non-Zulip platform.
+
+    If a rendering_pool is passed, messages are rendered in parallel
+    in its worker processes.
     """
+    messages_to_render: List[Record] = []
     for message in messages:
         if message["rendered_content"] is not None:
             # For Zulip->Zulip imports, we use the original rendered
@@ -357,6 +366,10 @@ def fix_message_rendered_content(
                 message["rendered_content"] = str(soup)
             continue
 
+        if rendering_pool is not None:
+            messages_to_render.append(message)
+            continue
+
         try:
             content = message["content"]
 
@@ -393,6 +406,30 @@ def fix_message_rendered_content(
                 "Error in Markdown rendering for message ID %s; continuing", message["id"]
             )
 
+    if not messages_to_render:
+        return
+
+    assert rendering_pool is not None
+    rendered_contents = rendering_pool.render(
+        [
+            MarkdownRenderingJob(
+                content=message["content"],
+                sent_by_bot=sender_map[message["sender_id"]]["is_bot"],
+                translate_emoticons=sender_map[message["sender_id"]]["translate_emoticons"],
+            )
+            for message in messages_to_render
+        ]
+    )
+    for message, rendered_content in zip(messages_to_render, rendered_contents):
+        if rendered_content is None:
+            logging.warning(
+                "Error in Markdown rendering for message ID %s; continuing", message["id"]
+            )
+            continue
+        message["rendered_content"] = rendered_content
+        if "scheduled_timestamp" not in message:
+            message["rendered_content_version"] = markdown_version
+
 
 def current_table_ids(data: TableData, table: TableName) -> List[int]:
     """
@@ -667,7 +704,9 @@ def bulk_import_user_message_data(data: TableData, dump_file_id: int) -> None:
             )
             for item in items
         ]
-        bulk_insert_ums(ums)
+        # Every batch is inserted with COPY, including a final batch
+        # below bulk_insert_ums's threshold for using it.
+        copy_insert_ums(ums)
 
     chunk_size = 10000
 
@@ -773,6 +812,31 @@ def process_avatars(record: Dict[str, Any]) -> None:
             )
 
 
+# Number of files copied by each task when importing uploads.
+UPLOAD_BATCH_SIZE = 100
+
+
+@dataclass
+class ImportedUpload:
+    source_path: Path
+    # The S3 key to upload the file to, or the local path to copy it to.
+    destination: str
+    extra_args: Optional[Dict[str, Any]] = None
+
+
+def copy_imported_uploads(bucket_name: Optional[str], uploads: List[ImportedUpload]) -> None:
+    if bucket_name is not None:
+        bucket = get_bucket(bucket_name)
+        for upload in uploads:
+            bucket.Object(upload.destination).upload_file(
+                Filename=upload.source_path, ExtraArgs=upload.extra_args
+            )
+    else:
+        for upload in uploads:
+            os.makedirs(os.path.dirname(upload.destination), exist_ok=True)
+            shutil.copy(upload.source_path, upload.destination)
+
+
 def import_uploads(
     realm: Realm,
     import_dir: Path,
@@ -808,14 +872,17 @@ def import_uploads(
 
     s3_uploads = settings.LOCAL_UPLOADS_DIR is None
 
+    bucket_name: Optional[str] = None
     if s3_uploads:
         if processing_avatars or processing_emojis or processing_realm_icons:
             bucket_name = settings.S3_AVATAR_BUCKET
         else:
             bucket_name = settings.S3_AUTH_UPLOADS_BUCKET
-        bucket = get_bucket(bucket_name)
 
-    for count, record in enumerate(records, 1):
+    # We work out where each file goes here, but copy the files
+    # afterwards, in parallel if we have multiple processes.
+    uploads: List[ImportedUpload] = []
+    for record in records:
         if processing_avatars:
             # For avatars, we need to rehash the user ID with the
             # new server's avatar salt
@@ -848,8 +915,8 @@ def import_uploads(
             )
             path_maps["attachment_path"][record["s3_path"]] = relative_path
 
+        source_path = os.path.join(import_dir, record["path"])
         if s3_uploads:
-            key = bucket.Object(relative_path)
             metadata = {}
             if "user_profile_id" not in record:
                 # This should never happen for uploads or avatars; if
@@ -882,9 +949,12 @@ def import_uploads(
                     # directly anyway.
                     content_type = "application/octet-stream"
 
-            key.upload_file(
-                Filename=os.path.join(import_dir, record["path"]),
-                ExtraArgs={"ContentType": content_type, "Metadata": metadata},
+            uploads.append(
+                ImportedUpload(
+                    source_path=source_path,
+                    destination=relative_path,
+                    extra_args={"ContentType": content_type, "Metadata": metadata},
+                )
             )
         else:
             assert settings.LOCAL_UPLOADS_DIR is not None
@@ -894,12 +964,37 @@ def import_uploads(
                 file_path = os.path.join(settings.LOCAL_AVATARS_DIR, relative_path)
             else:
                 file_path = os.path.join(settings.LOCAL_FILES_DIR, relative_path)
-            orig_file_path = os.path.join(import_dir, record["path"])
-            os.makedirs(os.path.dirname(file_path), exist_ok=True)
-            shutil.copy(orig_file_path, file_path)
+            uploads.append(ImportedUpload(source_path=source_path, destination=file_path))
 
-        if count % 1000 == 0:
-            logging.info("Processed %s/%s uploads", count, len(records))
+    upload_batches = [
+        uploads[i : i + UPLOAD_BATCH_SIZE] for i in range(0, len(uploads), UPLOAD_BATCH_SIZE)
+    ]
+    count = 0
+
+    def record_progress(batch_size: int) -> None:
+        nonlocal count
+        count += batch_size
+        # We log progress every 1000 files, not after every batch.
+        if count // 1000 > (count - batch_size) // 1000:
+            logging.info("Processed %s/%s uploads", count, len(uploads))
+
+    if processes == 1:
+        for batch in upload_batches:
+            copy_imported_uploads(bucket_name, batch)
+            record_progress(len(batch))
+    else:  # nocoverage
+        connection.close()
+        _cache = cache._cache  # type: ignore[attr-defined] # not in stubs
+        assert isinstance(_cache, bmemcached.Client)
+        _cache.disconnect_all()
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            futures = {
+                executor.submit(copy_imported_uploads, bucket_name, batch): len(batch)
+                for batch in upload_batches
+            }
+            for future in as_completed(futures):
+                future.result()
+                record_progress(futures[future])
 
     if processing_avatars:
         # Ensure that we have medium-size avatar images for every
@@ -1105,6 +1200,12 @@ def do_import_realm(import_dir: Path, subdomain: str, processes: int = 1) -> Rea
         # Handle rendering of stream descriptions for import from non-Zulip
         for stream in data["zerver_stream"]:
             stream["rendered_description"] = render_stream_description(stream["description"], realm)
+            # Exports only contain the UserMessage rows which exist, so
+            # subscribers of sparse streams will see any messages whose
+            # rows were still deferred as historical.  We don't keep the
+            # mode, since its bookkeeping refers to the old message IDs.
+            stream["sparse_user_messages"] = False
+            stream["has_deferred_user_messages"] = False
         bulk_import_model(data, Stream)
 
         if "zerver_usergroup" not in data:
@@ -1219,6 +1320,8 @@ def do_import_realm(import_dir: Path, subdomain: str, processes: int = 1) -> Rea
     re_map_foreign_keys(data, "zerver_subscription", "recipient", related_table="recipient")
     update_model_ids(Subscription, data, "subscription")
     fix_subscriptions_is_user_active_column(data, user_profiles, crossrealm_user_ids)
+    for sub in data["zerver_subscription"]:
+        sub["last_materialized_message_id"] = None
     bulk_import_model(data, Subscription)
 
     if "zerver_realmauditlog" in data:
@@ -1425,7 +1528,9 @@ def do_import_realm(import_dir: Path, subdomain: str, processes: int = 1) -> Rea
     sender_map = {user["id"]: user for user in data["zerver_userprofile"]}
 
     # Import zerver_message and zerver_usermessage
-    import_message_data(realm=realm, sender_map=sender_map, import_dir=import_dir)
+    import_message_data(
+        realm=realm, sender_map=sender_map, import_dir=import_dir, processes=processes
+    )
 
     if "zerver_scheduledmessage" in data:
         fix_datetime_fields(data, "zerver_scheduledmessage")
@@ -1618,7 +1723,25 @@ def get_incoming_message_ids(import_dir: Path, sort_by_date: bool) -> List[int]:
     return message_ids
 
 
-def import_message_data(realm: Realm, sender_map: Dict[int, Record], import_dir: Path) -> None:
+def import_message_data(
+    realm: Realm, sender_map: Dict[int, Record], import_dir: Path, processes: int = 1
+) -> None:
+    if processes == 1:
+        import_message_dumps(realm, sender_map, import_dir)
+    else:
+        # Rendering Markdown is the most expensive part of importing
+        # messages from other platforms, so we spread it across a
+        # pool of processes shared by all the message dumps.
+        with MarkdownRenderingPool(realm, processes) as rendering_pool:
+            import_message_dumps(realm, sender_map, import_dir, rendering_pool)
+
+
+def import_message_dumps(
+    realm: Realm,
+    sender_map: Dict[int, Record],
+    import_dir: Path,
+    rendering_pool: Optional[MarkdownRenderingPool] = None,
+) -> None:
     dump_file_id = 1
     while True:
         message_filename = os.path.join(import_dir, f"messages-{dump_file_id:06}.json")
@@ -1652,6 +1775,7 @@ def import_message_data(realm: Realm, sender_map: Dict[int, Record], import_dir:
             realm=realm,
             sender_map=sender_map,
             messages=data["zerver_message"],
+            rendering_pool=rendering_pool,
         )
         logging.info("Successfully rendered Markdown for message batch")
 
@@ -1,6 +1,7 @@
 # Zulip's main Markdown implementation.  See docs/subsystems/markdown.md for
 # detailed documentation on our Markdown syntax.
 import cgi
+import hashlib
 import html
 import logging
 import mimetypes
@@ -40,6 +41,7 @@ import markdown.postprocessors
 import markdown.preprocessors
 import markdown.treeprocessors
 import markdown.util
+import orjson
 import re2
 import regex
 import requests
@@ -51,7 +53,11 @@ from tlds import tld_set
 from typing_extensions import Self, TypeAlias, override
 
 from zerver.lib import mention
-from zerver.lib.cache import cache_with_key
+from zerver.lib.cache import (
+    cache_with_key,
+    get_cached_markdown_rendering,
+    set_cached_markdown_rendering,
+)
 from zerver.lib.camo import get_camo_url
 from zerver.lib.emoji import EMOTICON_RE, codepoint_to_name, name_to_codepoint, translate_emoticons
 from zerver.lib.emoji_utils import emoji_to_hex_codepoint, unqualify_emoji
@@ -262,6 +268,7 @@ def clear_state_for_testing() -> None:
     # try out both sides of ENABLE_FILE_LINKS, so we need
     # a way to clear it.
     get_web_link_regex.cache_clear()
+    linkifier_sets.clear()
 
 
 markdown_logger = logging.getLogger()
@@ -1829,6 +1836,103 @@ def prepare_linkifier_pattern(source: str) -> str:
     return rf"""(?P<{BEFORE_CAPTURE_GROUP}>^|\s|{next_line}|\pZ|['"\(,:<])(?P<{OUTER_CAPTURE_GROUP}>{source})(?P<{AFTER_CAPTURE_GROUP}>$|[^\pL\pN])"""
 
 
+class LinkifierSet:
+    """The compiled patterns and URL templates of a list of linkifiers,
+    along with an re2.Set of all of the patterns.  With hundreds of
+    linkifiers in a realm, searching a piece of text with each of them
+    in turn is expensive; the set instead finds which linkifiers match
+    the text in a single pass, so that only those need to be searched.
+    """
+
+    def __init__(self, linkifiers: List[LinkifierDict]) -> None:
+        self.linkifiers = linkifiers
+        self.patterns: List[Optional[Pattern[str]]] = []
+        self.url_templates: List[uri_template.URITemplate] = []
+
+        # Do not write errors to stderr (this still raises exceptions)
+        options = re2.Options()
+        options.log_errors = False
+
+        # Maps the indexes of the patterns in the set to the indexes
+        # of their linkifiers.
+        self.set_indexes: List[int] = []
+        pattern_set = re2.Set.SearchSet(options)
+        for linkifier in linkifiers:
+            prepared_pattern = prepare_linkifier_pattern(linkifier["pattern"])
+            try:
+                pattern = re2.compile(prepared_pattern, options=options)
+                pattern_set.Add(prepared_pattern)
+            except re2.error:
+                # An invalid regex shouldn't be possible here, and
+                # logging here on an invalid regex would spam the logs
+                # with every message sent; simply skip the linkifier.
+                pattern = None
+            else:
+                self.set_indexes.append(len(self.patterns))
+            self.patterns.append(pattern)
+            self.url_templates.append(uri_template.URITemplate(linkifier["url_template"]))
+        self.pattern_set: Optional[re2.Set] = None
+        if self.set_indexes:
+            try:
+                pattern_set.Compile()
+                self.pattern_set = pattern_set
+            except re2.error:
+                # This can happen if the combined patterns exceed
+                # re2's memory budget; we then search with every
+                # linkifier.
+                pass
+
+        # The Markdown processor searches the same text with each
+        # linkifier in turn, so we remember the last result.
+        self.last_search: Optional[Tuple[str, int, Set[int]]] = None
+
+    def matching_indexes(self, text: str, pos: int = 0) -> Set[int]:
+        """Returns the indexes of the linkifiers with a match in text,
+        starting at pos."""
+        last_search = self.last_search
+        if last_search is not None and last_search[1] == pos and last_search[0] == text:
+            return last_search[2]
+
+        if self.pattern_set is None:
+            indexes = set(self.set_indexes)
+        else:
+            # A linkifier's match starting at pos must be able to
+            # match "^" there, so we search the remaining text rather
+            # than the whole text, which could only miss matches.
+            set_matches = self.pattern_set.Match(text[pos:]) or []
+            indexes = {self.set_indexes[set_index] for set_index in set_matches}
+        self.last_search = (text, pos, indexes)
+        return indexes
+
+
+linkifier_sets: Dict[int, LinkifierSet] = {}
+
+
+def get_linkifier_set(linkifiers_key: int, linkifiers: List[LinkifierDict]) -> LinkifierSet:
+    linkifier_set = linkifier_sets.get(linkifiers_key)
+    if linkifier_set is None or linkifier_set.linkifiers != linkifiers:
+        linkifier_set = LinkifierSet(linkifiers)
+        linkifier_sets[linkifiers_key] = linkifier_set
+    return linkifier_set
+
+
+class LinkifierRegex:
+    """The compiled regex for LinkifierPattern, which only searches
+    text that its LinkifierSet found a match for the linkifier in."""
+
+    def __init__(self, linkifier_set: LinkifierSet, index: int) -> None:
+        self.linkifier_set = linkifier_set
+        self.index = index
+        pattern = linkifier_set.patterns[index]
+        assert pattern is not None
+        self.pattern = pattern
+
+    def search(self, text: str, pos: int = 0) -> Optional[Match[str]]:
+        if self.index not in self.linkifier_set.matching_indexes(text, pos):
+            return None
+        return self.pattern.search(text, pos)
+
+
 # Given a regular expression pattern, linkifies groups that match it
 # using the provided format string to construct the URL.
 class LinkifierPattern(CompiledInlineProcessor):
@@ -1836,19 +1940,13 @@ class LinkifierPattern(CompiledInlineProcessor):
 
     def __init__(
         self,
-        source_pattern: str,
-        url_template: str,
+        linkifier_set: LinkifierSet,
+        index: int,
         zmd: "ZulipMarkdown",
     ) -> None:
-        # Do not write errors to stderr (this still raises exceptions)
-        options = re2.Options()
-        options.log_errors = False
+        self.prepared_url_template = linkifier_set.url_templates[index]
 
-        compiled_re2 = re2.compile(prepare_linkifier_pattern(source_pattern), options=options)
-
-        self.prepared_url_template = uri_template.URITemplate(url_template)
-
-        super().__init__(compiled_re2, zmd)
+        super().__init__(cast(Pattern[str], LinkifierRegex(linkifier_set, index)), zmd)
 
     @override
     def handleMatch(  # type: ignore[override] # https://github.com/python/mypy/issues/10197
@@ -2172,11 +2270,11 @@ class ZulipMarkdown(markdown.Markdown):
 
     def __init__(
         self,
-        linkifiers: List[LinkifierDict],
+        linkifier_set: LinkifierSet,
         linkifiers_key: int,
         email_gateway: bool,
     ) -> None:
-        self.linkifiers = linkifiers
+        self.linkifier_set = linkifier_set
         self.linkifiers_key = linkifiers_key
         self.email_gateway = email_gateway
 
@@ -2330,10 +2428,12 @@ class ZulipMarkdown(markdown.Markdown):
     def register_linkifiers(
         self, registry: markdown.util.Registry[markdown.inlinepatterns.Pattern]
     ) -> markdown.util.Registry[markdown.inlinepatterns.Pattern]:
-        for linkifier in self.linkifiers:
+        for index, linkifier in enumerate(self.linkifier_set.linkifiers):
+            if self.linkifier_set.patterns[index] is None:
+                continue
             pattern = linkifier["pattern"]
             registry.register(
-                LinkifierPattern(pattern, linkifier["url_template"], self),
+                LinkifierPattern(self.linkifier_set, index, self),
                 f"linkifiers/{pattern}",
                 45,
             )
@@ -2395,7 +2495,7 @@ def make_md_engine(linkifiers_key: int, email_gateway: bool) -> None:
 
     linkifiers = linkifier_data[linkifiers_key]
     md_engines[md_engine_key] = ZulipMarkdown(
-        linkifiers=linkifiers,
+        linkifier_set=get_linkifier_set(linkifiers_key, linkifiers),
         linkifiers_key=linkifiers_key,
         email_gateway=email_gateway,
     )
@@ -2435,21 +2535,14 @@ class TopicLinkMatch:
 # are validated and escaped inside `url_to_a`).
 def topic_links(linkifiers_key: int, topic_name: str) -> List[Dict[str, str]]:
     matches: List[TopicLinkMatch] = []
-    linkifiers = linkifiers_for_realm(linkifiers_key)
-    precedence = 0
-
-    options = re2.Options()
-    options.log_errors = False
-    for linkifier in linkifiers:
-        raw_pattern = linkifier["pattern"]
-        prepared_url_template = uri_template.URITemplate(linkifier["url_template"])
-        try:
-            pattern = re2.compile(prepare_linkifier_pattern(raw_pattern), options=options)
-        except re2.error:
-            # An invalid regex shouldn't be possible here, and logging
-            # here on an invalid regex would spam the logs with every
-            # message sent; simply move on.
-            continue
+    linkifier_set = get_linkifier_set(linkifiers_key, linkifiers_for_realm(linkifiers_key))
+
+    # Linkifiers are prioritized by their order, so we use their
+    # indexes as their precedence.
+    for precedence in sorted(linkifier_set.matching_indexes(topic_name)):
+        pattern = linkifier_set.patterns[precedence]
+        assert pattern is not None
+        prepared_url_template = linkifier_set.url_templates[precedence]
         pos = 0
         while pos < len(topic_name):
             m = pattern.search(topic_name, pos)
@@ -2476,7 +2569,6 @@ def topic_links(linkifiers_key: int, topic_name: str) -> List[Dict[str, str]]:
                     precedence=precedence,
                 )
             ]
-        precedence += 1
 
     # Sort the matches beforehand so we favor the match with a higher priority and tie-break with the starting index.
     # Note that we sort it before processing the raw URLs so that linkifiers will be prioritized over them.
@@ -2564,10 +2656,48 @@ def maybe_update_markdown_engines(linkifiers_key: int, email_gateway: bool) -> N
 _privacy_re = re.compile(r"\w")
 
 
+# Cleared in the worker processes of a MarkdownRenderingPool; see
+# zerver/lib/markdown/pool.py.
+render_with_thread_timeout = True
+
+
 def privacy_clean_markdown(content: str) -> str:
     return repr(_privacy_re.sub("x", content))
 
 
+def get_rendering_inputs_hash(
+    content: str, md_engine_key: Tuple[int, bool], _md_engine: ZulipMarkdown
+) -> str:
+    """Hashes everything that rendering this content can depend on,
+    other than the realm's linkifiers, custom emoji, and alert words,
+    which are covered by the realm's rendering cache epoch."""
+    db_data = _md_engine.zulip_db_data
+    assert db_data is not None
+    assert _md_engine.zulip_realm is not None
+    mention_data = db_data.mention_data
+    rendering_inputs = [
+        content,
+        md_engine_key,
+        db_data.realm_uri,
+        _md_engine.zulip_realm.default_code_block_language,
+        db_data.realm_alert_words_automaton is not None,
+        db_data.sent_by_bot,
+        db_data.translate_emoticons,
+        _md_engine.image_preview_enabled,
+        _md_engine.url_embed_preview_enabled,
+        sorted(
+            (user.id, user.full_name, user.is_active)
+            for user in mention_data.user_id_info.values()
+        ),
+        sorted(
+            (user_group.id, user_group.name)
+            for user_group in mention_data.user_group_name_info.values()
+        ),
+        sorted(db_data.stream_names.items()),
+    ]
+    return hashlib.sha256(orjson.dumps(rendering_inputs)).hexdigest()
+
+
 def do_convert(
     content: str,
     realm_alert_words_automaton: Optional[ahocorasick.Automaton] = None,
@@ -2669,13 +2799,38 @@ def do_convert(
             translate_emoticons=translate_emoticons,
         )
 
+    # Bots often send the same content repeatedly, so we cache the
+    # rendering of message content, keyed by all of the inputs that
+    # the rendering depends on.  We don't cache renderings with URL
+    # previews, which the embed_links worker fetches separately.
+    rendering_inputs_hash: Optional[str] = None
+    if message is not None and _md_engine.zulip_db_data is not None and url_embed_data is None:
+        rendering_inputs_hash = get_rendering_inputs_hash(content, md_engine_key, _md_engine)
+
     try:
+        if rendering_inputs_hash is not None:
+            assert message is not None and message_realm is not None
+            rendering_cache_epoch, cached_rendering = get_cached_markdown_rendering(
+                message_realm.id, rendering_inputs_hash
+            )
+            if cached_rendering is not None:
+                # The rendering sets these flags on the message as a
+                # side effect, so we cache them too.
+                cached_rendering_result, message.has_link, message.has_image = cached_rendering
+                return cached_rendering_result
+
         # Spend at most 5 seconds rendering; this protects the backend
         # from being overloaded by bugs (e.g. Markdown logic that is
         # extremely inefficient in corner cases) as well as user
         # errors (e.g. a linkifier that makes some syntax
-        # infinite-loop).
-        rendering_result.rendered_content = unsafe_timeout(5, lambda: _md_engine.convert(content))
+        # infinite-loop).  Processes in a MarkdownRenderingPool are
+        # instead killed by their parent when they take too long.
+        if render_with_thread_timeout:
+            rendering_result.rendered_content = unsafe_timeout(
+                5, lambda: _md_engine.convert(content)
+            )
+        else:  # nocoverage
+            rendering_result.rendered_content = _md_engine.convert(content)
 
         # Throw an exception if the content is huge; this protects the
         # rest of the codebase from any bugs where we end up rendering
@@ -2685,6 +2840,14 @@ def do_convert(
             raise MarkdownRenderingError(
                 f"Rendered content exceeds {MAX_MESSAGE_LENGTH * 100} characters (message {logging_message_id})"
             )
+
+        if rendering_inputs_hash is not None:
+            assert message is not None
+            set_cached_markdown_rendering(
+                rendering_inputs_hash,
+                rendering_cache_epoch,
+                (rendering_result, message.has_link, message.has_image),
+            )
         return rendering_result
     except Exception:
         cleaned = privacy_clean_markdown(content)
@@ -0,0 +1,188 @@
+import logging
+import multiprocessing
+import time
+from dataclasses import dataclass
+from multiprocessing.connection import Connection, wait
+from multiprocessing.process import BaseProcess
+from types import TracebackType
+from typing import Dict, List, Optional, Sequence, Tuple, Type
+
+import bmemcached
+from django.core.cache import cache
+from django.db import connection
+from typing_extensions import Self
+
+from zerver.lib import markdown
+from zerver.lib.markdown import markdown_convert, privacy_clean_markdown
+from zerver.lib.mention import MentionBackend, MentionData
+from zerver.models import Realm
+
+# We fork worker processes so that they inherit the already-imported
+# Django application, and the Markdown engines built by the parent.
+fork_context = multiprocessing.get_context("fork")
+
+
+@dataclass
+class MarkdownRenderingJob:
+    content: str
+    sent_by_bot: bool
+    translate_emoticons: bool
+    # The mention data for rendering the message, if the caller has
+    # already fetched it; otherwise the worker fetches it.
+    mention_data: Optional[MentionData] = None
+
+
+@dataclass
+class MarkdownRenderingWorker:
+    process: BaseProcess
+    connection: Connection
+
+
+def close_connections_before_fork() -> None:  # nocoverage
+    # Forked processes must not share the parent's database or
+    # memcached sockets; both reconnect lazily on their next use.
+    connection.close()
+    _cache = cache._cache  # type: ignore[attr-defined] # not in stubs
+    assert isinstance(_cache, bmemcached.Client)
+    _cache.disconnect_all()
+
+
+def render_jobs_in_worker(realm: Realm, job_connection: Connection) -> None:  # nocoverage
+    # The parent kills this process if a job takes too long, which,
+    # unlike unsafe_timeout, works even if rendering is stuck inside
+    # a C extension such as a regular expression engine.
+    markdown.render_with_thread_timeout = False
+    # The worker renders every job for the same realm, and without a
+    # sender, so it can reuse one MentionBackend's caches of the
+    # realm's users and streams across jobs, rather than fetching the
+    # same mentioned users from the database for every message.
+    mention_backend = MentionBackend(realm.id)
+    while True:
+        try:
+            job: MarkdownRenderingJob = job_connection.recv()
+        except EOFError:
+            return
+
+        rendered_content: Optional[str] = None
+        try:
+            mention_data = job.mention_data
+            if mention_data is None:
+                mention_data = MentionData(mention_backend, job.content, message_sender=None)
+            rendered_content = markdown_convert(
+                content=job.content,
+                message_realm=realm,
+                sent_by_bot=job.sent_by_bot,
+                translate_emoticons=job.translate_emoticons,
+                mention_data=mention_data,
+            ).rendered_content
+        except Exception:
+            # markdown_convert has already logged the details.
+            pass
+        job_connection.send(rendered_content)
+
+
+class MarkdownRenderingPool:
+    """A pool of worker processes for rendering many messages from a
+    single realm, for bulk operations like data imports.
+
+    Each worker keeps its own Markdown engine across jobs.  A job that
+    takes longer than `timeout` seconds has its worker killed and
+    replaced, and renders as None, as does a job whose rendering
+    raises an exception.
+    """
+
+    def __init__(self, realm: Realm, processes: int, timeout: float = 5) -> None:
+        assert processes > 0
+        self.realm = realm
+        self.processes = processes
+        self.timeout = timeout
+        self.workers: List[MarkdownRenderingWorker] = []
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc_value: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> None:
+        self.close()
+
+    def start_worker(self) -> MarkdownRenderingWorker:
+        close_connections_before_fork()
+        parent_connection, child_connection = fork_context.Pipe()
+        process = fork_context.Process(
+            target=render_jobs_in_worker, args=(self.realm, child_connection), daemon=True
+        )
+        process.start()
+        child_connection.close()
+        return MarkdownRenderingWorker(process=process, connection=parent_connection)
+
+    def stop_worker(self, worker: MarkdownRenderingWorker) -> None:
+        worker.connection.close()
+        worker.process.kill()
+        worker.process.join()
+
+    def render(self, jobs: Sequence[MarkdownRenderingJob]) -> List[Optional[str]]:
+        while len(self.workers) < min(self.processes, len(jobs)):
+            self.workers.append(self.start_worker())
+
+        results: List[Optional[str]] = [None] * len(jobs)
+        next_job_index = 0
+        idle_workers = list(self.workers)
+        # Maps each busy worker's connection to the worker, the index
+        # of the job it is rendering, and that job's deadline.
+        busy_workers: Dict[Connection, Tuple[MarkdownRenderingWorker, int, float]] = {}
+
+        while next_job_index < len(jobs) or busy_workers:
+            while idle_workers and next_job_index < len(jobs):
+                worker = idle_workers.pop()
+                worker.connection.send(jobs[next_job_index])
+                busy_workers[worker.connection] = (
+                    worker,
+                    next_job_index,
+                    time.monotonic() + self.timeout,
+                )
+                next_job_index += 1
+
+            next_deadline = min(deadline for _, _, deadline in busy_workers.values())
+            ready = wait(list(busy_workers), timeout=max(0, next_deadline - time.monotonic()))
+            for ready_connection in ready:
+                assert isinstance(ready_connection, Connection)
+                worker, job_index, deadline = busy_workers.pop(ready_connection)
+                try:
+                    results[job_index] = ready_connection.recv()
+                    idle_workers.append(worker)
+                except EOFError:
+                    logging.warning("Markdown rendering worker exited unexpectedly")
+                    idle_workers.append(self.replace_worker(worker))
+
+            now = time.monotonic()
+            for worker, job_index, deadline in list(busy_workers.values()):
+                if deadline > now:
+                    continue
+                del busy_workers[worker.connection]
+                logging.warning(
+                    "Timed out rendering Markdown; input (sanitized) was: %s",
+                    privacy_clean_markdown(jobs[job_index].content),
+                )
+                idle_workers.append(self.replace_worker(worker))
+
+        return results
+
+    def replace_worker(self, worker: MarkdownRenderingWorker) -> MarkdownRenderingWorker:
+        self.stop_worker(worker)
+        new_worker = self.start_worker()
+        self.workers[self.workers.index(worker)] = new_worker
+        return new_worker
+
+    def close(self) -> None:
+        for worker in self.workers:
+            # Closing the connection makes the worker exit cleanly.
+            worker.connection.close()
+            worker.process.join(timeout=self.timeout)
+            if worker.process.is_alive():  # nocoverage
+                worker.process.kill()
+                worker.process.join()
+        self.workers = []
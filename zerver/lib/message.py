@@ -26,12 +26,22 @@ from psycopg2.sql import SQL
 
 from analytics.lib.counts import COUNT_STATS
 from analytics.models import RealmCount
-from zerver.lib.cache import generic_bulk_cached_fetch, to_dict_cache_key_id
+from zerver.lib.cache import (
+    UNREAD_MESSAGE_METADATA_CACHE_MAX_MESSAGES,
+    UNREAD_MESSAGE_METADATA_CACHE_TIMEOUT,
+    cache_get,
+    cache_set,
+    generic_bulk_cached_fetch,
+    get_unread_message_metadata_epoch,
+    message_dict_local_cache,
+    to_dict_cache_key_id,
+    unread_message_metadata_cache_key,
+)
 from zerver.lib.display_recipient import get_display_recipient_by_id
 from zerver.lib.exceptions import JsonableError, MissingAuthenticationError
 from zerver.lib.markdown import MessageRenderingResult
 from zerver.lib.mention import MentionData
-from zerver.lib.message_cache import MessageDict, extract_message_dict, stringify_message_dict
+from zerver.lib.message_cache import MessageDict, stringify_message_dict
 from zerver.lib.partial import partial
 from zerver.lib.request import RequestVariableConversionError
 from zerver.lib.stream_subscription import (
@@ -223,23 +233,30 @@ def messages_for_ids(
 ) -> List[Dict[str, Any]]:
     id_fetcher = lambda row: row["id"]
 
-    message_dicts = generic_bulk_cached_fetch(
+    # We fetch the encoded message dicts, rather than parsing them,
+    # since the parsed and finalized forms of recently fetched
+    # messages are cached too; see MessageDict.get_cached_message_dicts.
+    encoded_message_dicts = generic_bulk_cached_fetch(
         to_dict_cache_key_id,
         MessageDict.ids_to_dict,
         message_ids,
         id_fetcher=id_fetcher,
-        cache_transformer=lambda obj: obj,
-        extractor=extract_message_dict,
-        setter=stringify_message_dict,
+        cache_transformer=stringify_message_dict,
+        extractor=lambda obj: obj,
+        setter=lambda obj: obj,
+        local_cache=message_dict_local_cache,
     )
+    cached_message_dicts = MessageDict.get_cached_message_dicts(encoded_message_dicts)
+    entries = [cached_message_dicts[message_id] for message_id in message_ids]
 
-    message_list: List[Dict[str, Any]] = []
-
-    sender_ids = [message_dicts[message_id]["sender_id"] for message_id in message_ids]
+    sender_ids = [entry.wide_dict["sender_id"] for entry in entries]
     inaccessible_sender_ids = get_inaccessible_user_ids(sender_ids, user_profile)
 
-    for message_id in message_ids:
-        msg_dict = message_dicts[message_id]
+    message_list = MessageDict.finalize_cached_message_dicts(
+        entries, apply_markdown, client_gravatar, realm, inaccessible_sender_ids
+    )
+    for msg_dict in message_list:
+        message_id = msg_dict["id"]
         flags = user_message_flags[message_id]
         # TODO/compatibility: The `wildcard_mentioned` flag was deprecated in favor of
         # the `stream_wildcard_mentioned` and `topic_wildcard_mentioned` flags.  The
@@ -255,10 +272,6 @@ def messages_for_ids(
         # in realms with allow_edit_history disabled.
         if "edit_history" in msg_dict and not allow_edit_history:
             del msg_dict["edit_history"]
-        msg_dict["can_access_sender"] = msg_dict["sender_id"] not in inaccessible_sender_ids
-        message_list.append(msg_dict)
-
-    MessageDict.post_process_dicts(message_list, apply_markdown, client_gravatar, realm)
 
     return message_list
 
@@ -574,45 +587,159 @@ def get_starred_message_ids(user_profile: UserProfile) -> List[int]:
     )
 
 
+UNREAD_ROW_FIELDS = [
+    "message_id",
+    "message__sender_id",
+    MESSAGE__TOPIC,
+    "message__recipient_id",
+    "message__recipient__type",
+    "message__recipient__type_id",
+    "flags",
+]
+
+
 def get_raw_unread_data(
     user_profile: UserProfile, message_ids: Optional[List[int]] = None
 ) -> RawUnreadMessagesResult:
     excluded_recipient_ids = get_inactive_recipient_ids(user_profile)
 
+    if message_ids is None:
+        # At page load we need all unread messages.
+        rows = get_unread_message_rows(user_profile, excluded_recipient_ids)
+        return extract_unread_data_from_um_rows(rows, user_profile)
+
+    # When users are marking just a few messages as unread, we just need
+    # those ids, and we know they're unread.
     user_msgs = (
         UserMessage.objects.filter(
             user_profile=user_profile,
+            message_id__in=message_ids,
         )
         .exclude(
             message__recipient_id__in=excluded_recipient_ids,
         )
-        .values(
-            "message_id",
-            "message__sender_id",
-            MESSAGE__TOPIC,
-            "message__recipient_id",
-            "message__recipient__type",
-            "message__recipient__type_id",
-            "flags",
-        )
+        .values(*UNREAD_ROW_FIELDS)
         .order_by("-message_id")
     )
 
-    if message_ids is not None:
-        # When users are marking just a few messages as unread, we just need
-        # those ids, and we know they're unread.
-        user_msgs = user_msgs.filter(message_id__in=message_ids)
-    else:
-        # At page load we need all unread messages.
-        user_msgs = user_msgs.extra(
-            where=[UserMessage.where_unread()],
+    # Limit unread messages for performance reasons.
+    rows = list(reversed(list(user_msgs[:MAX_UNREAD_MESSAGES])))
+    return extract_unread_data_from_um_rows(rows, user_profile)
+
+
+def get_unread_message_rows(
+    user_profile: UserProfile, excluded_recipient_ids: List[int]
+) -> List[Dict[str, Any]]:
+    """Returns the user's most recent MAX_UNREAD_MESSAGES unread messages
+    in recipients other than excluded_recipient_ids, oldest first, as
+    UserMessage rows with the fields in UNREAD_ROW_FIELDS.
+
+    Finding the ids of a user's unread messages is cheap, thanks to the
+    partial index on unread UserMessage rows; the expensive part, for
+    users with large backlogs, is joining each of them to Message and
+    Recipient.  So we cache the Message fields we need for each of the
+    user's unread messages, and only query Message for those that are
+    not in that cache, i.e. those received or marked as unread since it
+    was computed.  Messages that are read or deleted since then simply
+    don't appear in the UserMessage query, so the only maintenance the
+    cache needs is when messages move to a different topic or stream;
+    see flush_unread_message_metadata.
+    """
+    # Uses index: zerver_usermessage_unread_message_id
+    unread_user_messages = list(
+        UserMessage.objects.filter(user_profile=user_profile)
+        .extra(where=[UserMessage.where_unread()])
+        .order_by("-message_id")
+        .values_list("message_id", "flags")[:MAX_UNREAD_MESSAGES]
+    )
+    if not unread_user_messages:
+        return []
+
+    epoch = get_unread_message_metadata_epoch(user_profile.id)
+    cache_key = unread_message_metadata_cache_key(user_profile.id)
+    cached = cache_get(cache_key)
+    cached_metadata: Dict[int, Tuple[int, str, int, int, int]] = {}
+    if cached is not None and cached[0]["epoch"] == epoch:
+        cached_metadata = cached[0]["messages"]
+
+    metadata = cached_metadata
+    missing_message_ids = [
+        message_id for message_id, flags in unread_user_messages if message_id not in metadata
+    ]
+    if missing_message_ids:
+        metadata = dict(cached_metadata)
+        for row in Message.objects.filter(id__in=missing_message_ids).values_list(
+            "id",
+            "sender_id",
+            TOPIC_NAME,
+            "recipient_id",
+            "recipient__type",
+            "recipient__type_id",
+        ):
+            metadata[row[0]] = row[1:]
+
+        # We only cache the metadata for the most recent unread
+        # messages, and so only need to update the cache if some of
+        # those were missing; older unread messages beyond the cap
+        # are always fetched from the database.
+        cached_unread_messages = unread_user_messages[:UNREAD_MESSAGE_METADATA_CACHE_MAX_MESSAGES]
+        if any(message_id not in cached_metadata for message_id, flags in cached_unread_messages):
+            cache_set(
+                cache_key,
+                dict(
+                    epoch=epoch,
+                    messages={
+                        message_id: metadata[message_id]
+                        for message_id, flags in cached_unread_messages
+                        if message_id in metadata
+                    },
+                ),
+                timeout=UNREAD_MESSAGE_METADATA_CACHE_TIMEOUT,
+            )
+
+    excluded_recipient_id_set = set(excluded_recipient_ids)
+    rows: List[Dict[str, Any]] = []
+    for message_id, flags in reversed(unread_user_messages):
+        if message_id not in metadata:
+            # Deleted since we queried UserMessage.
+            continue
+        sender_id, topic_name, recipient_id, recipient_type, recipient_type_id = metadata[
+            message_id
+        ]
+        if recipient_id in excluded_recipient_id_set:
+            continue
+        rows.append(
+            {
+                "message_id": message_id,
+                "message__sender_id": sender_id,
+                MESSAGE__TOPIC: topic_name,
+                "message__recipient_id": recipient_id,
+                "message__recipient__type": recipient_type,
+                "message__recipient__type_id": recipient_type_id,
+                "flags": flags,
+            }
         )
 
-    # Limit unread messages for performance reasons.
-    user_msgs = list(user_msgs[:MAX_UNREAD_MESSAGES])
+    if len(unread_user_messages) == MAX_UNREAD_MESSAGES and len(rows) < MAX_UNREAD_MESSAGES:
+        # We excluded some messages, and there may be older unread
+        # messages that would have made the cut; this is rare enough
+        # that we just do the full query.
+        user_msgs = (
+            UserMessage.objects.filter(
+                user_profile=user_profile,
+            )
+            .exclude(
+                message__recipient_id__in=excluded_recipient_ids,
+            )
+            .extra(
+                where=[UserMessage.where_unread()],
+            )
+            .values(*UNREAD_ROW_FIELDS)
+            .order_by("-message_id")
+        )
+        rows = list(reversed(list(user_msgs[:MAX_UNREAD_MESSAGES])))
 
-    rows = list(reversed(user_msgs))
-    return extract_unread_data_from_um_rows(rows, user_profile)
+    return rows
 
 
 def extract_unread_data_from_um_rows(
@@ -1,13 +1,22 @@
 import copy
 import zlib
+from collections import OrderedDict
+from dataclasses import dataclass, field
 from datetime import datetime
 from email.headerregistry import Address
-from typing import Any, Dict, Iterable, List, Optional, TypedDict
+from typing import AbstractSet, Any, Dict, Iterable, List, Optional, Tuple, TypedDict
 
 import orjson
+from django.conf import settings
 
 from zerver.lib.avatar import get_avatar_field, get_avatar_for_inaccessible_user
-from zerver.lib.cache import cache_set_many, cache_with_key, to_dict_cache_key, to_dict_cache_key_id
+from zerver.lib.cache import (
+    cache_set_many,
+    cache_with_key,
+    flush_message_dict_cache,
+    to_dict_cache_key,
+    to_dict_cache_key_id,
+)
 from zerver.lib.display_recipient import bulk_fetch_display_recipients
 from zerver.lib.markdown import render_message_markdown, topic_links
 from zerver.lib.markdown import version as markdown_version
@@ -77,6 +86,31 @@ def message_to_encoded_cache(message: Message, realm_id: Optional[int] = None) -
     return MessageDict.messages_to_encoded_cache([message], realm_id)[message.id]
 
 
+@dataclass
+class CachedMessageDict:
+    # The encoded message dict from the cache, and its parsed form,
+    # which must not be mutated.
+    encoded_dict: bytes
+    wide_dict: Dict[str, Any]
+    # Maps apply_markdown to the sender details and display recipient
+    # that the finalized payload template was built from, and the
+    # template itself, which lacks only the fields from
+    # MessageDict.get_sender_fields.
+    templates: Dict[bool, Tuple[Dict[str, Any], DisplayRecipientT, Dict[str, Any]]] = field(
+        default_factory=dict
+    )
+
+
+# Each process keeps the parsed and finalized forms of the message
+# dicts it fetched recently, so that fetching the same messages again,
+# which clients do all the time, mostly only needs to copy them.  The
+# entries are only used while the encoded message dict, sender details
+# and display recipient they were built from are unchanged, and are
+# bounded, like the local cache of the encoded dicts themselves, by
+# MESSAGE_DICT_LOCAL_CACHE_SIZE.
+cached_message_dicts: "OrderedDict[int, CachedMessageDict]" = OrderedDict()
+
+
 def update_message_cache(
     changed_messages: Iterable[Message], realm_id: Optional[int] = None
 ) -> List[int]:
@@ -91,6 +125,7 @@ def update_message_cache(
         items_for_remote_cache[key] = (msg,)
 
     cache_set_many(items_for_remote_cache)
+    flush_message_dict_cache(message_ids)
     return message_ids
 
 
@@ -189,8 +224,20 @@ class MessageDict:
         MessageDict.bulk_hydrate_sender_info(objs)
         MessageDict.bulk_hydrate_recipient_info(objs)
 
+        # A batch of messages usually has only a few distinct senders,
+        # so we compute the fields derived from the sender, like the
+        # avatar URL, once per sender in the batch rather than once
+        # per message.  We don't memoize them across batches, since
+        # they also depend on settings like ENABLE_GRAVATAR and on the
+        # upload backend.
+        sender_fields: Dict[Tuple[int, bool], Dict[str, Any]] = {}
         for obj in objs:
             can_access_sender = obj.get("can_access_sender", True)
+            sender_key = (obj["sender_id"], can_access_sender)
+            if sender_key not in sender_fields:
+                sender_fields[sender_key] = MessageDict.get_sender_fields(
+                    obj, client_gravatar, can_access_sender, realm.host
+                )
             MessageDict.finalize_payload(
                 obj,
                 apply_markdown,
@@ -198,8 +245,92 @@ class MessageDict:
                 skip_copy=True,
                 can_access_sender=can_access_sender,
                 realm_host=realm.host,
+                sender_fields=sender_fields[sender_key],
             )
 
+    @staticmethod
+    def get_cached_message_dicts(encoded_dicts: Dict[int, bytes]) -> Dict[int, CachedMessageDict]:
+        max_size = settings.MESSAGE_DICT_LOCAL_CACHE_SIZE
+        result: Dict[int, CachedMessageDict] = {}
+        for message_id, encoded_dict in encoded_dicts.items():
+            entry = cached_message_dicts.get(message_id)
+            if entry is None or entry.encoded_dict != encoded_dict:
+                entry = CachedMessageDict(encoded_dict, extract_message_dict(encoded_dict))
+            if max_size > 0:
+                cached_message_dicts[message_id] = entry
+                cached_message_dicts.move_to_end(message_id)
+            result[message_id] = entry
+        while len(cached_message_dicts) > max_size:
+            cached_message_dicts.popitem(last=False)
+        return result
+
+    @staticmethod
+    def finalize_cached_message_dicts(
+        entries: List[CachedMessageDict],
+        apply_markdown: bool,
+        client_gravatar: bool,
+        realm: Realm,
+        inaccessible_sender_ids: AbstractSet[int],
+    ) -> List[Dict[str, Any]]:
+        """
+        Returns the finalized payloads for the messages, as
+        post_process_dicts would, as new dicts which the caller may
+        modify; their nested values are shared, and must not be.
+
+        We still fetch the sender details and display recipients for
+        every call, since those change independently of the message
+        dicts, but only rebuild a message's payload template when they
+        differ from what it was built from.
+        """
+        sender_info = MessageDict.get_sender_info(
+            list({entry.wide_dict["sender_id"] for entry in entries})
+        )
+        display_recipients = bulk_fetch_display_recipients(
+            {
+                (
+                    entry.wide_dict["recipient_id"],
+                    entry.wide_dict["recipient_type"],
+                    entry.wide_dict["recipient_type_id"],
+                )
+                for entry in entries
+            }
+        )
+
+        sender_fields: Dict[Tuple[int, bool], Dict[str, Any]] = {}
+        objs: List[Dict[str, Any]] = []
+        for entry in entries:
+            wide_dict = entry.wide_dict
+            sender_id = wide_dict["sender_id"]
+            sender = sender_info[sender_id]
+            display_recipient = display_recipients[wide_dict["recipient_id"]]
+
+            cached_template = entry.templates.get(apply_markdown)
+            if (
+                cached_template is not None
+                and cached_template[0] == sender
+                and cached_template[1] == display_recipient
+            ):
+                template = cached_template[2]
+            else:
+                template = dict(wide_dict, **sender)
+                MessageDict.hydrate_recipient_info(template, display_recipient)
+                MessageDict.finalize_payload(
+                    template, apply_markdown, client_gravatar, skip_copy=True, sender_fields={}
+                )
+                entry.templates[apply_markdown] = (sender, display_recipient, template)
+
+            can_access_sender = sender_id not in inaccessible_sender_ids
+            sender_key = (sender_id, can_access_sender)
+            if sender_key not in sender_fields:
+                sender_fields[sender_key] = MessageDict.get_sender_fields(
+                    dict(sender, sender_id=sender_id, sender_realm_id=wide_dict["sender_realm_id"]),
+                    client_gravatar,
+                    can_access_sender,
+                    realm.host,
+                )
+            objs.append({**template, **sender_fields[sender_key]})
+        return objs
+
     @staticmethod
     def finalize_payload(
         obj: Dict[str, Any],
@@ -209,36 +340,26 @@ class MessageDict:
         skip_copy: bool = False,
         can_access_sender: bool = True,
         realm_host: str = "",
+        sender_fields: Optional[Dict[str, Any]] = None,
     ) -> Dict[str, Any]:
         """
         By default, we make a shallow copy of the incoming dict to avoid
         mutation-related bugs.  Code paths that are passing a unique object
         can pass skip_copy=True to avoid this extra work.
+
+        Code paths finalizing many messages from the same sender can
+        pass the result of get_sender_fields as sender_fields, to
+        avoid recomputing it for each message.
         """
         if not skip_copy:
             obj = copy.copy(obj)
 
-        if obj["sender_email_address_visibility"] != UserProfile.EMAIL_ADDRESS_VISIBILITY_EVERYONE:
-            # If email address of the sender is only available to administrators,
-            # clients cannot compute gravatars, so we force-set it to false.
-            # If we plumbed the current user's role, we could allow client_gravatar=True
-            # here if the current user's role has access to the target user's email address.
-            client_gravatar = False
-
-        if not can_access_sender:
-            # Enforce inability to access details of inaccessible
-            # users. We should be able to remove the realm_host and
-            # can_access_user plumbing to this function if/when we
-            # shift the Zulip API to not send these denormalized
-            # fields about message senders favor of just sending the
-            # sender's user ID.
-            obj["sender_full_name"] = str(UserProfile.INACCESSIBLE_USER_NAME)
-            sender_id = obj["sender_id"]
-            obj["sender_email"] = Address(
-                username=f"user{sender_id}", domain=get_fake_email_domain(realm_host)
-            ).addr_spec
+        if sender_fields is None:
+            sender_fields = MessageDict.get_sender_fields(
+                obj, client_gravatar, can_access_sender, realm_host
+            )
+        obj.update(sender_fields)
 
-        MessageDict.set_sender_avatar(obj, client_gravatar, can_access_sender)
         if apply_markdown:
             obj["content_type"] = "text/html"
             obj["content"] = obj["rendered_content"]
@@ -456,10 +577,14 @@ class MessageDict:
 
     @staticmethod
     def bulk_hydrate_sender_info(objs: List[Dict[str, Any]]) -> None:
-        sender_ids = list({obj["sender_id"] for obj in objs})
+        sender_info = MessageDict.get_sender_info(list({obj["sender_id"] for obj in objs}))
+        for obj in objs:
+            obj.update(sender_info[obj["sender_id"]])
 
+    @staticmethod
+    def get_sender_info(sender_ids: List[int]) -> Dict[int, Dict[str, Any]]:
         if not sender_ids:
-            return
+            return {}
 
         query = UserProfile.objects.values(
             "id",
@@ -475,19 +600,20 @@ class MessageDict:
 
         rows = query_for_ids(query, sender_ids, "zerver_userprofile.id")
 
-        sender_dict = {row["id"]: row for row in rows}
-
-        for obj in objs:
-            sender_id = obj["sender_id"]
-            user_row = sender_dict[sender_id]
-            obj["sender_full_name"] = user_row["full_name"]
-            obj["sender_email"] = user_row["email"]
-            obj["sender_delivery_email"] = user_row["delivery_email"]
-            obj["sender_realm_str"] = user_row["realm__string_id"]
-            obj["sender_avatar_source"] = user_row["avatar_source"]
-            obj["sender_avatar_version"] = user_row["avatar_version"]
-            obj["sender_is_mirror_dummy"] = user_row["is_mirror_dummy"]
-            obj["sender_email_address_visibility"] = user_row["email_address_visibility"]
+        sender_info = {
+            row["id"]: {
+                "sender_full_name": row["full_name"],
+                "sender_email": row["email"],
+                "sender_delivery_email": row["delivery_email"],
+                "sender_realm_str": row["realm__string_id"],
+                "sender_avatar_source": row["avatar_source"],
+                "sender_avatar_version": row["avatar_version"],
+                "sender_is_mirror_dummy": row["is_mirror_dummy"],
+                "sender_email_address_visibility": row["email_address_visibility"],
+            }
+            for row in rows
+        }
+        return sender_info
 
     @staticmethod
     def hydrate_recipient_info(obj: Dict[str, Any], display_recipient: DisplayRecipientT) -> None:
@@ -547,25 +673,45 @@ class MessageDict:
             MessageDict.hydrate_recipient_info(obj, display_recipients[obj["recipient_id"]])
 
     @staticmethod
-    def set_sender_avatar(
-        obj: Dict[str, Any], client_gravatar: bool, can_access_sender: bool = True
-    ) -> None:
+    def get_sender_fields(
+        obj: Dict[str, Any], client_gravatar: bool, can_access_sender: bool, realm_host: str
+    ) -> Dict[str, Any]:
+        """
+        Returns the fields of the finalized payload that only depend
+        on the message's sender, not on the message itself.  Callers
+        finalizing a batch of messages reuse the result for each
+        sender within the batch; see post_process_dicts.
+        """
         if not can_access_sender:
-            obj["avatar_url"] = get_avatar_for_inaccessible_user()
-            return
+            # Enforce inability to access details of inaccessible
+            # users. We should be able to remove the realm_host and
+            # can_access_user plumbing to this function if/when we
+            # shift the Zulip API to not send these denormalized
+            # fields about message senders favor of just sending the
+            # sender's user ID.
+            sender_id = obj["sender_id"]
+            return {
+                "sender_full_name": str(UserProfile.INACCESSIBLE_USER_NAME),
+                "sender_email": Address(
+                    username=f"user{sender_id}", domain=get_fake_email_domain(realm_host)
+                ).addr_spec,
+                "avatar_url": get_avatar_for_inaccessible_user(),
+            }
 
-        sender_id = obj["sender_id"]
-        sender_realm_id = obj["sender_realm_id"]
-        sender_delivery_email = obj["sender_delivery_email"]
-        sender_avatar_source = obj["sender_avatar_source"]
-        sender_avatar_version = obj["sender_avatar_version"]
-
-        obj["avatar_url"] = get_avatar_field(
-            user_id=sender_id,
-            realm_id=sender_realm_id,
-            email=sender_delivery_email,
-            avatar_source=sender_avatar_source,
-            avatar_version=sender_avatar_version,
+        if obj["sender_email_address_visibility"] != UserProfile.EMAIL_ADDRESS_VISIBILITY_EVERYONE:
+            # If email address of the sender is only available to administrators,
+            # clients cannot compute gravatars, so we force-set it to false.
+            # If we plumbed the current user's role, we could allow client_gravatar=True
+            # here if the current user's role has access to the target user's email address.
+            client_gravatar = False
+
+        avatar_url = get_avatar_field(
+            user_id=obj["sender_id"],
+            realm_id=obj["sender_realm_id"],
+            email=obj["sender_delivery_email"],
+            avatar_source=obj["sender_avatar_source"],
+            avatar_version=obj["sender_avatar_version"],
             medium=False,
             client_gravatar=client_gravatar,
         )
+        return {"avatar_url": avatar_url}
@@ -45,6 +45,7 @@ from sqlalchemy.types import ARRAY, Boolean, Integer, Text
 from typing_extensions import TypeAlias, override
 
 from zerver.lib.addressee import get_user_profiles, get_user_profiles_by_ids
+from zerver.lib.cache import get_first_unread_anchors, set_first_unread_anchors
 from zerver.lib.exceptions import ErrorCode, JsonableError
 from zerver.lib.message import get_first_visible_message_id
 from zerver.lib.narrow_predicate import channel_operators, channels_operators
@@ -741,21 +742,13 @@ class NarrowBuilder:
         else:
             return self._by_search_tsearch(query, operand, maybe_negate)
 
+    # Note that these only filter the query; the match positions used
+    # to highlight search results are computed separately, for just
+    # the rows we return, by search_highlight_query.
     def _by_search_pgroonga(
         self, query: Select, operand: str, maybe_negate: ConditionTransform
     ) -> Select:
-        match_positions_character = func.pgroonga_match_positions_character
-        query_extract_keywords = func.pgroonga_query_extract_keywords
         operand_escaped = func.escape_html(operand, type_=Text)
-        keywords = query_extract_keywords(operand_escaped)
-        query = query.add_columns(
-            match_positions_character(column("rendered_content", Text), keywords).label(
-                "content_matches"
-            ),
-            match_positions_character(
-                func.escape_html(topic_column_sa(), type_=Text), keywords
-            ).label("topic_matches"),
-        )
         condition = column("search_pgroonga", Text).op("&@~")(operand_escaped)
         return query.where(maybe_negate(condition))
 
@@ -763,17 +756,6 @@ class NarrowBuilder:
         self, query: Select, operand: str, maybe_negate: ConditionTransform
     ) -> Select:
         tsquery = func.plainto_tsquery(literal("zulip.english_us_search"), literal(operand))
-        query = query.add_columns(
-            ts_locs_array(
-                literal("zulip.english_us_search", Text), column("rendered_content", Text), tsquery
-            ).label("content_matches"),
-            # We HTML-escape the topic in PostgreSQL to avoid doing a server round-trip
-            ts_locs_array(
-                literal("zulip.english_us_search", Text),
-                func.escape_html(topic_column_sa(), type_=Text),
-                tsquery,
-            ).label("topic_matches"),
-        )
 
         # Do quoted string matching.  We really want phrase
         # search here so we can ignore punctuation and do
@@ -792,6 +774,49 @@ class NarrowBuilder:
         return query.where(maybe_negate(cond))
 
 
+def search_highlight_query(message_ids: List[int], operand: str) -> Select:
+    """
+    Computes the match positions of a search query in the topic and
+    rendered content of the given messages.  This is the expensive
+    part of a search, so we do it in a separate query for only the
+    page of results that we're returning, rather than for every
+    candidate row considered by the search query itself.
+    """
+    # We HTML-escape the topic in PostgreSQL to avoid doing a server round-trip
+    escaped_topic = func.escape_html(topic_column_sa(), type_=Text)
+    if settings.USING_PGROONGA:
+        match_positions_character = func.pgroonga_match_positions_character
+        keywords = func.pgroonga_query_extract_keywords(func.escape_html(operand, type_=Text))
+        content_matches = match_positions_character(column("rendered_content", Text), keywords)
+        topic_matches = match_positions_character(escaped_topic, keywords)
+    else:
+        config = literal("zulip.english_us_search", Text)
+        tsquery = func.plainto_tsquery(literal("zulip.english_us_search"), literal(operand))
+        content_matches = ts_locs_array(config, column("rendered_content", Text), tsquery)
+        topic_matches = ts_locs_array(config, escaped_topic, tsquery)
+
+    return (
+        select(
+            column("id", Integer).label("message_id"),
+            topic_column_sa(),
+            column("rendered_content", Text),
+            content_matches.label("content_matches"),
+            topic_matches.label("topic_matches"),
+        )
+        .select_from(table("zerver_message"))
+        .where(column("id", Integer).in_(message_ids))
+    )
+
+
+def get_search_operand(narrow: OptionalNarrowListT) -> Optional[str]:
+    if narrow is None:
+        return None
+    search_operands = [term["operand"] for term in narrow if term["operator"] == "search"]
+    if not search_operands:
+        return None
+    return " ".join(search_operands)
+
+
 def narrow_parameter(var_name: str, json: str) -> OptionalNarrowListT:
     data = orjson.loads(json)
     if not isinstance(data, list):
@@ -1037,7 +1062,6 @@ def add_narrow_conditions(
 
     if search_operands:
         is_search = True
-        query = query.add_columns(topic_column_sa(), column("rendered_content", Text))
         search_term = dict(
             operator="search",
             operand=" ".join(search_operands),
@@ -1047,6 +1071,42 @@ def add_narrow_conditions(
     return (query, is_search)
 
 
+# Narrow operators for which we cache the first unread anchor.  For
+# these, an earlier message can only become the first unread message
+# in the narrow by being marked as unread, by being moved into the
+# narrow, or by a change to the user's muted streams and topics, all
+# of which flush the cache; see flush_first_unread_anchors.
+FIRST_UNREAD_ANCHOR_CACHEABLE_OPERATORS = {
+    "channel",
+    "stream",
+    "topic",
+    "subject",
+    "sender",
+    "dm",
+    "pm-with",
+    "in",
+    "is",
+}
+FIRST_UNREAD_ANCHOR_CACHEABLE_IS_OPERANDS = {"dm", "private", "unread"}
+MAX_CACHED_FIRST_UNREAD_ANCHORS = 50
+
+
+def get_first_unread_anchor_cache_narrow_key(narrow: OptionalNarrowListT) -> Optional[str]:
+    if narrow is None:
+        narrow = []
+
+    terms = []
+    for term in narrow:
+        operator = term["operator"]
+        operand = term["operand"]
+        if term.get("negated", False) or operator not in FIRST_UNREAD_ANCHOR_CACHEABLE_OPERATORS:
+            return None
+        if operator == "is" and operand not in FIRST_UNREAD_ANCHOR_CACHEABLE_IS_OPERANDS:
+            return None
+        terms.append(orjson.dumps([operator, operand]).decode())
+    return ",".join(sorted(terms))
+
+
 def find_first_unread_anchor(
     sa_conn: Connection, user_profile: Optional[UserProfile], narrow: OptionalNarrowListT
 ) -> int:
@@ -1055,6 +1115,38 @@ def find_first_unread_anchor(
     if user_profile is None:
         return LARGER_THAN_MAX_MESSAGE_ID
 
+    narrow_key = get_first_unread_anchor_cache_narrow_key(narrow)
+    if narrow_key is None:
+        return query_first_unread_anchor(sa_conn, user_profile, narrow)
+
+    epoch, anchors = get_first_unread_anchors(user_profile.id)
+    anchor = anchors.get(narrow_key)
+    # Reading messages doesn't flush the cache, so we check that the
+    # cached anchor is still unread, which only needs a single row
+    # lookup in the UserMessage primary key index.
+    if (
+        anchor is not None
+        and UserMessage.objects.filter(user_profile_id=user_profile.id, message_id=anchor)
+        .extra(where=[UserMessage.where_unread()])
+        .exists()
+    ):
+        return anchor
+
+    anchor = query_first_unread_anchor(sa_conn, user_profile, narrow)
+    # We don't cache the absence of unread messages, since new
+    # messages arrive without flushing the cache.
+    if anchor != LARGER_THAN_MAX_MESSAGE_ID:
+        anchors.pop(narrow_key, None)
+        anchors[narrow_key] = anchor
+        while len(anchors) > MAX_CACHED_FIRST_UNREAD_ANCHORS:
+            del anchors[next(iter(anchors))]
+        set_first_unread_anchors(user_profile.id, epoch, anchors)
+    return anchor
+
+
+def query_first_unread_anchor(
+    sa_conn: Connection, user_profile: UserProfile, narrow: OptionalNarrowListT
+) -> int:
     # We always need UserMessage in our query, because it has the unread
     # flag for the user.
     need_user_message = True
@@ -1,4 +1,4 @@
-from typing import Any, Collection, Dict, List, Protocol
+from typing import Any, Collection, Dict, List, Optional, Protocol, Tuple
 
 from django.utils.translation import gettext as _
 
@@ -76,3 +76,52 @@ def build_narrow_predicate(
         return True
 
     return narrow_predicate
+
+
+# A key under which event queues with a narrow are indexed, so that a
+# stream message can be dispatched to just the narrowed queues that
+# could possibly match it, rather than testing every narrow predicate.
+NarrowIndexKey = Tuple[str, ...]
+
+
+def get_narrow_index_key(narrow: Collection[NarrowTerm]) -> Optional[NarrowIndexKey]:
+    """Returns the most selective index key for the narrow, or None if
+    the narrow may match any stream message.  Every stream message
+    matching the narrow is guaranteed to have this key among its
+    get_stream_message_index_keys; the narrow predicate must still be
+    checked for candidates found through the index."""
+    channel_name: Optional[str] = None
+    topic_name: Optional[str] = None
+    sender_email: Optional[str] = None
+    for narrow_term in narrow:
+        operator, operand = narrow_term.operator, narrow_term.operand
+        if operator in channel_operators and channel_name is None:
+            channel_name = operand.lower()
+        elif operator == "topic" and topic_name is None:
+            topic_name = operand.lower()
+        elif operator == "sender" and sender_email is None:
+            sender_email = operand.lower()
+        elif operator == "is" and operand in ["dm", "private"]:
+            # Never matches a stream message.
+            return ("dm",)
+
+    if channel_name is not None and topic_name is not None:
+        return ("channel_topic", channel_name, topic_name)
+    if channel_name is not None:
+        return ("channel", channel_name)
+    if topic_name is not None:
+        return ("topic", topic_name)
+    if sender_email is not None:
+        return ("sender", sender_email)
+    return None
+
+
+def get_stream_message_index_keys(message: Dict[str, Any]) -> List[NarrowIndexKey]:
+    channel_name = message["display_recipient"].lower()
+    topic_name = get_topic_from_message_info(message).lower()
+    return [
+        ("channel_topic", channel_name, topic_name),
+        ("channel", channel_name),
+        ("topic", topic_name),
+        ("sender", message["sender_email"].lower()),
+    ]
@@ -8,7 +8,7 @@ from django.utils.timezone import now as timezone_now
 
 from zerver.lib.timestamp import datetime_to_timestamp
 from zerver.lib.users import check_user_can_access_all_users, get_accessible_user_ids
-from zerver.models import Realm, UserPresence, UserProfile
+from zerver.models import PresenceSequence, Realm, UserPresence, UserProfile
 
 
 def get_presence_dicts_for_rows(
@@ -147,7 +147,10 @@ def get_presence_for_user(
 
 
 def get_presence_dict_by_realm(
-    realm: Realm, slim_presence: bool = False, requesting_user_profile: Optional[UserProfile] = None
+    realm: Realm,
+    slim_presence: bool = False,
+    requesting_user_profile: Optional[UserProfile] = None,
+    last_update_id_fetched_by_client: Optional[int] = None,
 ) -> Dict[str, Dict[str, Any]]:
     two_weeks_ago = timezone_now() - timedelta(weeks=2)
     query = UserPresence.objects.filter(
@@ -156,6 +159,8 @@ def get_presence_dict_by_realm(
         user_profile__is_active=True,
         user_profile__is_bot=False,
     )
+    if last_update_id_fetched_by_client is not None:
+        query = query.filter(last_update_id__gt=last_update_id_fetched_by_client)
 
     if settings.CAN_ACCESS_ALL_USERS_GROUP_LIMITS_PRESENCE and not check_user_can_access_all_users(
         requesting_user_profile
@@ -179,19 +184,50 @@ def get_presence_dict_by_realm(
 
 
 def get_presences_for_realm(
-    realm: Realm, slim_presence: bool, requesting_user_profile: UserProfile
+    realm: Realm,
+    slim_presence: bool,
+    requesting_user_profile: UserProfile,
+    last_update_id_fetched_by_client: Optional[int] = None,
 ) -> Dict[str, Dict[str, Dict[str, Any]]]:
     if realm.presence_disabled:
         # Return an empty dict if presence is disabled in this realm
         return defaultdict(dict)
 
-    return get_presence_dict_by_realm(realm, slim_presence, requesting_user_profile)
+    return get_presence_dict_by_realm(
+        realm, slim_presence, requesting_user_profile, last_update_id_fetched_by_client
+    )
+
+
+def get_presence_last_update_id(realm: Realm) -> int:
+    last_update_id = (
+        PresenceSequence.objects.filter(realm_id=realm.id)
+        .values_list("last_update_id", flat=True)
+        .first()
+    )
+    # Rows written before update ids were tracked have id 0.
+    return last_update_id or 0
 
 
 def get_presence_response(
-    requesting_user_profile: UserProfile, slim_presence: bool
+    requesting_user_profile: UserProfile,
+    slim_presence: bool,
+    last_update_id_fetched_by_client: Optional[int] = None,
 ) -> Dict[str, Any]:
     realm = requesting_user_profile.realm
     server_timestamp = time.time()
-    presences = get_presences_for_realm(realm, slim_presence, requesting_user_profile)
-    return dict(presences=presences, server_timestamp=server_timestamp)
+    if last_update_id_fetched_by_client is None:
+        presences = get_presences_for_realm(realm, slim_presence, requesting_user_profile)
+        return dict(presences=presences, server_timestamp=server_timestamp)
+
+    # We read the latest update id before fetching the presence data,
+    # so that any change committed in between is sent again with the
+    # client's next request, rather than being skipped.
+    presence_last_update_id = get_presence_last_update_id(realm)
+    presences = get_presences_for_realm(
+        realm, slim_presence, requesting_user_profile, last_update_id_fetched_by_client
+    )
+    return dict(
+        presences=presences,
+        server_timestamp=server_timestamp,
+        presence_last_update_id=presence_last_update_id,
+    )
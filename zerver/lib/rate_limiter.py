@@ -1,10 +1,10 @@
 import logging
 import time
 from abc import ABC, abstractmethod
-from typing import Dict, List, Optional, Set, Tuple, Type, cast
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set, Tuple, Type
 
 import orjson
-import redis
 from circuitbreaker import CircuitBreakerError, circuit
 from django.conf import settings
 from django.http import HttpRequest
@@ -25,10 +25,6 @@ rules: Dict[str, List[Tuple[int, int]]] = settings.RATE_LIMITING_RULES
 logger = logging.getLogger(__name__)
 
 
-class RateLimiterLockingError(Exception):
-    pass
-
-
 class RateLimitedObject(ABC):
     def __init__(self, backend: Optional["Type[RateLimiterBackend]"] = None) -> None:
         if backend is not None:
@@ -191,36 +187,54 @@ class RateLimiterBackend(ABC):
 
 class TornadoInMemoryRateLimiterBackend(RateLimiterBackend):
     # reset_times[rule][key] is the time at which the event
-    # request from the rate-limited key will be accepted.
-    reset_times: Dict[Tuple[int, int], Dict[str, float]] = {}
-
-    # last_gc_time is the last time when the garbage was
-    # collected from reset_times for rule (time_window, max_count).
-    last_gc_time: Dict[Tuple[int, int], float] = {}
+    # request from the rate-limited key will be accepted.  Keys are
+    # kept in the order they were last updated, so that expired keys
+    # can be garbage-collected from the front.
+    reset_times: Dict[Tuple[int, int], "OrderedDict[str, float]"] = {}
 
     # timestamps_blocked_until[key] contains the timestamp
     # up to which the key has been blocked manually.
     timestamps_blocked_until: Dict[str, float] = {}
 
+    # The most keys garbage-collected for a rule in a single request,
+    # which bounds how long that can block the Tornado ioloop.
+    GC_BATCH_SIZE = 100
+
+    # Once a rule tracks this many keys, requests from keys it does not
+    # track yet are counted in one of OVERFLOW_BUCKETS shared buckets,
+    # chosen by hashing the key.  This is approximate, since the keys
+    # in a bucket share its limit, but it caps memory use during a
+    # flood of requests from many IP addresses: a rule never tracks
+    # more than MAX_KEYS_PER_RULE + OVERFLOW_BUCKETS keys.
+    MAX_KEYS_PER_RULE = 100000
+    OVERFLOW_BUCKETS = 1000
+
     @classmethod
     def _garbage_collect_for_rule(cls, now: float, time_window: int, max_count: int) -> None:
-        keys_to_delete = []
         reset_times_for_rule = cls.reset_times.get((time_window, max_count), None)
         if reset_times_for_rule is None:
             return
 
-        keys_to_delete = [
-            entity_key
-            for entity_key in reset_times_for_rule
-            if reset_times_for_rule[entity_key] < now
-        ]
-
-        for entity_key in keys_to_delete:
+        # A key's reset time is at most time_window after it was last
+        # updated, so every key updated before the first one that has
+        # not expired has expired too, and we can stop there.
+        for _ in range(min(len(reset_times_for_rule), cls.GC_BATCH_SIZE)):
+            entity_key, reset_time = next(iter(reset_times_for_rule.items()))
+            if reset_time >= now:
+                break
             del reset_times_for_rule[entity_key]
 
         if not reset_times_for_rule:
             del cls.reset_times[(time_window, max_count)]
 
+    @classmethod
+    def _get_tracked_key(
+        cls, reset_times_for_rule: "OrderedDict[str, float]", entity_key: str
+    ) -> str:
+        if entity_key in reset_times_for_rule or len(reset_times_for_rule) < cls.MAX_KEYS_PER_RULE:
+            return entity_key
+        return f"overflow:{hash(entity_key) % cls.OVERFLOW_BUCKETS}"
+
     @classmethod
     def need_to_limit(cls, entity_key: str, time_window: int, max_count: int) -> Tuple[bool, float]:
         """
@@ -238,12 +252,11 @@ class TornadoInMemoryRateLimiterBackend(RateLimiterBackend):
         """
         now = time.time()
 
-        # Remove all timestamps from `reset_times` that are too old.
-        if cls.last_gc_time.get((time_window, max_count), 0) <= now - time_window / max_count:
-            cls.last_gc_time[(time_window, max_count)] = now
-            cls._garbage_collect_for_rule(now, time_window, max_count)
+        # Remove some of the timestamps from `reset_times` that are too old.
+        cls._garbage_collect_for_rule(now, time_window, max_count)
 
-        reset_times_for_rule = cls.reset_times.setdefault((time_window, max_count), {})
+        reset_times_for_rule = cls.reset_times.setdefault((time_window, max_count), OrderedDict())
+        entity_key = cls._get_tracked_key(reset_times_for_rule, entity_key)
         new_reset = max(reset_times_for_rule.get(entity_key, now), now) + time_window / max_count
 
         if new_reset > now + time_window:
@@ -252,6 +265,7 @@ class TornadoInMemoryRateLimiterBackend(RateLimiterBackend):
             return True, time_till_free
 
         reset_times_for_rule[entity_key] = new_reset
+        reset_times_for_rule.move_to_end(entity_key)
         return False, 0.0
 
     @classmethod
@@ -260,12 +274,13 @@ class TornadoInMemoryRateLimiterBackend(RateLimiterBackend):
         cls, entity_key: str, range_seconds: int, max_calls: int
     ) -> Tuple[int, float]:
         now = time.time()
-        if (range_seconds, max_calls) in cls.reset_times and entity_key in cls.reset_times[
-            (range_seconds, max_calls)
-        ]:
-            reset_time = cls.reset_times[(range_seconds, max_calls)][entity_key]
-        else:
+        reset_times_for_rule = cls.reset_times.get((range_seconds, max_calls))
+        if reset_times_for_rule is None:
+            return max_calls, 0
+        entity_key = cls._get_tracked_key(reset_times_for_rule, entity_key)
+        if entity_key not in reset_times_for_rule:
             return max_calls, 0
+        reset_time = reset_times_for_rule[entity_key]
 
         calls_remaining = (now + range_seconds - reset_time) * max_calls // range_seconds
         return int(calls_remaining), reset_time - now
@@ -312,6 +327,53 @@ class TornadoInMemoryRateLimiterBackend(RateLimiterBackend):
         return ratelimited, time_till_free
 
 
+# Checks the manual block and every rule for an entity, and if none
+# of them apply, records the request; running this as a single
+# script makes it atomic, and takes only one round trip to Redis.
+#
+# The most recent max_api_calls request timestamps are kept both in a
+# list, newest first, so that we can check each rule by looking at the
+# timestamp of the request that many requests ago, and in a sorted
+# set, so that get_api_calls_left can count the requests in a window.
+#
+# Times are returned as strings, since Redis truncates Lua numbers
+# to integers.
+RATE_LIMIT_SCRIPT = """
+local list_key, set_key, blocking_key = KEYS[1], KEYS[2], KEYS[3]
+local now = tonumber(ARGV[1])
+local max_api_calls = tonumber(ARGV[2])
+local max_api_window = tonumber(ARGV[3])
+
+if redis.call("GET", blocking_key) then
+    return {1, tostring(redis.call("TTL", blocking_key))}
+end
+
+for i = 4, #ARGV, 2 do
+    local timestamp = redis.call("LINDEX", list_key, tonumber(ARGV[i + 1]) - 1)
+    if timestamp then
+        local boundary = tonumber(timestamp) + tonumber(ARGV[i])
+        if boundary >= now then
+            return {1, tostring(boundary - now)}
+        end
+    end
+end
+
+local trimmed = redis.call("LINDEX", list_key, max_api_calls - 1)
+redis.call("LPUSH", list_key, ARGV[1])
+redis.call("LTRIM", list_key, 0, max_api_calls - 1)
+redis.call("ZADD", set_key, ARGV[1], ARGV[1])
+if trimmed then
+    redis.call("ZREM", set_key, trimmed)
+end
+redis.call("EXPIRE", list_key, max_api_window)
+redis.call("EXPIRE", set_key, max_api_window)
+return {0, "0"}
+"""
+
+# This runs the script with EVALSHA, loading it into Redis if needed.
+rate_limit_script = client.register_script(RATE_LIMIT_SCRIPT)
+
+
 class RedisRateLimiterBackend(RateLimiterBackend):
     @classmethod
     def get_keys(cls, entity_key: str) -> List[str]:
@@ -373,123 +435,18 @@ class RedisRateLimiterBackend(RateLimiterBackend):
 
         return calls_left, time_reset - now
 
-    @classmethod
-    def is_ratelimited(cls, entity_key: str, rules: List[Tuple[int, int]]) -> Tuple[bool, float]:
-        """Returns a tuple of (rate_limited, time_till_free)"""
-        assert rules
-        list_key, set_key, blocking_key = cls.get_keys(entity_key)
-
-        # Go through the rules from shortest to longest,
-        # seeing if this user has violated any of them. First
-        # get the timestamps for each nth items
-        with client.pipeline() as pipe:
-            for _, request_count in rules:
-                pipe.lindex(list_key, request_count - 1)  # 0-indexed list
-
-            # Get blocking info
-            pipe.get(blocking_key)
-            pipe.ttl(blocking_key)
-
-            rule_timestamps: List[Optional[bytes]] = pipe.execute()
-
-        # Check if there is a manual block on this API key
-        blocking_ttl_b = rule_timestamps.pop()
-        key_blocked = rule_timestamps.pop()
-
-        if key_blocked is not None:
-            # We are manually blocked. Report for how much longer we will be
-            if blocking_ttl_b is None:  # nocoverage # defensive code, this should never happen
-                blocking_ttl = 0.5
-            else:
-                blocking_ttl = int(blocking_ttl_b)
-            return True, blocking_ttl
-
-        now = time.time()
-        for timestamp, (range_seconds, num_requests) in zip(rule_timestamps, rules):
-            # Check if the nth timestamp is newer than the associated rule. If so,
-            # it means we've hit our limit for this rule
-            if timestamp is None:
-                continue
-
-            boundary = float(timestamp) + range_seconds
-            if boundary >= now:
-                free = boundary - now
-                return True, free
-
-        return False, 0.0
-
-    @classmethod
-    def incr_ratelimit(cls, entity_key: str, max_api_calls: int, max_api_window: int) -> None:
-        """Increases the rate-limit for the specified entity"""
-        list_key, set_key, _ = cls.get_keys(entity_key)
-        now = time.time()
-
-        # Start Redis transaction
-        with client.pipeline() as pipe:
-            count = 0
-            while True:
-                try:
-                    # To avoid a race condition between getting the element we might trim from our list
-                    # and removing it from our associated set, we abort this whole transaction if
-                    # another agent manages to change our list out from under us
-                    # When watching a value, the pipeline is set to Immediate mode
-                    pipe.watch(list_key)
-
-                    # Get the last elem that we'll trim (so we can remove it from our sorted set)
-                    last_val = cast(  # mypy doesn’t know the pipe is in immediate mode
-                        Optional[bytes], pipe.lindex(list_key, max_api_calls - 1)
-                    )
-
-                    # Restart buffered execution
-                    pipe.multi()
-
-                    # Add this timestamp to our list
-                    pipe.lpush(list_key, now)
-
-                    # Trim our list to the oldest rule we have
-                    pipe.ltrim(list_key, 0, max_api_calls - 1)
-
-                    # Add our new value to the sorted set that we keep
-                    # We need to put the score and val both as timestamp,
-                    # as we sort by score but remove by value
-                    pipe.zadd(set_key, {str(now): now})
-
-                    # Remove the trimmed value from our sorted set, if there was one
-                    if last_val is not None:
-                        pipe.zrem(set_key, last_val)
-
-                    # Set the TTL for our keys as well
-                    api_window = max_api_window
-                    pipe.expire(list_key, api_window)
-                    pipe.expire(set_key, api_window)
-
-                    pipe.execute()
-
-                    # If no exception was raised in the execution, there were no transaction conflicts
-                    break
-                except redis.WatchError:  # nocoverage # Ideally we'd have a test for this.
-                    if count > 10:
-                        raise RateLimiterLockingError
-                    count += 1
-
-                    continue
-
     @classmethod
     @override
     def rate_limit_entity(
         cls, entity_key: str, rules: List[Tuple[int, int]], max_api_calls: int, max_api_window: int
     ) -> Tuple[bool, float]:
-        ratelimited, time = cls.is_ratelimited(entity_key, rules)
-
-        if not ratelimited:
-            try:
-                cls.incr_ratelimit(entity_key, max_api_calls, max_api_window)
-            except RateLimiterLockingError:
-                logger.warning("Deadlock trying to incr_ratelimit for %s", entity_key)
-                # rate-limit users who are hitting the API so hard we can't update our stats.
-                ratelimited = True
-
-        return ratelimited, time
+        assert rules
+        now = time.time()
+        args: List[float] = [now, max_api_calls, max_api_window]
+        for range_seconds, num_requests in rules:
+            args += [range_seconds, num_requests]
+        ratelimited, time_till_free = rate_limit_script(keys=cls.get_keys(entity_key), args=args)
+        return bool(ratelimited), float(time_till_free)
 
 
 class RateLimitResult:
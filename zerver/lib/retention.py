@@ -27,16 +27,22 @@
 # message or group of messages) as we use for message retention policy
 # deletions.
 import logging
+import secrets
 import time
-from datetime import timedelta
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass
+from datetime import datetime, timedelta
 from typing import Any, Dict, Iterable, List, Mapping, Optional, Tuple, Type, Union
 
+import bmemcached
 from django.conf import settings
+from django.core.cache import cache
 from django.db import connection, transaction
 from django.db.models import Model
 from django.utils.timezone import now as timezone_now
 from psycopg2.sql import SQL, Composable, Identifier, Literal
 
+from zerver.lib.cache import cache_delete, cache_get, cache_get_many, cache_set, cache_set_many
 from zerver.lib.logging_util import log_to_file
 from zerver.lib.request import RequestVariableConversionError
 from zerver.models import (
@@ -62,6 +68,11 @@ MESSAGE_BATCH_SIZE = 1000
 STREAM_MESSAGE_BATCH_SIZE = 100
 TRANSACTION_DELETION_BATCH_SIZE = 100
 
+# Progress of archive_messages is checkpointed in the cache, so that an
+# interrupted run can be resumed; see get_archiving_run.
+ARCHIVING_RUN_CACHE_KEY = "retention_archiving_run"
+ARCHIVING_CHECKPOINT_TIMEOUT = 3600 * 24 * 7
+
 # This data structure declares the details of all database tables that
 # hang off the Message table (with a foreign key to Message being part
 # of its primary lookup key).  This structure allows us to share the
@@ -90,16 +101,13 @@ models_with_message_key: List[Dict[str, Any]] = [
 EXCLUDE_FIELDS = {Message._meta.get_field("search_tsvector")}
 
 
-@transaction.atomic(savepoint=False)
-def move_rows(
+def format_move_query(
     base_model: Type[Model],
     raw_query: SQL,
     *,
     src_db_table: Optional[str] = None,
-    returning_id: bool = False,
     **kwargs: Composable,
-) -> List[int]:
-    """Core helper for bulk moving rows between a table and its archive table"""
+) -> Composable:
     if src_db_table is None:
         # Use base_model's db_table unless otherwise specified.
         src_db_table = base_model._meta.db_table
@@ -107,11 +115,24 @@ def move_rows(
     fields = [field for field in base_model._meta.fields if field not in EXCLUDE_FIELDS]
     src_fields = [Identifier(src_db_table, field.column) for field in fields]
     dst_fields = [Identifier(field.column) for field in fields]
+    return raw_query.format(
+        src_fields=SQL(",").join(src_fields), dst_fields=SQL(",").join(dst_fields), **kwargs
+    )
+
+
+@transaction.atomic(savepoint=False)
+def move_rows(
+    base_model: Type[Model],
+    raw_query: SQL,
+    *,
+    src_db_table: Optional[str] = None,
+    returning_id: bool = False,
+    **kwargs: Composable,
+) -> List[int]:
+    """Core helper for bulk moving rows between a table and its archive table"""
     with connection.cursor() as cursor:
         cursor.execute(
-            raw_query.format(
-                src_fields=SQL(",").join(src_fields), dst_fields=SQL(",").join(dst_fields), **kwargs
-            )
+            format_move_query(base_model, raw_query, src_db_table=src_db_table, **kwargs)
         )
         if returning_id:
             return [id for (id,) in cursor.fetchall()]  # return list of row ids
@@ -132,6 +153,9 @@ def run_archiving_in_chunks(
     #
     # We implement this design by executing queries that archive messages and their related objects
     # (such as UserMessage, Reaction, and Attachment) inside the same transaction.atomic() block.
+    #
+    # The query must return the id and the size (pg_column_size) of
+    # each archived message row, which we use to report throughput.
     assert type in (ArchiveTransaction.MANUAL, ArchiveTransaction.RETENTION_POLICY_BASED)
 
     message_count = 0
@@ -139,15 +163,18 @@ def run_archiving_in_chunks(
         start_time = time.time()
         with transaction.atomic():
             archive_transaction = ArchiveTransaction.objects.create(type=type, realm=realm)
-            new_chunk = move_rows(
-                Message,
-                query,
-                src_db_table=None,
-                chunk_size=Literal(chunk_size),
-                returning_id=True,
-                archive_transaction_id=Literal(archive_transaction.id),
-                **kwargs,
-            )
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    format_move_query(
+                        Message,
+                        query,
+                        chunk_size=Literal(chunk_size),
+                        archive_transaction_id=Literal(archive_transaction.id),
+                        **kwargs,
+                    )
+                )
+                rows = cursor.fetchall()
+            new_chunk = [message_id for message_id, row_size in rows]
             if new_chunk:
                 move_related_objects_to_archive(new_chunk)
                 delete_messages(new_chunk)
@@ -160,11 +187,16 @@ def run_archiving_in_chunks(
         # archiving of the chunk is finished (since Django does some significant additional work
         # when leaving the block).
         if len(new_chunk) > 0:
+            chunk_bytes = sum(row_size for message_id, row_size in rows)
             logger.info(
-                "Archived %s messages in %.2fs in transaction %s.",
+                "Archived %s messages (%s bytes) in %.2fs in transaction %s; "
+                "%.0f messages/s, %.0f bytes/s.",
                 len(new_chunk),
+                chunk_bytes,
                 total_time,
                 archive_transaction.id,
+                len(new_chunk) / total_time,
+                chunk_bytes / total_time,
             )
 
         # We run the loop, until the query returns fewer results than chunk_size,
@@ -185,6 +217,7 @@ def move_expired_messages_to_archive_by_recipient(
     recipient: Recipient,
     message_retention_days: int,
     realm: Realm,
+    archive_before: datetime,
     chunk_size: int = MESSAGE_BATCH_SIZE,
 ) -> int:
     assert message_retention_days != -1
@@ -200,10 +233,10 @@ def move_expired_messages_to_archive_by_recipient(
             AND zerver_message.date_sent < {check_date}
         LIMIT {chunk_size}
     ON CONFLICT (id) DO UPDATE SET archive_transaction_id = {archive_transaction_id}
-    RETURNING id
+    RETURNING id, pg_column_size(zerver_archivedmessage.*)
     """
     )
-    check_date = timezone_now() - timedelta(days=message_retention_days)
+    check_date = archive_before - timedelta(days=message_retention_days)
 
     return run_archiving_in_chunks(
         query,
@@ -218,11 +251,12 @@ def move_expired_messages_to_archive_by_recipient(
 
 def move_expired_personal_and_huddle_messages_to_archive(
     realm: Realm,
+    archive_before: datetime,
     chunk_size: int = MESSAGE_BATCH_SIZE,
 ) -> int:
     message_retention_days = realm.message_retention_days
     assert message_retention_days != -1
-    check_date = timezone_now() - timedelta(days=message_retention_days)
+    check_date = archive_before - timedelta(days=message_retention_days)
 
     recipient_types = (Recipient.PERSONAL, Recipient.DIRECT_MESSAGE_GROUP)
 
@@ -239,7 +273,7 @@ def move_expired_personal_and_huddle_messages_to_archive(
             AND zerver_message.date_sent < {check_date}
         LIMIT {chunk_size}
     ON CONFLICT (id) DO UPDATE SET archive_transaction_id = {archive_transaction_id}
-    RETURNING id
+    RETURNING id, pg_column_size(zerver_archivedmessage.*)
     """
     )
 
@@ -345,66 +379,110 @@ def move_related_objects_to_archive(msg_ids: List[int]) -> None:
     move_attachment_messages_to_archive(msg_ids)
 
 
-def archive_messages_by_recipient(
-    recipient: Recipient,
-    message_retention_days: int,
-    realm: Realm,
-    chunk_size: int = MESSAGE_BATCH_SIZE,
-) -> int:
-    return move_expired_messages_to_archive_by_recipient(
-        recipient, message_retention_days, realm, chunk_size
-    )
+@dataclass
+class ArchivingJob:
+    realm: Realm
+    # None for the realm's personal and huddle messages.
+    stream: Optional[Stream]
 
+    def checkpoint_key(self, run_id: str) -> str:
+        stream_key = "dms" if self.stream is None else str(self.stream.id)
+        return f"retention_archiving_checkpoint:{run_id}:{self.realm.id}:{stream_key}"
 
-def archive_personal_and_huddle_messages(
-    realm: Realm, chunk_size: int = MESSAGE_BATCH_SIZE
-) -> None:
-    logger.info("Archiving personal and huddle messages for realm %s", realm.string_id)
-    message_count = move_expired_personal_and_huddle_messages_to_archive(realm, chunk_size)
-    logger.info("Done. Archived %s messages", message_count)
 
+def get_archiving_run() -> Tuple[str, datetime]:
+    """Returns the id and the reference time of the current archiving run.
 
-def archive_stream_messages(
-    realm: Realm, streams: List[Stream], chunk_size: int = STREAM_MESSAGE_BATCH_SIZE
-) -> None:
-    if not streams:
-        return  # nocoverage # TODO
+    If the previous run was interrupted, we resume it, using its
+    reference time so that expiry dates don't move under us; otherwise
+    we start a new run.
+    """
+    run = cache_get(ARCHIVING_RUN_CACHE_KEY)
+    if run is not None:
+        run_id, archive_before = run[0]
+        logger.info("Resuming interrupted archiving run started at %s", archive_before)
+        return run_id, archive_before
+
+    run_id, archive_before = secrets.token_hex(8), timezone_now()
+    cache_set(
+        ARCHIVING_RUN_CACHE_KEY, (run_id, archive_before), timeout=ARCHIVING_CHECKPOINT_TIMEOUT
+    )
+    return run_id, archive_before
 
-    logger.info("Archiving stream messages for realm %s", realm.string_id)
-    retention_policy_dict: Dict[int, int] = {}
-    for stream in streams:
+
+def run_archiving_job(
+    job: ArchivingJob, run_id: str, archive_before: datetime, chunk_size: int
+) -> None:
+    realm = job.realm
+    if job.stream is None:
+        logger.info("Archiving personal and huddle messages for realm %s", realm.string_id)
+        message_count = move_expired_personal_and_huddle_messages_to_archive(
+            realm, archive_before, chunk_size
+        )
+    else:
+        logger.info("Archiving messages in stream %s of realm %s", job.stream.id, realm.string_id)
         #  if stream.message_retention_days is null, use the realm's policy
-        if stream.message_retention_days:
-            retention_policy_dict[stream.id] = stream.message_retention_days
-        else:
+        message_retention_days = job.stream.message_retention_days
+        if not message_retention_days:
             assert realm.message_retention_days != -1
-            retention_policy_dict[stream.id] = realm.message_retention_days
-
-    recipients = [stream.recipient for stream in streams]
-    message_count = 0
-    for recipient in recipients:
-        assert recipient is not None
-        message_count += archive_messages_by_recipient(
-            recipient,
-            retention_policy_dict[recipient.type_id],
+            message_retention_days = realm.message_retention_days
+        assert job.stream.recipient is not None
+        message_count = move_expired_messages_to_archive_by_recipient(
+            job.stream.recipient,
+            message_retention_days,
             realm,
-            chunk_size,
+            archive_before,
+            STREAM_MESSAGE_BATCH_SIZE,
         )
 
-    logger.info("Done. Archived %s messages.", message_count)
+    # Messages are deleted as they are archived, so an interrupted job
+    # picks up where it stopped anyway; the checkpoint lets a resumed
+    # run skip the jobs which had already finished.
+    cache_set_many({job.checkpoint_key(run_id): True}, timeout=ARCHIVING_CHECKPOINT_TIMEOUT)
+    logger.info("Done. Archived %s messages", message_count)
 
 
-def archive_messages(chunk_size: int = MESSAGE_BATCH_SIZE) -> None:
+def archive_messages(chunk_size: int = MESSAGE_BATCH_SIZE, processes: int = 1) -> None:
     logger.info("Starting the archiving process with chunk_size %s", chunk_size)
+    run_id, archive_before = get_archiving_run()
 
-    for realm, streams in get_realms_and_streams_for_archiving():
-        archive_stream_messages(realm, streams, chunk_size=STREAM_MESSAGE_BATCH_SIZE)
+    realms_and_streams = get_realms_and_streams_for_archiving()
+    jobs: List[ArchivingJob] = []
+    for realm, streams in realms_and_streams:
+        jobs += [ArchivingJob(realm=realm, stream=stream) for stream in streams]
         if realm.message_retention_days != -1:
-            archive_personal_and_huddle_messages(realm, chunk_size)
+            jobs.append(ArchivingJob(realm=realm, stream=None))
 
-        # Messages have been archived for the realm, now we can clean up attachments:
+    finished_keys = cache_get_many([job.checkpoint_key(run_id) for job in jobs])
+    pending_jobs = [job for job in jobs if job.checkpoint_key(run_id) not in finished_keys]
+    if len(pending_jobs) < len(jobs):
+        logger.info(
+            "Skipping %s jobs finished before the interruption", len(jobs) - len(pending_jobs)
+        )
+
+    if processes == 1:
+        for job in pending_jobs:
+            run_archiving_job(job, run_id, archive_before, chunk_size)
+    else:  # nocoverage
+        # Each worker process opens its own database connection, so
+        # different streams are archived in parallel.
+        connection.close()
+        _cache = cache._cache  # type: ignore[attr-defined] # not in stubs
+        assert isinstance(_cache, bmemcached.Client)
+        _cache.disconnect_all()
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            for future in as_completed(
+                executor.submit(run_archiving_job, job, run_id, archive_before, chunk_size)
+                for job in pending_jobs
+            ):
+                future.result()
+
+    # Messages have been archived for the realms, now we can clean up attachments:
+    for realm, streams in realms_and_streams:
         delete_expired_attachments(realm)
 
+    cache_delete(ARCHIVING_RUN_CACHE_KEY)
+
 
 def get_realms_and_streams_for_archiving() -> List[Tuple[Realm, List[Stream]]]:
     """
@@ -468,7 +546,7 @@ def move_messages_to_archive(
         WHERE zerver_message.id IN {message_ids}
         LIMIT {chunk_size}
     ON CONFLICT (id) DO UPDATE SET archive_transaction_id = {archive_transaction_id}
-    RETURNING id
+    RETURNING id, pg_column_size(zerver_archivedmessage.*)
     """
     )
     count = run_archiving_in_chunks(
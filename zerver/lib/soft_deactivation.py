@@ -1,15 +1,23 @@
 # Documented in https://zulip.readthedocs.io/en/latest/subsystems/sending-messages.html#soft-deactivation
 import logging
 from collections import defaultdict
+from datetime import timedelta
+from functools import reduce
 from typing import Any, DefaultDict, Dict, Iterable, List, Optional, Sequence, Set, TypedDict, Union
 
 from django.conf import settings
-from django.db import transaction
-from django.db.models import Exists, F, Max, OuterRef, QuerySet
+from django.db import connection, transaction
+from django.db.models import Exists, F, Max, OuterRef, Q, QuerySet
 from django.db.models.functions import Greatest
 from django.utils.timezone import now as timezone_now
+from psycopg2.sql import SQL, Literal
 from sentry_sdk import capture_exception
 
+from zerver.lib.cache import (
+    cache_with_key,
+    flush_first_unread_anchors,
+    sparse_stream_recipient_ids_cache_key,
+)
 from zerver.lib.logging_util import log_to_file
 from zerver.lib.queue import queue_json_publish
 from zerver.lib.user_message import bulk_insert_all_ums
@@ -18,7 +26,7 @@ from zerver.models import (
     Message,
     Realm,
     RealmAuditLog,
-    Recipient,
+    Stream,
     Subscription,
     UserActivity,
     UserMessage,
@@ -30,6 +38,14 @@ logger = logging.getLogger("zulip.soft_deactivation")
 log_to_file(logger, settings.SOFT_DEACTIVATION_LOG_PATH)
 BULK_CREATE_BATCH_SIZE = 10000
 
+# Message IDs are allocated before the sending transaction commits, so
+# a message can become visible after others with higher IDs.  We only
+# advance a subscription's last_materialized_message_id past messages
+# sent at least this long ago, so that more recent messages are checked
+# again on later calls rather than being skipped if one was still
+# being sent.
+SPARSE_STREAM_MATERIALIZATION_MARGIN = timedelta(minutes=5)
+
 
 class MissingMessageDict(TypedDict):
     id: int
@@ -109,56 +125,9 @@ def filter_by_subscription_history(
     return sorted(message_ids)
 
 
-def add_missing_messages(user_profile: UserProfile) -> None:
-    """This function takes a soft-deactivated user, and computes and adds
-    to the database any UserMessage rows that were not created while
-    the user was soft-deactivated.  The end result is that from the
-    perspective of the message database, it should be impossible to
-    tell that the user was soft-deactivated at all.
-
-    At a high level, the algorithm is as follows:
-
-    * Find all the streams that the user was at any time a subscriber
-      of when or after they were soft-deactivated (`recipient_ids`
-      below).
-
-    * Find all the messages sent to those streams since the user was
-      soft-deactivated.  This will be a superset of the target
-      UserMessages we need to create in two ways: (1) some UserMessage
-      rows will have already been created in do_send_messages because
-      the user had a nonzero set of flags (the fact that we do so in
-      do_send_messages simplifies things considerably, since it means
-      we don't need to inspect message content to look for things like
-      mentions here), and (2) the user might not have been subscribed
-      to all of the streams in recipient_ids for the entire time
-      window.
-
-    * Correct the list from the previous state by excluding those with
-      existing UserMessage rows.
-
-    * Correct the list from the previous state by excluding those
-      where the user wasn't subscribed at the time, using the
-      RealmAuditLog data to determine exactly when the user was
-      subscribed/unsubscribed.
-
-    * Create the UserMessage rows.
-
-    For further documentation, see:
-
-      https://zulip.readthedocs.io/en/latest/subsystems/sending-messages.html#soft-deactivation
-
-    """
-    assert user_profile.last_active_message_id is not None
-    all_stream_subs = list(
-        Subscription.objects.filter(
-            user_profile=user_profile, recipient__type=Recipient.STREAM
-        ).values("recipient_id", "recipient__type_id")
-    )
-
-    # For stream messages we need to check messages against data from
-    # RealmAuditLog for visibility to user. So we fetch the subscription logs.
-    stream_ids = [sub["recipient__type_id"] for sub in all_stream_subs]
-
+def get_subscription_logs(
+    user_profile: UserProfile, stream_ids: List[int]
+) -> DefaultDict[int, List[RealmAuditLog]]:
     # We have a partial index on RealmAuditLog for these rows -- if
     # this set changes, the partial index must be updated as well, to
     # keep this query performant
@@ -187,20 +156,210 @@ def add_missing_messages(user_profile: UserProfile) -> None:
     all_stream_subscription_logs: DefaultDict[int, List[RealmAuditLog]] = defaultdict(list)
     for log in subscription_logs:
         all_stream_subscription_logs[assert_is_not_none(log.modified_stream_id)].append(log)
+    return all_stream_subscription_logs
+
+
+# Creates a batch of a soft-deactivated user's missing UserMessage
+# rows.  The user's subscription history for each stream is a sequence
+# of RealmAuditLog events, ordered by event_last_message_id, and then
+# by ID for events with no messages sent between them.  The user
+# received a message if the first such event after the message was
+# sent is an unsubscription, or if there is no such event and the last
+# event is a subscription.  So each unsubscription covers the messages
+# since the previous event, and a final subscription covers all later
+# messages.
+#
+# The partial index zerver_realmauditlog_user_subscriptions_idx covers
+# exactly these event types; if this set changes, the index must be
+# updated as well, to keep this query performant.
+ADD_MISSING_MESSAGES_SQL = SQL(
+    """
+WITH subscription_events AS (
+    SELECT
+        modified_stream_id AS stream_id,
+        event_type,
+        event_last_message_id,
+        lag(event_last_message_id) OVER stream_events AS previous_event_last_message_id,
+        lead(id) OVER stream_events IS NULL AS is_last_event
+    FROM zerver_realmauditlog
+    WHERE modified_user_id = %(user_profile_id)s
+        AND event_type IN (
+            {subscription_created}, {subscription_activated}, {subscription_deactivated}
+        )
+    WINDOW stream_events AS (
+        PARTITION BY modified_stream_id ORDER BY event_last_message_id, id
+    )
+), subscribed_intervals AS (
+    SELECT
+        stream_id,
+        previous_event_last_message_id AS after_message_id,
+        event_last_message_id AS through_message_id
+    FROM subscription_events
+    WHERE event_type = {subscription_deactivated}
+    UNION ALL
+    SELECT stream_id, event_last_message_id, NULL
+    FROM subscription_events
+    WHERE is_last_event AND event_type != {subscription_deactivated}
+)
+INSERT INTO zerver_usermessage (user_profile_id, message_id, flags)
+SELECT %(user_profile_id)s, zerver_message.id, 0
+FROM subscribed_intervals
+JOIN zerver_stream ON zerver_stream.id = subscribed_intervals.stream_id
+-- Uses index: zerver_message_realm_recipient_id
+JOIN zerver_message ON
+    zerver_message.realm_id = %(realm_id)s
+    AND zerver_message.recipient_id = zerver_stream.recipient_id
+    AND zerver_message.id > %(last_active_message_id)s
+    AND (
+        subscribed_intervals.after_message_id IS NULL
+        OR zerver_message.id > subscribed_intervals.after_message_id
+    )
+    AND (
+        subscribed_intervals.through_message_id IS NULL
+        OR zerver_message.id <= subscribed_intervals.through_message_id
+    )
+WHERE NOT EXISTS (
+    SELECT 1 FROM zerver_usermessage
+    WHERE zerver_usermessage.user_profile_id = %(user_profile_id)s
+        AND zerver_usermessage.message_id = zerver_message.id
+)
+ORDER BY zerver_message.id
+LIMIT %(batch_size)s
+ON CONFLICT (user_profile_id, message_id) DO NOTHING
+RETURNING message_id
+"""
+).format(
+    subscription_created=Literal(RealmAuditLog.SUBSCRIPTION_CREATED),
+    subscription_activated=Literal(RealmAuditLog.SUBSCRIPTION_ACTIVATED),
+    subscription_deactivated=Literal(RealmAuditLog.SUBSCRIPTION_DEACTIVATED),
+)
+
+
+def add_missing_messages(user_profile: UserProfile) -> None:
+    """This function takes a soft-deactivated user, and computes and adds
+    to the database any UserMessage rows that were not created while
+    the user was soft-deactivated.  The end result is that from the
+    perspective of the message database, it should be impossible to
+    tell that the user was soft-deactivated at all.
+
+    The target UserMessage rows are those for messages sent, since
+    the user was soft-deactivated, to streams that the user was
+    subscribed to at the time, according to the RealmAuditLog
+    subscription history, excluding messages that already have a
+    UserMessage row because the user had a nonzero set of flags (the
+    fact that we do so in do_send_messages simplifies things
+    considerably, since it means we don't need to inspect message
+    content to look for things like mentions here).
+
+    We compute and insert these in batches of BULK_CREATE_BATCH_SIZE,
+    with a single SQL statement each (see ADD_MISSING_MESSAGES_SQL),
+    advancing last_active_message_id after each batch, so that a
+    user who was idle for a long time on busy streams can be caught
+    up incrementally, and without transferring the message IDs to
+    Python and back.
+
+    For further documentation, see:
+
+      https://zulip.readthedocs.io/en/latest/subsystems/sending-messages.html#soft-deactivation
+
+    """
+    assert user_profile.last_active_message_id is not None
+    last_active_message_id = user_profile.last_active_message_id
+    added_messages = False
+
+    while True:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                ADD_MISSING_MESSAGES_SQL,
+                {
+                    "user_profile_id": user_profile.id,
+                    "realm_id": user_profile.realm_id,
+                    "last_active_message_id": last_active_message_id,
+                    "batch_size": BULK_CREATE_BATCH_SIZE,
+                },
+            )
+            message_ids = [message_id for (message_id,) in cursor.fetchall()]
+        if not message_ids:
+            break
+
+        added_messages = True
+        last_active_message_id = max(message_ids)
+        UserProfile.objects.filter(id=user_profile.id).update(
+            last_active_message_id=Greatest(F("last_active_message_id"), last_active_message_id)
+        )
+        if len(message_ids) < BULK_CREATE_BATCH_SIZE:
+            break
+
+    if added_messages:
+        # The new rows are unread, and may predate the user's cached
+        # first unread anchors.
+        transaction.on_commit(lambda: flush_first_unread_anchors([user_profile.id]))
+
+
+@cache_with_key(sparse_stream_recipient_ids_cache_key, timeout=3600 * 24 * 7)
+def get_sparse_stream_recipient_ids(realm_id: int) -> List[int]:
+    return [
+        assert_is_not_none(recipient_id)
+        for recipient_id in Stream.objects.filter(
+            realm_id=realm_id, has_deferred_user_messages=True
+        ).values_list("recipient_id", flat=True)
+    ]
+
+
+def add_missing_sparse_stream_messages(
+    user_profile: UserProfile, recipient_ids: Optional[List[int]] = None
+) -> None:
+    """Creates the UserMessage rows which do_send_messages deferred for
+    this user, because the messages were sent to streams with
+    sparse_user_messages.  Those rows all have the default flags, so
+    once they exist, unread message counts, narrows, and flag updates
+    don't need to handle sparse streams specially; we call this before
+    any of those query the user's UserMessage rows.
+
+    This uses the same approach as add_missing_messages, but only
+    considers messages sent since the last_materialized_message_id of
+    each of the user's subscriptions to those streams, so it is cheap
+    to call on every request.  By default, it processes every stream
+    in the user's realm with has_deferred_user_messages; for most
+    realms, there are none, and this only reads the cache.
+    """
+    if recipient_ids is None:
+        recipient_ids = get_sparse_stream_recipient_ids(user_profile.realm_id)
+    if not recipient_ids:
+        return
+
+    # This includes inactive subscriptions, since the user may not
+    # have caught up on messages sent before they unsubscribed.
+    all_stream_subs = list(
+        Subscription.objects.filter(
+            user_profile=user_profile, recipient_id__in=recipient_ids
+        ).values("id", "recipient_id", "recipient__type_id", "last_materialized_message_id")
+    )
+    if not all_stream_subs:
+        return
+
+    stream_ids = [sub["recipient__type_id"] for sub in all_stream_subs]
+    all_stream_subscription_logs = get_subscription_logs(user_profile, stream_ids)
 
-    recipient_ids = []
+    messages_filter = []
     for sub in all_stream_subs:
         stream_subscription_logs = all_stream_subscription_logs[sub["recipient__type_id"]]
-        if stream_subscription_logs[-1].event_type == RealmAuditLog.SUBSCRIPTION_DEACTIVATED:
-            assert stream_subscription_logs[-1].event_last_message_id is not None
-            if (
-                stream_subscription_logs[-1].event_last_message_id
-                <= user_profile.last_active_message_id
-            ):
-                # We are going to short circuit this iteration as its no use
-                # iterating since user unsubscribed before soft-deactivation
-                continue
-        recipient_ids.append(sub["recipient_id"])
+        if not stream_subscription_logs:  # nocoverage
+            # filter_by_subscription_history can't place any messages
+            # without the subscription's history.
+            continue
+        last_materialized_message_id = sub["last_materialized_message_id"]
+        if last_materialized_message_id is None:
+            # The stream was already sparse when the user first
+            # subscribed, so only later messages can be missing.
+            last_materialized_message_id = assert_is_not_none(
+                stream_subscription_logs[0].event_last_message_id
+            )
+        messages_filter.append(
+            Q(recipient_id=sub["recipient_id"], id__gt=last_materialized_message_id)
+        )
+    if not messages_filter:  # nocoverage
+        return
 
     new_stream_msgs = (
         Message.objects.annotate(
@@ -212,39 +371,75 @@ def add_missing_messages(user_profile: UserProfile) -> None:
             )
         )
         .filter(
+            reduce(lambda a, b: a | b, messages_filter),
             # Uses index: zerver_message_realm_recipient_id
-            has_user_message=0,
             realm_id=user_profile.realm_id,
-            recipient_id__in=recipient_ids,
-            id__gt=user_profile.last_active_message_id,
         )
         .order_by("id")
-        .values("id", "recipient__type_id")
+        .values("id", "recipient_id", "recipient__type_id", "date_sent", "has_user_message")
     )
 
+    materialized_cutoff = timezone_now() - SPARSE_STREAM_MATERIALIZATION_MARGIN
     stream_messages: DefaultDict[int, List[MissingMessageDict]] = defaultdict(list)
+    last_message_ids: Dict[int, int] = {}
     for msg in new_stream_msgs:
-        stream_messages[msg["recipient__type_id"]].append(
-            MissingMessageDict(id=msg["id"], recipient__type_id=msg["recipient__type_id"])
-        )
+        if msg["date_sent"] <= materialized_cutoff:
+            last_message_ids[msg["recipient_id"]] = msg["id"]
+        if not msg["has_user_message"]:
+            stream_messages[msg["recipient__type_id"]].append(
+                MissingMessageDict(id=msg["id"], recipient__type_id=msg["recipient__type_id"])
+            )
 
-    # Calling this function to filter out stream messages based upon
-    # subscription logs and then store all UserMessage objects for bulk insert
-    # This function does not perform any SQL related task and gets all the data
-    # required for its operation in its params.
     message_ids_to_insert = filter_by_subscription_history(
         user_profile, stream_messages, all_stream_subscription_logs
     )
 
-    # Doing a bulk create for all the UserMessage objects stored for creation.
-    while len(message_ids_to_insert) > 0:
-        message_ids, message_ids_to_insert = (
-            message_ids_to_insert[0:BULK_CREATE_BATCH_SIZE],
-            message_ids_to_insert[BULK_CREATE_BATCH_SIZE:],
-        )
-        bulk_insert_all_ums(user_ids=[user_profile.id], message_ids=message_ids, flags=0)
-        UserProfile.objects.filter(id=user_profile.id).update(
-            last_active_message_id=Greatest(F("last_active_message_id"), message_ids[-1])
+    with transaction.atomic(savepoint=False):
+        if message_ids_to_insert:
+            bulk_insert_all_ums(
+                user_ids=[user_profile.id], message_ids=message_ids_to_insert, flags=0
+            )
+            transaction.on_commit(lambda: flush_first_unread_anchors([user_profile.id]))
+
+        for sub in all_stream_subs:
+            if sub["recipient_id"] not in last_message_ids:
+                continue
+            Subscription.objects.filter(id=sub["id"]).update(
+                last_materialized_message_id=Greatest(
+                    F("last_materialized_message_id"), last_message_ids[sub["recipient_id"]]
+                )
+            )
+
+
+def add_missing_sparse_stream_messages_for_stream(stream: Stream) -> None:
+    """Creates the UserMessage rows deferred in a stream for everyone who
+    was ever subscribed to it."""
+    assert stream.recipient_id is not None
+    for user_profile in UserProfile.objects.filter(
+        subscription__recipient_id=stream.recipient_id
+    ).order_by("id"):
+        add_missing_sparse_stream_messages(user_profile, [stream.recipient_id])
+
+
+def do_materialize_sparse_stream_messages(stream: Stream) -> None:
+    """Creates the UserMessage rows still deferred for everyone who was
+    ever subscribed to a stream whose sparse_user_messages mode was
+    turned off, since nothing else would create them for users who
+    never return.  Until this finishes, add_missing_sparse_stream_messages
+    keeps creating them on demand, as while the mode was on."""
+    assert stream.recipient_id is not None
+    add_missing_sparse_stream_messages_for_stream(stream)
+
+    with transaction.atomic():
+        stream = Stream.objects.select_for_update().get(id=stream.id)
+        if stream.sparse_user_messages:
+            # The mode was turned back on in the meantime, and the
+            # subscriptions' bookkeeping is still needed.
+            return
+        stream.has_deferred_user_messages = False
+        stream.save(update_fields=["has_deferred_user_messages"])
+        Subscription.objects.filter(recipient_id=stream.recipient_id).update(
+            last_materialized_message_id=None
         )
 
 
@@ -364,7 +559,19 @@ def do_soft_activate_users(users: List[UserProfile]) -> List[UserProfile]:
     ]
 
 
-def do_catch_up_soft_deactivated_users(users: Iterable[UserProfile]) -> List[UserProfile]:
+def do_catch_up_soft_deactivated_users(
+    users: Iterable[UserProfile], *, in_background: bool = False
+) -> List[UserProfile]:
+    if in_background:
+        # Pre-warm users whom we expect to return soon, without
+        # blocking the caller; the deferred_work queue processor will
+        # catch each of them up.
+        users_queued = [user_profile for user_profile in users if user_profile.long_term_idle]
+        for user_profile in users_queued:
+            queue_soft_catch_up(user_profile.id)
+        logger.info("Queued catching up %d soft-deactivated users", len(users_queued))
+        return users_queued
+
     users_caught_up = []
     failures = []
     for user_profile in users:
@@ -399,6 +606,14 @@ def queue_soft_reactivation(user_profile_id: int) -> None:
     queue_json_publish("deferred_work", event)
 
 
+def queue_soft_catch_up(user_profile_id: int) -> None:
+    event = {
+        "type": "soft_catch_up",
+        "user_profile_id": user_profile_id,
+    }
+    queue_json_publish("deferred_work", event)
+
+
 def soft_reactivate_if_personal_notification(
     user_profile: UserProfile,
     unique_triggers: Set[str],
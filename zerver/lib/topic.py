@@ -9,7 +9,7 @@ from django.db.models.functions import Cast
 from zerver.lib.request import REQ
 from zerver.lib.types import EditHistoryEvent
 from zerver.lib.utils import assert_is_not_none
-from zerver.models import Message, Reaction, Stream, UserMessage, UserProfile
+from zerver.models import Message, Reaction, Stream, StreamTopic, UserMessage, UserProfile
 
 # Only use these constants for events.
 ORIG_TOPIC = "orig_subject"
@@ -235,43 +235,69 @@ def generate_topic_history_from_db_rows(rows: List[Tuple[str, int]]) -> List[Dic
     return sorted(history, key=lambda x: -x["max_id"])
 
 
-def get_topic_history_for_public_stream(realm_id: int, recipient_id: int) -> List[Dict[str, Any]]:
-    cursor = connection.cursor()
-    # Uses index: zerver_message_realm_recipient_subject
-    # Note that this is *case-sensitive*, so that we can display the
-    # most recently-used case (in generate_topic_history_from_db_rows)
-    query = """
-    SELECT
-        "zerver_message"."subject" as topic,
-        max("zerver_message".id) as max_message_id
-    FROM "zerver_message"
-    WHERE (
-        "zerver_message"."realm_id" = %s AND
-        "zerver_message"."recipient_id" = %s
-    )
-    GROUP BY (
-        "zerver_message"."subject"
-    )
-    ORDER BY max("zerver_message".id) DESC
-    """
-    cursor.execute(query, [realm_id, recipient_id])
-    rows = cursor.fetchall()
-    cursor.close()
-
-    return generate_topic_history_from_db_rows(rows)
+def filter_topic_history(
+    history: List[Dict[str, Any]],
+    query: Optional[str] = None,
+    before_max_id: Optional[int] = None,
+    limit: Optional[int] = None,
+) -> List[Dict[str, Any]]:
+    if query is not None:
+        query = query.lower()
+        history = [topic for topic in history if query in topic["name"].lower()]
+    if before_max_id is not None:
+        history = [topic for topic in history if topic["max_id"] < before_max_id]
+    if limit is not None:
+        history = history[:limit]
+    return history
+
+
+def get_topic_history_for_public_stream(
+    realm_id: int,
+    recipient_id: int,
+    query: Optional[str] = None,
+    before_max_id: Optional[int] = None,
+    limit: Optional[int] = None,
+) -> List[Dict[str, Any]]:
+    # Every message in a stream with public history is visible, so we
+    # can use the topic summaries maintained by database triggers,
+    # rather than grouping the stream's messages by topic.
+    #
+    # Uses index: zerver_streamtopic_recipient_max_message_id; a
+    # search query is a filter on that index scan, which can stop
+    # once it finds `limit` matching topics.
+    topics = StreamTopic.objects.filter(realm_id=realm_id, recipient_id=recipient_id)
+    if query is not None:
+        topics = topics.filter(topic_name__icontains=query)
+    if before_max_id is not None:
+        topics = topics.filter(max_message_id__lt=before_max_id)
+    topics = topics.order_by("-max_message_id")
+    if limit is not None:
+        topics = topics[:limit]
+
+    return [
+        dict(name=topic_name, max_id=max_message_id)
+        for topic_name, max_message_id in topics.values_list("topic_name", "max_message_id")
+    ]
 
 
 def get_topic_history_for_stream(
-    user_profile: UserProfile, recipient_id: int, public_history: bool
+    user_profile: UserProfile,
+    recipient_id: int,
+    public_history: bool,
+    query: Optional[str] = None,
+    before_max_id: Optional[int] = None,
+    limit: Optional[int] = None,
 ) -> List[Dict[str, Any]]:
     if public_history:
-        return get_topic_history_for_public_stream(user_profile.realm_id, recipient_id)
+        return get_topic_history_for_public_stream(
+            user_profile.realm_id, recipient_id, query, before_max_id, limit
+        )
 
     cursor = connection.cursor()
     # Uses index: zerver_message_realm_recipient_subject
     # Note that this is *case-sensitive*, so that we can display the
     # most recently-used case (in generate_topic_history_from_db_rows)
-    query = """
+    query_sql = """
     SELECT
         "zerver_message"."subject" as topic,
         max("zerver_message".id) as max_message_id
@@ -289,11 +315,16 @@ def get_topic_history_for_stream(
     )
     ORDER BY max("zerver_message".id) DESC
     """
-    cursor.execute(query, [user_profile.id, user_profile.realm_id, recipient_id])
+    cursor.execute(query_sql, [user_profile.id, user_profile.realm_id, recipient_id])
     rows = cursor.fetchall()
     cursor.close()
 
-    return generate_topic_history_from_db_rows(rows)
+    # The topics a user can see in a stream with protected history
+    # depend on their UserMessage rows, so these are not covered by
+    # the topic summaries, and we filter them here.
+    return filter_topic_history(
+        generate_topic_history_from_db_rows(rows), query, before_max_id, limit
+    )
 
 
 def get_topic_resolution_and_bare_name(stored_name: str) -> Tuple[bool, str]:
@@ -1,6 +1,8 @@
+import struct
+from io import BytesIO
 from typing import List, Optional
 
-from django.db import connection
+from django.db import connection, transaction
 from psycopg2.extras import execute_values
 from psycopg2.sql import SQL, Composable, Literal
 
@@ -51,6 +53,13 @@ def create_historical_user_messages(
     bulk_insert_all_ums([user_id], message_ids, flags, conflict)
 
 
+# Above this many rows, bulk_insert_ums streams the rows to the
+# database using COPY, rather than as a single huge INSERT statement
+# that PostgreSQL must parse; see the user_message_insert_rate
+# management command for benchmarks.
+BULK_INSERT_UMS_COPY_THRESHOLD = 10000
+
+
 def bulk_insert_ums(ums: List[UserMessageLite]) -> None:
     """
     Doing bulk inserts this way is much faster than using Django,
@@ -61,6 +70,13 @@ def bulk_insert_ums(ums: List[UserMessageLite]) -> None:
     if not ums:
         return
 
+    if len(ums) >= BULK_INSERT_UMS_COPY_THRESHOLD:
+        copy_insert_ums(ums)
+    else:
+        values_insert_ums(ums)
+
+
+def values_insert_ums(ums: List[UserMessageLite]) -> None:
     vals = [(um.user_profile_id, um.message_id, um.flags) for um in ums]
     query = SQL(
         """
@@ -75,6 +91,56 @@ def bulk_insert_ums(ums: List[UserMessageLite]) -> None:
         execute_values(cursor.cursor, query, vals)
 
 
+# PostgreSQL's binary COPY format: a fixed header, then for each row
+# its number of fields, followed by each field's length and value in
+# network byte order, and then a trailer.  The field types must match
+# the columns of the table being copied into exactly.
+PGCOPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+PGCOPY_TRAILER = struct.pack("!h", -1)
+USER_MESSAGE_COPY_ROW = struct.Struct("!hiiiiiq")
+
+
+def copy_insert_ums(ums: List[UserMessageLite]) -> None:
+    """Inserts the rows by COPYing them into a temporary table, since
+    COPY has no equivalent of ON CONFLICT DO NOTHING, and then moving
+    them from there into zerver_usermessage.  The temporary table is
+    emptied at the end of every transaction, and by the move itself,
+    and lasts for the rest of the database session, so that we don't
+    need to create it for every message we send."""
+    data = BytesIO()
+    data.write(PGCOPY_HEADER)
+    pack_row = USER_MESSAGE_COPY_ROW.pack
+    for um in ums:
+        data.write(pack_row(3, 4, um.user_profile_id, 4, um.message_id, 8, int(um.flags)))
+    data.write(PGCOPY_TRAILER)
+    data.seek(0)
+
+    with transaction.atomic(savepoint=False), connection.cursor() as cursor:
+        cursor.execute(
+            """
+            CREATE TEMPORARY TABLE IF NOT EXISTS usermessage_copy (
+                user_profile_id integer NOT NULL,
+                message_id integer NOT NULL,
+                flags bigint NOT NULL
+            ) ON COMMIT DELETE ROWS
+            """
+        )
+        cursor.cursor.copy_expert(
+            "COPY usermessage_copy (user_profile_id, message_id, flags) FROM STDIN (FORMAT binary)",
+            data,
+        )
+        cursor.execute(
+            """
+            WITH copied AS (
+                DELETE FROM usermessage_copy RETURNING user_profile_id, message_id, flags
+            )
+            INSERT INTO zerver_usermessage (user_profile_id, message_id, flags)
+            SELECT user_profile_id, message_id, flags FROM copied
+            ON CONFLICT DO NOTHING
+            """
+        )
+
+
 def bulk_insert_all_ums(
     user_ids: List[int], message_ids: List[int], flags: int, conflict: Optional[Composable] = None
 ) -> None:
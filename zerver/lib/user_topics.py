@@ -9,6 +9,7 @@ from django.utils.timezone import now as timezone_now
 from sqlalchemy.sql import ClauseElement, and_, column, not_, or_
 from sqlalchemy.types import Integer
 
+from zerver.lib.cache import flush_first_unread_anchors
 from zerver.lib.timestamp import datetime_to_timestamp
 from zerver.lib.topic_sqlalchemy import topic_match_sa
 from zerver.lib.types import UserTopicDict
@@ -92,6 +93,7 @@ def set_topic_visibility_policy(
         user_profile=user_profile,
         visibility_policy=visibility_policy,
     ).delete()
+    flush_first_unread_anchors_on_commit([user_profile])
 
     if last_updated is None:
         last_updated = timezone_now()
@@ -156,6 +158,7 @@ def bulk_set_user_topic_visibility_policy_in_database(
                 user_profile.id,
             )
         rows.delete()
+        flush_first_unread_anchors_on_commit(user_profiles_with_visibility_policy)
         return user_profiles_with_visibility_policy
 
     assert last_updated is not None
@@ -191,7 +194,19 @@ def bulk_set_user_topic_visibility_policy_in_database(
             )
             for user_profile in user_profiles_without_visibility_policy
         )
-    return user_profiles_seeking_visibility_policy_update + user_profiles_without_visibility_policy
+    changed_user_profiles = (
+        user_profiles_seeking_visibility_policy_update + user_profiles_without_visibility_policy
+    )
+    flush_first_unread_anchors_on_commit(changed_user_profiles)
+    return changed_user_profiles
+
+
+def flush_first_unread_anchors_on_commit(user_profiles: List[UserProfile]) -> None:
+    # Muting or unmuting a topic changes which messages are candidates
+    # for the first unread message in a narrow; see exclude_topic_mutes.
+    user_profile_ids = [user_profile.id for user_profile in user_profiles]
+    if user_profile_ids:
+        transaction.on_commit(lambda: flush_first_unread_anchors(user_profile_ids))
 
 
 def topic_has_visibility_policy(
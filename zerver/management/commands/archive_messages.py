@@ -1,6 +1,6 @@
 from typing import Any
 
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandParser
 from typing_extensions import override
 
 from zerver.lib.management import abort_unless_locked
@@ -8,8 +8,17 @@ from zerver.lib.retention import archive_messages, clean_archived_data
 
 
 class Command(BaseCommand):
+    @override
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument(
+            "--processes",
+            default=1,
+            type=int,
+            help="Number of processes to use for archiving streams in parallel",
+        )
+
     @override
     @abort_unless_locked
-    def handle(self, *args: Any, **options: str) -> None:
+    def handle(self, *args: Any, **options: Any) -> None:
         clean_archived_data()
-        archive_messages()
+        archive_messages(processes=options["processes"])
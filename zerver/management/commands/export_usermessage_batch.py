@@ -1,13 +1,14 @@
 import glob
 import logging
 import os
+import time
 from argparse import ArgumentParser
 from typing import Any
 
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from typing_extensions import override
 
-from zerver.lib.export import export_usermessages_batch
+from zerver.lib.export import MESSAGE_PARTIALS_DONE_FILENAME, export_usermessages_batch
 
 
 class Command(BaseCommand):
@@ -22,10 +23,34 @@ class Command(BaseCommand):
             type=int,
             help="ID of the message advertising users to react with thumbs up",
         )
+        parser.add_argument(
+            "--wait-for-partials",
+            action="store_true",
+            help="Keep waiting for new message partials until the export has written all of them",
+        )
 
     @override
     def handle(self, *args: Any, **options: Any) -> None:
         logging.info("Starting UserMessage batch thread %s", options["thread"])
+        if not options["wait_for_partials"]:
+            self.process_partials(options)
+            return
+
+        parent_pid = os.getppid()
+        done_path = os.path.join(options["path"], MESSAGE_PARTIALS_DONE_FILENAME)
+        while True:
+            # Check this before looking for partials, since the
+            # export writes it after the last partial.
+            all_partials_written = os.path.exists(done_path)
+            if self.process_partials(options) == 0:
+                if all_partials_written:
+                    return
+                if os.getppid() != parent_pid:
+                    raise CommandError("The export process exited.")
+                time.sleep(0.1)
+
+    def process_partials(self, options: Any) -> int:
+        processed = 0
         files = set(glob.glob(os.path.join(options["path"], "messages-*.json.partial")))
         for partial_path in files:
             locked_path = partial_path.replace(".json.partial", ".json.locked")
@@ -42,3 +67,5 @@ class Command(BaseCommand):
                 # Put the item back in the free pool when we fail
                 os.rename(locked_path, partial_path)
                 raise
+            processed += 1
+        return processed
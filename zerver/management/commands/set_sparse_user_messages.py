@@ -0,0 +1,44 @@
+from typing import Any
+
+from django.core.management.base import CommandError, CommandParser
+from typing_extensions import override
+
+from zerver.actions.streams import do_change_stream_sparse_user_messages
+from zerver.lib.management import ZulipBaseCommand
+from zerver.models.streams import get_stream
+
+
+class Command(ZulipBaseCommand):
+    help = """Turn sparse UserMessage rows on or off for a stream.
+
+Messages sent to such a stream don't immediately get the UserMessage
+rows for subscribers which would have the default flags; instead, each
+subscriber's rows are created the next time they load the app, fetch
+messages, or change message flags.  This makes sending messages to
+streams with very large audiences, like announcement streams, much
+faster.
+
+Only streams whose history is public to subscribers are supported.
+Turning this off creates all of the deferred rows in the background,
+using the deferred_work queue."""
+
+    @override
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument("-s", "--stream", required=True, help="A stream name.")
+        parser.add_argument(
+            "--off", action="store_true", help="Turn sparse UserMessage rows off instead."
+        )
+        self.add_realm_args(parser, required=True)
+
+    @override
+    def handle(self, *args: Any, **options: Any) -> None:
+        realm = self.get_realm(options)
+        assert realm is not None  # Should be ensured by parser
+        stream = get_stream(options["stream"].strip(), realm)
+
+        sparse_user_messages = not options["off"]
+        if sparse_user_messages and not stream.is_history_public_to_subscribers():
+            raise CommandError(
+                "Sparse UserMessage rows require the stream's history to be public to subscribers."
+            )
+        do_change_stream_sparse_user_messages(stream, sparse_user_messages, acting_user=None)
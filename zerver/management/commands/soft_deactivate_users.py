@@ -1,6 +1,6 @@
 import sys
 from argparse import ArgumentParser
-from typing import Any, Dict, List
+from typing import Any, Dict, Iterable, List
 
 from django.conf import settings
 from django.core.management.base import CommandError
@@ -9,8 +9,10 @@ from typing_extensions import override
 from zerver.lib.management import ZulipBaseCommand, abort_unless_locked
 from zerver.lib.soft_deactivation import (
     do_auto_soft_deactivate_users,
+    do_catch_up_soft_deactivated_users,
     do_soft_activate_users,
     do_soft_deactivate_users,
+    get_soft_deactivated_users_for_catch_up,
     logger,
 )
 from zerver.models import Realm, UserProfile
@@ -43,6 +45,13 @@ class Command(ZulipBaseCommand):
         parser.add_argument(
             "-a", "--activate", action="store_true", help="Used to activate user/users."
         )
+        parser.add_argument(
+            "-c",
+            "--catch-up",
+            action="store_true",
+            help="Used to catch up soft-deactivated user/users in the background, without "
+            "activating them, so that they load quickly when they return.",
+        )
         parser.add_argument(
             "--inactive-for",
             type=int,
@@ -53,7 +62,7 @@ class Command(ZulipBaseCommand):
             "users",
             metavar="<users>",
             nargs="*",
-            help="A list of user emails to soft activate/deactivate.",
+            help="A list of user emails to soft activate/deactivate/catch up.",
         )
 
     @override
@@ -67,6 +76,7 @@ class Command(ZulipBaseCommand):
         user_emails = options["users"]
         activate = options["activate"]
         deactivate = options["deactivate"]
+        catch_up = options["catch_up"]
 
         filter_kwargs: Dict[str, Realm] = {}
         if realm is not None:
@@ -93,6 +103,15 @@ class Command(ZulipBaseCommand):
                 )
             logger.info("Soft deactivated %d user(s)", len(users_deactivated))
 
+        elif catch_up:
+            if user_emails:
+                users_to_catch_up: Iterable[UserProfile] = get_users_from_emails(
+                    user_emails, filter_kwargs
+                )
+            else:
+                users_to_catch_up = get_soft_deactivated_users_for_catch_up(filter_kwargs)
+            do_catch_up_soft_deactivated_users(users_to_catch_up, in_background=True)
+
         else:
             self.print_help("./manage.py", "soft_deactivate_users")
             raise CommandError
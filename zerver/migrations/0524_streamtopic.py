@@ -0,0 +1,451 @@
+import django.db.models.deletion
+import django.db.models.functions.text
+from django.db import connection, migrations, models, transaction
+from django.db.backends.base.schema import BaseDatabaseSchemaEditor
+from django.db.migrations.state import StateApps
+
+# The SQL to summarize a set of messages, given as a table-like
+# expression, by topic.  We only track messages to streams
+# (Recipient.STREAM = 2), and use the case of each topic's most recent
+# message as its name.
+SUMMARIZE_MESSAGES_SQL = """(
+    SELECT
+        m.realm_id,
+        m.recipient_id,
+        (array_agg(m.subject ORDER BY m.id DESC))[1] AS topic_name,
+        max(m.id) AS max_message_id,
+        count(*) AS message_count
+    FROM {messages} AS m
+    JOIN zerver_recipient ON zerver_recipient.id = m.recipient_id
+    WHERE zerver_recipient.type = 2
+    GROUP BY m.realm_id, m.recipient_id, upper(m.subject)
+)"""
+
+# The SQL to add a set of topic summaries, in the form produced by
+# SUMMARIZE_MESSAGES_SQL, to the existing ones.
+#
+# The upsert locks the summary rows in the order it inserts them, so
+# we sort by the unique key; concurrent transactions then always lock
+# a given pair of topics in the same order, and cannot deadlock.
+ADD_SUMMARIES_SQL = """
+INSERT INTO zerver_streamtopic AS t
+    (realm_id, recipient_id, topic_name, is_resolved, max_message_id, message_count)
+SELECT
+    realm_id,
+    recipient_id,
+    topic_name,
+    topic_name LIKE '✔ %',
+    max_message_id,
+    message_count
+FROM (
+    SELECT
+        s.realm_id,
+        s.recipient_id,
+        (array_agg(s.topic_name ORDER BY s.max_message_id DESC))[1] AS topic_name,
+        max(s.max_message_id) AS max_message_id,
+        sum(s.message_count) AS message_count
+    FROM {summaries} AS s
+    GROUP BY s.realm_id, s.recipient_id, upper(s.topic_name)
+) AS added
+ORDER BY recipient_id, upper(topic_name)
+ON CONFLICT (recipient_id, upper(topic_name)) DO UPDATE SET
+    topic_name = CASE
+        WHEN excluded.max_message_id > t.max_message_id THEN excluded.topic_name
+        ELSE t.topic_name
+    END,
+    is_resolved = CASE
+        WHEN excluded.max_message_id > t.max_message_id THEN excluded.is_resolved
+        ELSE t.is_resolved
+    END,
+    max_message_id = greatest(t.max_message_id, excluded.max_message_id),
+    message_count = t.message_count + excluded.message_count;
+"""
+
+# Sending messages only records the summaries of the new messages in
+# zerver_streamtopicchange, which has no unique constraints for
+# concurrent sends to wait on.  They are added to zerver_streamtopic
+# by a deferred trigger when the transaction commits, so that the
+# summary of a busy topic is only locked while committing, rather than
+# while the rest of do_send_messages runs.  The table is always empty
+# outside of transactions in progress, so it need not be logged.
+CREATE_CHANGES_TABLE_SQL = """
+CREATE UNLOGGED TABLE zerver_streamtopicchange (
+    transaction_id bigint NOT NULL,
+    realm_id integer NOT NULL,
+    recipient_id integer NOT NULL,
+    topic_name varchar(60) NOT NULL,
+    max_message_id integer NOT NULL,
+    message_count integer NOT NULL
+);
+CREATE INDEX zerver_streamtopicchange_transaction_id
+    ON zerver_streamtopicchange (transaction_id);
+"""
+
+# Adds the current transaction's recorded changes to the summaries.
+APPLY_CHANGES_SQL = (
+    """
+WITH changes AS (
+    DELETE FROM zerver_streamtopicchange
+    WHERE transaction_id = txid_current()
+    RETURNING realm_id, recipient_id, topic_name, max_message_id, message_count
+)"""
+    + ADD_SUMMARIES_SQL.format(summaries="changes")
+)
+
+# The DELETE and UPDATE statements below lock the summary rows in
+# whatever order their joins produce, so the triggers which remove
+# messages first lock every summary they touch, in the same order as
+# ADD_SUMMARIES_SQL.
+LOCK_TOPICS_SQL = """
+PERFORM 1 FROM zerver_streamtopic AS t
+WHERE (t.recipient_id, upper(t.topic_name)) IN (
+    SELECT m.recipient_id, upper(m.subject) FROM {messages} AS m
+)
+ORDER BY t.recipient_id, upper(t.topic_name)
+FOR UPDATE;
+"""
+
+# The SQL to remove a set of messages from the topic summaries.
+# Topics left with no messages are deleted; topics whose most recent
+# message was removed look up their new most recent message, using
+# the zerver_message_realm_recipient_upper_subject index, and are
+# deleted if there is none, in case message_count was wrong.
+REMOVE_MESSAGES_SQL = """
+DELETE FROM zerver_streamtopic AS t
+USING (
+    SELECT m.recipient_id, upper(m.subject) AS upper_topic_name, count(*) AS message_count
+    FROM {messages} AS m
+    GROUP BY m.recipient_id, upper(m.subject)
+) AS removed
+WHERE t.recipient_id = removed.recipient_id
+    AND upper(t.topic_name) = removed.upper_topic_name
+    AND t.message_count <= removed.message_count;
+
+UPDATE zerver_streamtopic AS t SET
+    message_count = t.message_count - removed.message_count
+FROM (
+    SELECT m.recipient_id, upper(m.subject) AS upper_topic_name, count(*) AS message_count
+    FROM {messages} AS m
+    GROUP BY m.recipient_id, upper(m.subject)
+) AS removed
+WHERE t.recipient_id = removed.recipient_id
+    AND upper(t.topic_name) = removed.upper_topic_name;
+
+WITH latest AS (
+    SELECT t.id, latest_message.id AS message_id, latest_message.subject
+    FROM zerver_streamtopic AS t
+    LEFT JOIN LATERAL (
+        SELECT zerver_message.id, zerver_message.subject
+        FROM zerver_message
+        WHERE zerver_message.realm_id = t.realm_id
+            AND zerver_message.recipient_id = t.recipient_id
+            AND upper(zerver_message.subject) = upper(t.topic_name)
+        ORDER BY zerver_message.id DESC
+        LIMIT 1
+    ) AS latest_message ON true
+    WHERE (t.recipient_id, t.max_message_id) IN (
+        SELECT m.recipient_id, m.id FROM {messages} AS m
+    )
+), emptied AS (
+    DELETE FROM zerver_streamtopic AS t
+    USING latest
+    WHERE t.id = latest.id AND latest.message_id IS NULL
+)
+UPDATE zerver_streamtopic AS t SET
+    topic_name = latest.subject,
+    is_resolved = latest.subject LIKE '✔ %',
+    max_message_id = latest.message_id
+FROM latest
+WHERE t.id = latest.id AND latest.message_id IS NOT NULL;
+"""
+
+# An UPDATE only changes the topic summaries for messages whose
+# stream or topic changed (including changes to only the case of the
+# topic name).
+MOVED_FROM_SQL = """(
+    SELECT old_messages.* FROM old_messages
+    JOIN new_messages ON new_messages.id = old_messages.id
+    WHERE old_messages.recipient_id != new_messages.recipient_id
+        OR old_messages.subject != new_messages.subject
+)"""
+MOVED_TO_SQL = """(
+    SELECT new_messages.* FROM new_messages
+    JOIN old_messages ON old_messages.id = new_messages.id
+    WHERE old_messages.recipient_id != new_messages.recipient_id
+        OR old_messages.subject != new_messages.subject
+)"""
+MOVED_SQL = f"""(
+    SELECT * FROM {MOVED_FROM_SQL} AS moved_from
+    UNION ALL
+    SELECT * FROM {MOVED_TO_SQL} AS moved_to
+)"""
+
+# While the backfill runs, zerver_streamtopicbackfill has a row for
+# each stream whose summaries have not been backfilled yet, with the
+# largest message ID when the triggers were created; the backfill
+# counts the messages up to that ID, and the triggers count the rest.
+# The triggers leave moving or deleting those older messages in such
+# a stream to the backfill, and lock its row first, so that they wait
+# for the stream's backfill to commit, or it waits for them.
+LOCK_BACKFILL_SQL = """
+PERFORM 1 FROM zerver_streamtopicbackfill
+WHERE recipient_id IN (SELECT m.recipient_id FROM {messages} AS m)
+ORDER BY recipient_id
+FOR SHARE;
+"""
+NOT_BACKFILLED_SQL = """(
+    SELECT m.* FROM {messages} AS m
+    WHERE NOT EXISTS (
+        SELECT 1 FROM zerver_streamtopicbackfill AS b
+        WHERE b.recipient_id = m.recipient_id AND m.id <= b.max_message_id
+    )
+)"""
+
+
+def trigger_functions_sql(backfilling: bool) -> str:
+    def counted(messages: str) -> str:
+        if backfilling:
+            return NOT_BACKFILLED_SQL.format(messages=messages)
+        return messages
+
+    def lock_backfill(messages: str) -> str:
+        if backfilling:
+            return LOCK_BACKFILL_SQL.format(messages=messages)
+        return ""
+
+    add_moved_to_sql = ADD_SUMMARIES_SQL.format(
+        summaries=SUMMARIZE_MESSAGES_SQL.format(messages=counted(MOVED_TO_SQL))
+    )
+
+    # Moves and deletions first apply the transaction's own pending
+    # changes, in case it sent some of the messages involved.  Saving
+    # other fields of a message, like has_attachment when sending it,
+    # does not move it, and so leaves those changes deferred.
+    return f"""
+CREATE OR REPLACE FUNCTION zerver_streamtopic_insert_trigger_function()
+RETURNS trigger AS $$
+BEGIN
+    INSERT INTO zerver_streamtopicchange
+        (transaction_id, realm_id, recipient_id, topic_name, max_message_id, message_count)
+    SELECT txid_current(), s.*
+    FROM {SUMMARIZE_MESSAGES_SQL.format(messages="new_messages")} AS s;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION zerver_streamtopic_update_trigger_function()
+RETURNS trigger AS $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM {MOVED_SQL} AS moved) THEN
+        {lock_backfill(MOVED_SQL)}
+        {APPLY_CHANGES_SQL}
+        {LOCK_TOPICS_SQL.format(messages=counted(MOVED_SQL))}
+        {REMOVE_MESSAGES_SQL.format(messages=counted(MOVED_FROM_SQL))}
+        {add_moved_to_sql}
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION zerver_streamtopic_delete_trigger_function()
+RETURNS trigger AS $$
+BEGIN
+    {lock_backfill("old_messages")}
+    {APPLY_CHANGES_SQL}
+    {LOCK_TOPICS_SQL.format(messages=counted("old_messages"))}
+    {REMOVE_MESSAGES_SQL.format(messages=counted("old_messages"))}
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+"""
+
+
+CREATE_APPLY_CHANGES_TRIGGER_SQL = f"""
+CREATE FUNCTION zerver_streamtopic_apply_changes_trigger_function()
+RETURNS trigger AS $$
+BEGIN
+    {APPLY_CHANGES_SQL}
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE CONSTRAINT TRIGGER zerver_streamtopic_apply_changes_trigger
+AFTER INSERT ON zerver_streamtopicchange
+DEFERRABLE INITIALLY DEFERRED
+FOR EACH ROW
+EXECUTE PROCEDURE zerver_streamtopic_apply_changes_trigger_function();
+"""
+
+DROP_CHANGES_TABLE_SQL = """
+DROP TABLE zerver_streamtopicchange;
+DROP FUNCTION zerver_streamtopic_apply_changes_trigger_function();
+"""
+
+CREATE_TRIGGERS_SQL = """
+CREATE TRIGGER zerver_streamtopic_insert_trigger
+AFTER INSERT ON zerver_message
+REFERENCING NEW TABLE AS new_messages
+FOR EACH STATEMENT
+EXECUTE PROCEDURE zerver_streamtopic_insert_trigger_function();
+
+CREATE TRIGGER zerver_streamtopic_update_trigger
+AFTER UPDATE ON zerver_message
+REFERENCING OLD TABLE AS old_messages NEW TABLE AS new_messages
+FOR EACH STATEMENT
+EXECUTE PROCEDURE zerver_streamtopic_update_trigger_function();
+
+CREATE TRIGGER zerver_streamtopic_delete_trigger
+AFTER DELETE ON zerver_message
+REFERENCING OLD TABLE AS old_messages
+FOR EACH STATEMENT
+EXECUTE PROCEDURE zerver_streamtopic_delete_trigger_function();
+"""
+
+DROP_TRIGGERS_SQL = """
+DROP TRIGGER zerver_streamtopic_insert_trigger ON zerver_message;
+DROP TRIGGER zerver_streamtopic_update_trigger ON zerver_message;
+DROP TRIGGER zerver_streamtopic_delete_trigger ON zerver_message;
+DROP FUNCTION zerver_streamtopic_insert_trigger_function();
+DROP FUNCTION zerver_streamtopic_update_trigger_function();
+DROP FUNCTION zerver_streamtopic_delete_trigger_function();
+DROP TABLE IF EXISTS zerver_streamtopicbackfill;
+"""
+
+
+def create_triggers(apps: StateApps, schema_editor: BaseDatabaseSchemaEditor) -> None:
+    """Creating the triggers waits for transactions which have already
+    inserted messages to commit, and blocks new inserts until this
+    transaction commits; so every message up to the largest ID we read
+    here is visible to the backfill, and every later one is counted by
+    the triggers."""
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(
+            """
+            CREATE TABLE zerver_streamtopicbackfill (
+                recipient_id integer PRIMARY KEY,
+                max_message_id integer NOT NULL
+            )
+            """
+        )
+        # No parameters, as the SQL contains a literal %.
+        cursor.execute(trigger_functions_sql(backfilling=True))
+        cursor.execute(CREATE_TRIGGERS_SQL)
+        cursor.execute(
+            """
+            INSERT INTO zerver_streamtopicbackfill (recipient_id, max_message_id)
+            SELECT id, (SELECT coalesce(max(id), 0) FROM zerver_message)
+            FROM zerver_recipient
+            WHERE type = 2
+            """
+        )
+
+
+def drop_triggers(apps: StateApps, schema_editor: BaseDatabaseSchemaEditor) -> None:
+    with connection.cursor() as cursor:
+        cursor.execute(DROP_TRIGGERS_SQL)
+
+
+def backfill_stream_topics(apps: StateApps, schema_editor: BaseDatabaseSchemaEditor) -> None:
+    """Backfill the summaries for existing messages, one stream at a
+    time, without blocking writes to zerver_message.  Removing the
+    stream from zerver_streamtopicbackfill first waits for any moves or
+    deletions of its older messages that are in progress, and makes
+    later ones wait for us, so that each of those messages is counted
+    exactly once."""
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT recipient_id FROM zerver_streamtopicbackfill ORDER BY recipient_id")
+        recipient_ids = [recipient_id for (recipient_id,) in cursor.fetchall()]
+
+    for recipient_id in recipient_ids:
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(
+                """
+                DELETE FROM zerver_streamtopicbackfill
+                WHERE recipient_id = %s
+                RETURNING max_message_id
+                """,
+                [recipient_id],
+            )
+            (max_message_id,) = cursor.fetchone()
+            messages = f"""(
+                SELECT * FROM zerver_message
+                WHERE recipient_id = {int(recipient_id)} AND id <= {int(max_message_id)}
+            )"""
+            # No parameters, as the SQL contains a literal %.
+            cursor.execute(
+                ADD_SUMMARIES_SQL.format(
+                    summaries=SUMMARIZE_MESSAGES_SQL.format(messages=messages)
+                )
+            )
+
+
+class Migration(migrations.Migration):
+    # Each step commits on its own, so that the lock on zerver_message
+    # taken to create the triggers is not held during the backfill, and
+    # the backfill of each stream is a separate transaction.
+    atomic = False
+
+    dependencies = [
+        ("zerver", "0523_alter_multiuseinvite_subscribe_to_default_streams_and_more"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="StreamTopic",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True, primary_key=True, serialize=False, verbose_name="ID"
+                    ),
+                ),
+                ("topic_name", models.CharField(max_length=60)),
+                ("is_resolved", models.BooleanField(default=False)),
+                ("max_message_id", models.IntegerField()),
+                ("message_count", models.IntegerField()),
+                (
+                    "realm",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE, to="zerver.realm"
+                    ),
+                ),
+                (
+                    "recipient",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE, to="zerver.recipient"
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        models.F("recipient"),
+                        models.OrderBy(models.F("max_message_id"), descending=True),
+                        name="zerver_streamtopic_recipient_max_message_id",
+                    )
+                ],
+                "constraints": [
+                    models.UniqueConstraint(
+                        models.F("recipient"),
+                        django.db.models.functions.text.Upper("topic_name"),
+                        name="zerver_streamtopic_recipient_upper_topic_name",
+                    )
+                ],
+            },
+        ),
+        migrations.RunSQL(
+            CREATE_CHANGES_TABLE_SQL + CREATE_APPLY_CHANGES_TRIGGER_SQL,
+            reverse_sql=DROP_CHANGES_TABLE_SQL,
+        ),
+        migrations.RunPython(create_triggers, reverse_code=drop_triggers),
+        migrations.RunPython(
+            backfill_stream_topics, reverse_code=migrations.RunPython.noop, elidable=True
+        ),
+        # The triggers no longer need to check for streams whose
+        # summaries have not been backfilled.
+        migrations.RunSQL(
+            trigger_functions_sql(backfilling=False)
+            + "DROP TABLE zerver_streamtopicbackfill;",
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
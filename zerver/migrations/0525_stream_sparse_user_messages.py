@@ -0,0 +1,25 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("zerver", "0524_streamtopic"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="stream",
+            name="sparse_user_messages",
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name="stream",
+            name="has_deferred_user_messages",
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name="subscription",
+            name="last_materialized_message_id",
+            field=models.IntegerField(null=True),
+        ),
+    ]
@@ -0,0 +1,72 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+# Assign each inserted or changed UserPresence row the next update id
+# in its realm.  The upsert takes a row lock on the realm's
+# PresenceSequence row until the transaction commits, so update ids
+# within a realm become visible in increasing order, and a client that
+# has seen id N never misses a later change with a smaller id.
+CREATE_TRIGGER_SQL = """
+CREATE FUNCTION zerver_userpresence_last_update_id_trigger_function()
+RETURNS trigger AS $$
+BEGIN
+    INSERT INTO zerver_presencesequence AS s (realm_id, last_update_id)
+    VALUES (NEW.realm_id, 1)
+    ON CONFLICT (realm_id) DO UPDATE SET last_update_id = s.last_update_id + 1
+    RETURNING s.last_update_id INTO NEW.last_update_id;
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER zerver_userpresence_last_update_id_trigger
+BEFORE INSERT OR UPDATE OF last_active_time, last_connected_time ON zerver_userpresence
+FOR EACH ROW
+EXECUTE PROCEDURE zerver_userpresence_last_update_id_trigger_function();
+"""
+
+DROP_TRIGGER_SQL = """
+DROP TRIGGER zerver_userpresence_last_update_id_trigger ON zerver_userpresence;
+DROP FUNCTION zerver_userpresence_last_update_id_trigger_function();
+"""
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("zerver", "0525_stream_sparse_user_messages"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="PresenceSequence",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True, primary_key=True, serialize=False, verbose_name="ID"
+                    ),
+                ),
+                ("last_update_id", models.PositiveBigIntegerField()),
+                (
+                    "realm",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE, to="zerver.realm"
+                    ),
+                ),
+            ],
+        ),
+        # Existing rows keep update id 0; clients always start with a
+        # full fetch, which includes them.
+        migrations.AddField(
+            model_name="userpresence",
+            name="last_update_id",
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name="userpresence",
+            index=models.Index(
+                fields=["realm", "last_update_id"],
+                name="zerver_userpresence_realm_last_update_id_idx",
+            ),
+        ),
+        migrations.RunSQL(CREATE_TRIGGER_SQL, reverse_sql=DROP_TRIGGER_SQL),
+    ]
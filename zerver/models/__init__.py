@@ -36,6 +36,7 @@ from zerver.models.prereg_users import MultiuseInvite as MultiuseInvite
 from zerver.models.prereg_users import PreregistrationRealm as PreregistrationRealm
 from zerver.models.prereg_users import PreregistrationUser as PreregistrationUser
 from zerver.models.prereg_users import RealmReactivationStatus as RealmReactivationStatus
+from zerver.models.presence import PresenceSequence as PresenceSequence
 from zerver.models.presence import UserPresence as UserPresence
 from zerver.models.presence import UserStatus as UserStatus
 from zerver.models.push_notifications import AbstractPushDeviceToken as AbstractPushDeviceToken
@@ -59,6 +60,7 @@ from zerver.models.scheduled_jobs import (
 from zerver.models.streams import DefaultStream as DefaultStream
 from zerver.models.streams import DefaultStreamGroup as DefaultStreamGroup
 from zerver.models.streams import Stream as Stream
+from zerver.models.streams import StreamTopic as StreamTopic
 from zerver.models.streams import Subscription as Subscription
 from zerver.models.user_activity import UserActivity as UserActivity
 from zerver.models.user_activity import UserActivityInterval as UserActivityInterval
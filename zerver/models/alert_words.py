@@ -4,6 +4,7 @@ from django.db.models.signals import post_delete, post_save
 
 from zerver.lib.cache import (
     cache_delete,
+    flush_markdown_rendering_cache_for_realm,
     realm_alert_words_automaton_cache_key,
     realm_alert_words_cache_key,
 )
@@ -28,6 +29,7 @@ class AlertWord(models.Model):
 def flush_realm_alert_words(realm_id: int) -> None:
     cache_delete(realm_alert_words_cache_key(realm_id))
     cache_delete(realm_alert_words_automaton_cache_key(realm_id))
+    flush_markdown_rendering_cache_for_realm(realm_id)
 
 
 def flush_alert_word(*, instance: AlertWord, **kwargs: object) -> None:
@@ -39,6 +39,12 @@ class UserPresence(models.Model):
     # interacting with a computer running the desktop app)
     last_active_time = models.DateTimeField(default=timezone_now, db_index=True, null=True)
 
+    # Increases, within the realm, every time either of the times
+    # above changes, so that clients can fetch just the presence data
+    # that changed since their last request.  This is maintained by a
+    # database trigger, using PresenceSequence; see migration 0526.
+    last_update_id = models.PositiveBigIntegerField(default=0)
+
     # The following constants are used in the presence API for
     # communicating whether a user is active (last_active_time recent)
     # or idle (last_connected_time recent) or offline (neither
@@ -58,6 +64,10 @@ class UserPresence(models.Model):
                 fields=["realm", "last_connected_time"],
                 name="zerver_userpresence_realm_id_last_connected_time_98d2fc9f_idx",
             ),
+            models.Index(
+                fields=["realm", "last_update_id"],
+                name="zerver_userpresence_realm_last_update_id_idx",
+            ),
         ]
 
     @staticmethod
@@ -70,6 +80,17 @@ class UserPresence(models.Model):
         return None
 
 
+class PresenceSequence(models.Model):
+    """The most recently assigned UserPresence.last_update_id in each
+    realm.  Rows are created and updated only by the trigger on
+    zerver_userpresence; taking the row lock also serializes presence
+    writes within a realm, so update ids are committed in order.
+    """
+
+    realm = models.OneToOneField(Realm, on_delete=CASCADE)
+    last_update_id = models.PositiveBigIntegerField()
+
+
 class UserStatus(AbstractEmoji):
     user_profile = models.OneToOneField(UserProfile, on_delete=CASCADE)
 
@@ -7,7 +7,7 @@ from django.db.models.signals import post_delete, post_save
 from django.utils.translation import gettext_lazy
 from typing_extensions import override
 
-from zerver.lib.cache import cache_set, cache_with_key
+from zerver.lib.cache import cache_set, cache_with_key, flush_markdown_rendering_cache_for_realm
 from zerver.models.realms import Realm
 
 
@@ -136,6 +136,7 @@ def flush_realm_emoji(*, instance: RealmEmoji, **kwargs: object) -> None:
         get_all_custom_emoji_for_realm_uncached(realm_id),
         timeout=3600 * 24 * 7,
     )
+    flush_markdown_rendering_cache_for_realm(realm_id)
 
 
 post_save.connect(flush_realm_emoji, sender=RealmEmoji)
@@ -2,7 +2,7 @@ import secrets
 from typing import Any, Dict, Set
 
 from django.db import models
-from django.db.models import CASCADE, Q, QuerySet
+from django.db.models import CASCADE, F, Q, QuerySet
 from django.db.models.functions import Upper
 from django.db.models.signals import post_delete, post_save
 from django.utils.timezone import now as timezone_now
@@ -13,6 +13,7 @@ from typing_extensions import override
 from zerver.lib.cache import flush_stream
 from zerver.lib.timestamp import datetime_to_timestamp
 from zerver.lib.types import DefaultStreamDict, GroupPermissionSetting
+from zerver.models.constants import MAX_TOPIC_NAME_LENGTH
 from zerver.models.groups import SystemGroups, UserGroup
 from zerver.models.realms import Realm
 from zerver.models.recipients import Recipient
@@ -141,6 +142,21 @@ class Stream(models.Model):
     # stream based on what messages they have cached.
     first_message_id = models.IntegerField(null=True, db_index=True)
 
+    # Whether to skip creating UserMessage rows that would have the
+    # default (unread, zero) flags when a message is sent to this
+    # stream, deferring them until each subscriber next fetches
+    # messages or updates their flags; see
+    # add_missing_sparse_stream_messages.  This makes sending messages
+    # to announcement streams with very large audiences much cheaper.
+    # Only supported for streams with history public to subscribers,
+    # since we otherwise use UserMessage rows to control access.
+    sparse_user_messages = models.BooleanField(default=False)
+    # Whether some subscribers may still be missing UserMessage rows
+    # deferred because of sparse_user_messages.  This stays set after
+    # that mode is turned off, until the deferred_work queue has
+    # created all of those rows.
+    has_deferred_user_messages = models.BooleanField(default=False)
+
     stream_permission_group_settings = {
         "can_remove_subscribers_group": GroupPermissionSetting(
             require_system_group=True,
@@ -318,6 +334,12 @@ class Subscription(models.Model):
     email_notifications = models.BooleanField(null=True, default=None)
     wildcard_mentions_notify = models.BooleanField(null=True, default=None)
 
+    # For streams with sparse_user_messages, the ID of the last message
+    # for which any UserMessage rows deferred for this subscriber have
+    # been created.  NULL means that the stream was already in that
+    # mode when the user first subscribed.
+    last_materialized_message_id = models.IntegerField(null=True)
+
     class Meta:
         unique_together = ("user_profile", "recipient")
         indexes = [
@@ -358,6 +380,45 @@ class Subscription(models.Model):
     ]
 
 
+class StreamTopic(models.Model):
+    """A summary of each topic in a stream, used to list and search a
+    stream's topics without aggregating over its messages.
+
+    Rows are maintained by statement-level triggers on zerver_message
+    (see migration 0524_streamtopic), so that every way of sending,
+    editing, moving, deleting, archiving, or importing messages keeps
+    them up to date; application code should never write to this
+    table.  New messages are only added when their transaction
+    commits.
+    """
+
+    realm = models.ForeignKey(Realm, on_delete=CASCADE)
+    recipient = models.ForeignKey(Recipient, on_delete=CASCADE)
+    # Topics are case-insensitive; this is the topic name as it
+    # appears in the topic's most recent message.
+    topic_name = models.CharField(max_length=MAX_TOPIC_NAME_LENGTH)
+    is_resolved = models.BooleanField(default=False)
+    max_message_id = models.IntegerField()
+    message_count = models.IntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                "recipient",
+                Upper("topic_name"),
+                name="zerver_streamtopic_recipient_upper_topic_name",
+            ),
+        ]
+        indexes = [
+            models.Index(
+                # For listing a stream's topics, most recent first.
+                "recipient",
+                F("max_message_id").desc(),
+                name="zerver_streamtopic_recipient_max_message_id",
+            ),
+        ]
+
+
 class DefaultStream(models.Model):
     realm = models.ForeignKey(Realm, on_delete=CASCADE)
     stream = models.ForeignKey(Stream, on_delete=CASCADE)
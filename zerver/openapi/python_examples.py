@@ -1094,6 +1094,38 @@ def send_message(client: Client) -> int:
     return message_id
 
 
+@openapi_test_function("/messages/batch:post")
+def send_messages(client: Client) -> None:
+    # {code_example|start}
+    # Send a batch of stream messages
+    messages = [
+        {
+            "type": "stream",
+            "to": "Denmark",
+            "topic": "Castle",
+            "content": "Now is the winter of our discontent",
+        },
+        {
+            "type": "stream",
+            "to": "Denmark",
+            "topic": "Castle",
+            "content": "Made glorious summer by this sun of York.",
+        },
+    ]
+    request = {"messages": json.dumps(messages)}
+    result = client.call_endpoint(url="/messages/batch", method="POST", request=request)
+    # {code_example|end}
+
+    validate_against_openapi_schema(result, "/messages/batch", "post", "200")
+
+    # test that the messages were actually sent, in order
+    assert len(result["ids"]) == len(messages)
+    for message_id, message in zip(result["ids"], messages):
+        message_result = client.call_endpoint(url=f"messages/{message_id}", method="GET")
+        assert message_result["result"] == "success"
+        assert message_result["raw_content"] == message["content"]
+
+
 @openapi_test_function("/messages/{message_id}/reactions:post")
 def add_reaction(client: Client, message_id: int) -> None:
     request: Dict[str, Any] = {}
@@ -1669,6 +1701,7 @@ def test_invalid_stream_error(client: Client) -> None:
 def test_messages(client: Client, nonadmin_client: Client) -> None:
     render_message(client)
     message_id = send_message(client)
+    send_messages(client)
     add_reaction(client, message_id)
     remove_reaction(client, message_id)
     update_message(client, message_id)
@@ -1,3 +1,6 @@
+import asyncio
+import os
+import tempfile
 import time
 from typing import Any, Callable, Collection, Dict, List
 from unittest import mock
@@ -21,11 +24,16 @@ from zerver.tornado.event_queue import (
     ClientDescriptor,
     access_client_descriptor,
     allocate_client_descriptor,
+    checkpoint_event_queues,
+    clear_client_event_queues_for_testing,
+    dump_event_queues,
+    load_event_queues,
     maybe_enqueue_notifications,
     missedmessage_hook,
     persistent_queue_filename,
     process_notification,
 )
+from zerver.tornado.exceptions import BadEventQueueIdError
 from zerver.tornado.views import cleanup_event_queue, get_events
 
 
@@ -1200,6 +1208,137 @@ class FileReloadLogicTest(ZulipTestCase):
                 "/home/zulip/tornado/event_queues.9800.last.json",
             )
 
+    def make_client(self) -> ClientDescriptor:
+        hamlet = self.example_user("hamlet")
+        queue_data = dict(
+            all_public_streams=False,
+            apply_markdown=True,
+            client_gravatar=True,
+            client_type_name="website",
+            event_types=None,
+            last_connection_time=time.time(),
+            queue_timeout=600,
+            realm_id=hamlet.realm_id,
+            user_profile_id=hamlet.id,
+        )
+        client = allocate_client_descriptor(queue_data)
+        client.event_queue.push(dict(type="arbitrary", x="foo"))
+        return client
+
+    def test_dump_and_load_event_queues(self) -> None:
+        clients_before = [self.make_client().to_dict() for i in range(3)]
+        with tempfile.TemporaryDirectory() as tmpdir, self.settings(
+            JSON_PERSISTENT_QUEUE_FILENAME_PATTERN=os.path.join(tmpdir, "event_queues%s.json")
+        ):
+            dump_event_queues(9800)
+            with open(persistent_queue_filename(9800), "rb") as f:
+                self.assertTrue(f.read().startswith(b"ZULIPEQ\x01"))
+            self.assertFalse(os.path.exists(persistent_queue_filename(9800) + ".tmp"))
+
+            clear_client_event_queues_for_testing()
+            load_event_queues(9800)
+
+        from zerver.tornado.event_queue import clients as loaded_clients
+
+        self.assertEqual(
+            sorted(client.to_dict()["event_queue"]["id"] for client in loaded_clients.values()),
+            sorted(client_dict["event_queue"]["id"] for client_dict in clients_before),
+        )
+        for client_dict in clients_before:
+            loaded = loaded_clients[client_dict["event_queue"]["id"]]
+            self.assertEqual(loaded.to_dict(), client_dict)
+
+    def test_checkpoint_event_queues(self) -> None:
+        clients_before = [self.make_client() for i in range(3)]
+        with tempfile.TemporaryDirectory() as tmpdir, self.settings(
+            JSON_PERSISTENT_QUEUE_FILENAME_PATTERN=os.path.join(tmpdir, "event_queues%s.json")
+        ), mock.patch("zerver.tornado.event_queue.EVENT_QUEUE_CHECKPOINT_BATCH_SIZE", 2):
+            with self.assertLogs(level="INFO") as logs:
+                asyncio.run(checkpoint_event_queues(9800))
+            self.assertIn("checkpointed 3 event queues", logs.output[0])
+            self.assertFalse(os.path.exists(persistent_queue_filename(9800) + ".checkpoint.tmp"))
+
+            # Shutting down only writes the queues changed since the
+            # checkpoint, including those which were garbage-collected.
+            clients_before[0].event_queue.push(dict(type="arbitrary", x="bar"))
+            clients_before[2].cleanup()
+            new_client = self.make_client()
+            clients_after = [clients_before[0], clients_before[1], new_client]
+            client_dicts = {client.event_queue.id: client.to_dict() for client in clients_after}
+            with self.assertLogs(level="INFO") as logs:
+                dump_event_queues(9800)
+            self.assertIn("dumped 3 changed event queues since the last checkpoint", logs.output[0])
+            self.assertFalse(os.path.exists(persistent_queue_filename(9800)))
+
+            clear_client_event_queues_for_testing()
+            load_event_queues(9800)
+            self.assertFalse(os.path.exists(persistent_queue_filename(9800) + ".checkpoint"))
+            self.assertFalse(os.path.exists(persistent_queue_filename(9800) + ".delta"))
+
+        from zerver.tornado.event_queue import clients as loaded_clients
+
+        self.assertEqual(
+            {qid: client.to_dict() for qid, client in loaded_clients.items()}, client_dicts
+        )
+
+    def test_load_checkpoint_after_crash(self) -> None:
+        client = self.make_client()
+        with tempfile.TemporaryDirectory() as tmpdir, self.settings(
+            JSON_PERSISTENT_QUEUE_FILENAME_PATTERN=os.path.join(tmpdir, "event_queues%s.json")
+        ):
+            with self.assertLogs(level="INFO"):
+                asyncio.run(checkpoint_event_queues(9800))
+
+            # Without the delta written on a clean shutdown, the
+            # checkpoint may be missing events, so its queues are
+            # dropped rather than restored.
+            clear_client_event_queues_for_testing()
+            with self.assertLogs(level="WARNING") as logs:
+                load_event_queues(9800)
+            self.assertIn("did not shut down cleanly", logs.output[0])
+            self.assertFalse(os.path.exists(persistent_queue_filename(9800) + ".checkpoint"))
+
+        from zerver.tornado.event_queue import clients as loaded_clients
+
+        self.assertEqual(loaded_clients, {})
+        with self.assertRaises(BadEventQueueIdError):
+            access_client_descriptor(client.user_profile_id, client.event_queue.id)
+
+    def test_load_legacy_event_queues(self) -> None:
+        client = self.make_client()
+        client_dict = client.to_dict()
+        with tempfile.TemporaryDirectory() as tmpdir, self.settings(
+            JSON_PERSISTENT_QUEUE_FILENAME_PATTERN=os.path.join(tmpdir, "event_queues%s.json")
+        ):
+            with open(persistent_queue_filename(9800), "wb") as f:
+                f.write(orjson.dumps([(client.event_queue.id, client_dict)]))
+
+            clear_client_event_queues_for_testing()
+            load_event_queues(9800)
+
+        from zerver.tornado.event_queue import clients as loaded_clients
+
+        self.assertEqual(list(loaded_clients.keys()), [client.event_queue.id])
+        self.assertEqual(loaded_clients[client.event_queue.id].to_dict(), client_dict)
+
+    def test_load_truncated_event_queues(self) -> None:
+        clients_before = [self.make_client() for i in range(2)]
+        with tempfile.TemporaryDirectory() as tmpdir, self.settings(
+            JSON_PERSISTENT_QUEUE_FILENAME_PATTERN=os.path.join(tmpdir, "event_queues%s.json")
+        ):
+            dump_event_queues(9800)
+            filename = persistent_queue_filename(9800)
+            os.truncate(filename, os.path.getsize(filename) - 10)
+
+            clear_client_event_queues_for_testing()
+            with self.assertLogs(level="ERROR") as logs:
+                load_event_queues(9800)
+            self.assertIn("could not deserialize event queues; loaded 1", logs.output[0])
+
+        from zerver.tornado.event_queue import clients as loaded_clients
+
+        self.assertEqual(list(loaded_clients.keys()), [clients_before[0].event_queue.id])
+
 
 class PruneInternalDataTest(ZulipTestCase):
     def test_prune_internal_data(self) -> None:
@@ -1237,6 +1376,35 @@ class PruneInternalDataTest(ZulipTestCase):
         self.assertTrue("internal_data" in events[1])
         self.assertTrue("internal_data" in events[2])
 
+    def test_message_payload_shared_between_queues(self) -> None:
+        user_profile = self.example_user("hamlet")
+        queue_data = dict(
+            all_public_streams=False,
+            apply_markdown=True,
+            client_gravatar=True,
+            client_type_name="website",
+            event_types=["message"],
+            last_connection_time=time.time(),
+            queue_timeout=600,
+            realm_id=user_profile.realm.id,
+            user_profile_id=user_profile.id,
+        )
+        client = allocate_client_descriptor(dict(queue_data))
+        other_client = allocate_client_descriptor(dict(queue_data))
+
+        self.send_stream_message(self.example_user("iago"), "Denmark", content="hello")
+
+        [event] = client.event_queue.contents()
+        [other_event] = other_client.event_queue.contents()
+        self.assertFalse("internal_data" in event)
+        # Both queues received the same message payload object, and
+        # pruning internal_data did not copy it.
+        self.assertIs(event["message"], other_event["message"])
+
+        # Pruning does not modify the events stored in the queue.
+        [event] = client.event_queue.contents(include_internal_data=True)
+        self.assertTrue("internal_data" in event)
+
 
 class EventQueueTest(ZulipTestCase):
     def get_client_descriptor(self) -> ClientDescriptor:
@@ -1453,6 +1621,124 @@ class EventQueueTest(ZulipTestCase):
         )
         self.verify_to_dict_end_to_end(client)
 
+    def test_flag_read_unread_interleaving(self) -> None:
+        client = self.get_client_descriptor()
+        queue = client.event_queue
+
+        def read_event(operation: str, messages: List[int]) -> Dict[str, Any]:
+            event: Dict[str, Any] = dict(
+                type="update_message_flags",
+                operation=operation,
+                flag="read",
+                all=False,
+                timestamp=1,
+                messages=messages,
+            )
+            if operation == "remove":
+                event["message_details"] = {
+                    str(message_id): dict(type="private", user_ids=[])
+                    for message_id in messages
+                }
+            return event
+
+        queue.push(read_event("add", [1, 2]))
+        queue.push(read_event("remove", [1, 3]))
+        queue.push(dict(type="unknown"))
+        queue.push(read_event("add", [2, 3, 4]))
+        self.verify_to_dict_end_to_end(client)
+
+        # Each message appears only in the event for the most recent
+        # update to it: 1 was marked unread last, 2 and 3 read.
+        self.assertEqual(
+            queue.contents(),
+            [
+                dict(
+                    id=1,
+                    type="update_message_flags",
+                    operation="remove",
+                    flag="read",
+                    all=False,
+                    timestamp=1,
+                    messages=[1],
+                    message_details={"1": dict(type="private", user_ids=[])},
+                ),
+                dict(id=2, type="unknown"),
+                dict(
+                    id=3,
+                    type="update_message_flags",
+                    operation="add",
+                    flag="read",
+                    all=False,
+                    timestamp=1,
+                    messages=[2, 3, 4],
+                ),
+            ],
+        )
+        self.assertEqual(queue.virtual_flag_updates, {})
+
+    def test_flag_collapsing_around_message_moves(self) -> None:
+        client = self.get_client_descriptor()
+        queue = client.event_queue
+
+        def unread_event(message_id: int, topic: str) -> Dict[str, Any]:
+            return dict(
+                type="update_message_flags",
+                operation="remove",
+                flag="read",
+                all=False,
+                messages=[message_id],
+                message_details={str(message_id): dict(type="stream", stream_id=1, topic=topic)},
+            )
+
+        read_event = dict(
+            type="update_message_flags", operation="add", flag="read", all=False, messages=[1]
+        )
+        queue.push(unread_event(1, "old topic"))
+        queue.push(dict(type="update_message", message_ids=[1], topic="new topic"))
+        queue.push(unread_event(2, "new topic"))
+        queue.push(read_event)
+        queue.push(unread_event(1, "new topic"))
+        self.verify_to_dict_end_to_end(client)
+
+        # The mark-as-unread from before the move is delivered before
+        # it, with the old topic.  After the move, message 1's read
+        # and unread updates collapse into one event; the add/read
+        # event left with no messages is dropped.
+        contents = queue.contents()
+        self.assertEqual(
+            [(event["id"], event["type"], event.get("messages")) for event in contents],
+            [
+                (0, "update_message_flags", [1]),
+                (1, "update_message", None),
+                (4, "update_message_flags", [2, 1]),
+            ],
+        )
+        self.assertEqual(contents[0]["message_details"]["1"]["topic"], "old topic")
+        self.assertEqual(contents[2]["message_details"]["1"]["topic"], "new topic")
+
+    def test_flag_collapsing_before_all_flags_event(self) -> None:
+        client = self.get_client_descriptor()
+        queue = client.event_queue
+        unread_event = dict(
+            type="update_message_flags",
+            operation="remove",
+            flag="read",
+            all=False,
+            messages=[1],
+            message_details={"1": dict(type="private", user_ids=[])},
+        )
+        queue.push(unread_event)
+        queue.push(dict(type="update_message_flags", operation="add", flag="read", all=True))
+        queue.push(dict(unread_event, messages=[2], message_details={}))
+
+        # The mark-all-as-read event must not be reordered before the
+        # pending update to message 1, and later updates must not be
+        # collapsed into it.
+        self.assertEqual(
+            [(event["id"], event.get("messages")) for event in queue.contents()],
+            [(0, [1]), (1, None), (2, [2])],
+        )
+
     def test_collapse_event(self) -> None:
         """
         This mostly focuses on the internals of
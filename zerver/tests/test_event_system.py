@@ -35,6 +35,7 @@ from zerver.models.users import get_system_bot
 from zerver.tornado.event_queue import (
     allocate_client_descriptor,
     clear_client_event_queues_for_testing,
+    do_gc_event_queues,
     get_client_info_for_message_event,
     mark_clients_to_reload,
     process_message_event,
@@ -833,9 +834,16 @@ class ClientDescriptorsTest(ZulipTestCase):
 
         client = allocate_client_descriptor(queue_data)
 
+        message_dict = dict(
+            type="stream",
+            display_recipient="whatever",
+            subject="topic",
+            sender_email=self.example_email("iago"),
+        )
         message_event = dict(
             realm_id=realm.id,
             stream_name="whatever",
+            message_dict=message_dict,
         )
 
         client_info = get_client_info_for_message_event(
@@ -855,6 +863,7 @@ class ClientDescriptorsTest(ZulipTestCase):
         message_event = dict(
             realm_id=realm.id,
             stream_name="whatever",
+            message_dict=message_dict,
             sender_queue_id=client.event_queue.id,
         )
 
@@ -865,6 +874,60 @@ class ClientDescriptorsTest(ZulipTestCase):
         dct = client_info[client.event_queue.id]
         self.assertEqual(dct["is_sender"], True)
 
+    def test_get_client_info_for_narrowed_all_public_streams(self) -> None:
+        hamlet = self.example_user("hamlet")
+        realm = hamlet.realm
+
+        def allocate_narrowed_client(narrow: List[List[str]]) -> str:
+            queue_data = dict(
+                all_public_streams=True,
+                apply_markdown=True,
+                client_gravatar=True,
+                client_type_name="website",
+                event_types=["message"],
+                last_connection_time=time.time(),
+                narrow=narrow,
+                queue_timeout=0,
+                realm_id=realm.id,
+                user_profile_id=hamlet.id,
+            )
+            return allocate_client_descriptor(queue_data).event_queue.id
+
+        unnarrowed = allocate_narrowed_client([])
+        devel = allocate_narrowed_client([["stream", "Devel"]])
+        devel_topic = allocate_narrowed_client([["stream", "devel"], ["topic", "Bugs"]])
+        other_topic = allocate_narrowed_client([["stream", "devel"], ["topic", "other"]])
+        any_topic = allocate_narrowed_client([["topic", "bugs"]])
+        iago_sender = allocate_narrowed_client([["sender", self.example_email("iago")]])
+        othello_sender = allocate_narrowed_client([["sender", self.example_email("othello")]])
+        denmark = allocate_narrowed_client([["stream", "Denmark"], ["is", "mentioned"]])
+        dms = allocate_narrowed_client([["is", "dm"]])
+
+        message_event = dict(
+            realm_id=realm.id,
+            stream_name="devel",
+            message_dict=dict(
+                type="stream",
+                display_recipient="devel",
+                subject="bugs",
+                sender_email=self.example_email("iago"),
+            ),
+        )
+        client_info = get_client_info_for_message_event(message_event, users=[])
+        self.assertEqual(
+            set(client_info),
+            {unnarrowed, devel, devel_topic, any_topic, iago_sender},
+        )
+        self.assertNotIn(other_topic, client_info)
+        self.assertNotIn(othello_sender, client_info)
+        self.assertNotIn(denmark, client_info)
+        self.assertNotIn(dms, client_info)
+
+        # The index stays consistent as queues are garbage-collected.
+        do_gc_event_queues({devel, iago_sender}, {hamlet.id}, {realm.id})
+        client_info = get_client_info_for_message_event(message_event, users=[])
+        self.assertEqual(set(client_info), {unnarrowed, devel_topic, any_topic})
+
     def test_get_client_info_for_normal_users(self) -> None:
         hamlet = self.example_user("hamlet")
         cordelia = self.example_user("cordelia")
@@ -889,6 +952,12 @@ class ClientDescriptorsTest(ZulipTestCase):
             message_event = dict(
                 realm_id=realm.id,
                 stream_name="whatever",
+                message_dict=dict(
+                    type="stream",
+                    display_recipient="whatever",
+                    subject="topic",
+                    sender_email=self.example_email("iago"),
+                ),
             )
 
             client_info = get_client_info_for_message_event(
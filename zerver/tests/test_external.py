@@ -18,7 +18,6 @@ from zerver.lib.cache import cache_delete
 from zerver.lib.rate_limiter import (
     RateLimitedIPAddr,
     RateLimitedUser,
-    RateLimiterLockingError,
     get_tor_ips,
 )
 from zerver.lib.test_classes import ZulipTestCase
@@ -191,6 +190,30 @@ class RateLimitTests(ZulipTestCase):
 
         self.do_test_hit_ratelimits(lambda: self.send_api_message(user, "some stuff"))
 
+    @ratelimit_rule(1, 5, domain="api_by_user")
+    def test_batch_of_messages_counts_each_message(self) -> None:
+        user = self.example_user("cordelia")
+        RateLimitedUser(user).clear_history()
+
+        def send_batch(count: int) -> "TestHttpResponse":
+            messages = [
+                dict(type="stream", to="Verona", topic="whatever", content=f"Message {i}")
+                for i in range(count)
+            ]
+            return self.api_post(
+                user, "/api/v1/messages/batch", {"messages": orjson.dumps(messages).decode()}
+            )
+
+        with mock.patch("time.time", return_value=time.time()):
+            result = send_batch(3)
+            self.assert_json_success(result)
+            self.assertEqual(result["X-RateLimit-Remaining"], "2")
+
+            last_message_id = self.get_last_message().id
+            result = send_batch(3)
+            self.assertEqual(result.status_code, 429)
+            self.assertEqual(self.get_last_message().id, last_message_id)
+
     @ratelimit_rule(1, 5, domain="email_change_by_user")
     def test_hit_change_email_ratelimit_as_user(self) -> None:
         user = self.example_user("cordelia")
@@ -434,23 +457,3 @@ class RateLimitTests(ZulipTestCase):
             )
         finally:
             self.DEFAULT_SUBDOMAIN = original_default_subdomain
-
-    def test_hit_ratelimiterlockingexception(self) -> None:
-        user = self.example_user("cordelia")
-        RateLimitedUser(user).clear_history()
-
-        with mock.patch(
-            "zerver.lib.rate_limiter.RedisRateLimiterBackend.incr_ratelimit",
-            side_effect=RateLimiterLockingError,
-        ):
-            with self.assertLogs("zerver.lib.rate_limiter", level="WARNING") as m:
-                result = self.send_api_message(user, "some stuff")
-                self.assertEqual(result.status_code, 429)
-            self.assertEqual(
-                m.output,
-                [
-                    "WARNING:zerver.lib.rate_limiter:Deadlock trying to incr_ratelimit for {}".format(
-                        f"RateLimitedUser:{user.id}:api_by_user"
-                    )
-                ],
-            )
@@ -1,6 +1,8 @@
+import glob
 import json
 import os
 import shutil
+import signal
 import uuid
 from collections import defaultdict
 from datetime import datetime, timedelta, timezone
@@ -10,6 +12,7 @@ from unittest.mock import patch
 import orjson
 from django.conf import settings
 from django.core.exceptions import ValidationError
+from django.core.management import call_command
 from django.db.models import Q, QuerySet
 from django.test import override_settings
 from django.utils.timezone import now as timezone_now
@@ -41,7 +44,13 @@ from zerver.lib import upload
 from zerver.lib.avatar_hash import user_avatar_path
 from zerver.lib.bot_config import set_bot_config
 from zerver.lib.bot_lib import StateHandler
-from zerver.lib.export import Record, do_export_realm, do_export_user, export_usermessages_batch
+from zerver.lib.export import (
+    MESSAGE_PARTIALS_DONE_FILENAME,
+    Record,
+    do_export_realm,
+    do_export_user,
+    export_usermessages_batch,
+)
 from zerver.lib.import_realm import do_import_realm, get_incoming_message_ids
 from zerver.lib.streams import create_stream_if_needed
 from zerver.lib.test_classes import ZulipTestCase
@@ -421,6 +430,47 @@ class RealmImportExportTest(ExportFile):
         self.verify_emojis(user, is_s3=True)
         self.verify_realm_logo_and_icon()
 
+    def test_export_usermessage_batch_waiting_for_partials(self) -> None:
+        realm = Realm.objects.get(string_id="zulip")
+        output_dir = make_export_output_dir()
+        with patch("zerver.lib.export.create_soft_link"), self.assertLogs(level="INFO"):
+            do_export_realm(realm=realm, output_dir=output_dir, threads=0)
+        self.assertFalse(os.path.exists(export_fn(MESSAGE_PARTIALS_DONE_FILENAME)))
+        self.assertTrue(os.path.exists(export_fn("messages-000001.json.partial")))
+
+        # The export marks when it has written all of the partials;
+        # a process waiting for partials exits once it has done them.
+        with open(export_fn(MESSAGE_PARTIALS_DONE_FILENAME), "x"):
+            pass
+        with self.assertLogs(level="INFO"):
+            call_command(
+                "export_usermessage_batch",
+                f"--path={output_dir}",
+                "--thread=0",
+                "--wait-for-partials",
+            )
+        self.assertEqual(glob.glob(export_fn("messages-*.json.partial")), [])
+        self.assertNotEqual(read_json("messages-000001.json")["zerver_usermessage"], [])
+
+    def test_export_failure_stops_usermessage_subprocesses(self) -> None:
+        realm = Realm.objects.get(string_id="zulip")
+        output_dir = make_export_output_dir()
+        pids = {12345: 0}
+        with patch("zerver.lib.export.create_soft_link"), patch(
+            "zerver.lib.export.launch_user_message_subprocesses", return_value=pids
+        ), patch(
+            "zerver.lib.export.export_partial_message_files", side_effect=OSError("Disk full")
+        ), patch("zerver.lib.export.os.kill") as mock_kill, patch(
+            "zerver.lib.export.os.waitpid", return_value=(12345, signal.SIGTERM)
+        ) as mock_waitpid, patch("builtins.print"), self.assertLogs(
+            level="INFO"
+        ), self.assertRaises(OSError):
+            do_export_realm(realm=realm, output_dir=output_dir, threads=1)
+        mock_kill.assert_called_once_with(12345, signal.SIGTERM)
+        # We only wait for our own subprocesses, so that reaping any
+        # other child process cannot mask the original exception.
+        mock_waitpid.assert_called_once_with(12345, 0)
+
     def test_zulip_realm(self) -> None:
         realm = Realm.objects.get(string_id="zulip")
 
@@ -1,6 +1,7 @@
 import copy
 import os
 import re
+import time
 from html import escape
 from textwrap import dedent
 from typing import Any, Dict, List, Optional, Set, Tuple
@@ -21,7 +22,7 @@ from zerver.actions.create_realm import do_create_realm
 from zerver.actions.realm_emoji import do_remove_realm_emoji
 from zerver.actions.realm_settings import do_set_realm_property
 from zerver.actions.user_groups import check_add_user_group
-from zerver.actions.user_settings import do_change_user_setting
+from zerver.actions.user_settings import do_change_full_name, do_change_user_setting
 from zerver.actions.users import change_user_is_active
 from zerver.lib.alert_words import get_alert_word_automaton
 from zerver.lib.camo import get_camo_url
@@ -32,6 +33,7 @@ from zerver.lib.exceptions import JsonableError, MarkdownRenderingError
 from zerver.lib.markdown import (
     POSSIBLE_EMOJI_RE,
     InlineInterestingLinkProcessor,
+    LinkifierSet,
     MarkdownListPreprocessor,
     MessageRenderingResult,
     clear_state_for_testing,
@@ -39,8 +41,10 @@ from zerver.lib.markdown import (
     fetch_tweet_data,
     get_tweet_id,
     image_preview_enabled,
+    linkifier_sets,
     markdown_convert,
     maybe_update_markdown_engines,
+    md_engines,
     possible_linked_stream_names,
     render_message_markdown,
     topic_links,
@@ -48,6 +52,7 @@ from zerver.lib.markdown import (
     url_to_a,
 )
 from zerver.lib.markdown.fenced_code import FencedBlockPreprocessor
+from zerver.lib.markdown.pool import MarkdownRenderingJob, MarkdownRenderingPool
 from zerver.lib.mdiff import diff_strings
 from zerver.lib.mention import (
     FullNameInfo,
@@ -63,6 +68,8 @@ from zerver.lib.mention import (
 from zerver.lib.per_request_cache import flush_per_request_caches
 from zerver.lib.test_classes import ZulipTestCase
 from zerver.lib.tex import render_tex
+from zerver.lib.timeout import unsafe_timeout
+from zerver.lib.types import LinkifierDict
 from zerver.models import Message, NamedUserGroup, RealmEmoji, RealmFilter, UserMessage, UserProfile
 from zerver.models.clients import get_client
 from zerver.models.groups import SystemGroups
@@ -1669,6 +1676,105 @@ class MarkdownTest(ZulipTestCase):
         converted_boring_topic = topic_links(realm.id, boring_msg.topic_name())
         self.assertEqual(converted_boring_topic, [])
 
+    def test_linkifier_set(self) -> None:
+        linkifier_set = LinkifierSet(
+            [
+                LinkifierDict(
+                    pattern=r"#(?P<id>[0-9]{2,8})",
+                    url_template=r"https://trac.example.com/ticket/{id}",
+                    id=1,
+                ),
+                LinkifierDict(
+                    pattern=r"CVE-(?P<id>[0-9]+)",
+                    url_template=r"https://cve.example.com/{id}",
+                    id=2,
+                ),
+                LinkifierDict(
+                    pattern=r"(?P<id>[0-9",
+                    url_template=r"https://invalid.example.com/{id}",
+                    id=3,
+                ),
+            ]
+        )
+        self.assertIsNone(linkifier_set.patterns[2])
+        self.assertEqual(linkifier_set.matching_indexes("no match here"), set())
+        self.assertEqual(linkifier_set.matching_indexes("see #123 and CVE-2024"), {0, 1})
+        # Matches are found as if the text started at pos.
+        self.assertEqual(linkifier_set.matching_indexes("see #123 and CVE-2024", 4), {0, 1})
+        self.assertEqual(linkifier_set.matching_indexes("see #123 and CVE-2024", 5), {1})
+
+        # The set is shared by the realm's Markdown engines and
+        # topic_links, and rebuilt when the linkifiers change.
+        realm = get_realm("zulip")
+        RealmFilter.objects.filter(realm=realm).delete()
+        RealmFilter(
+            realm=realm,
+            pattern=r"CVE-(?P<id>[0-9]+)",
+            url_template=r"https://cve.example.com/{id}",
+        ).save()
+        msg = Message(sender=self.example_user("othello"), realm=realm)
+        self.assertEqual(
+            markdown_convert("CVE-2024 and #123", message_realm=realm, message=msg).rendered_content,
+            '<p><a href="https://cve.example.com/2024">CVE-2024</a> and #123</p>',
+        )
+        self.assertEqual(
+            topic_links(realm.id, "CVE-2024"),
+            [{"url": "https://cve.example.com/2024", "text": "CVE-2024"}],
+        )
+        self.assertIs(linkifier_sets[realm.id], md_engines[(realm.id, False)].linkifier_set)
+
+    def test_markdown_rendering_cache(self) -> None:
+        hamlet = self.example_user("hamlet")
+        othello = self.example_user("othello")
+        realm = othello.realm
+        msg = Message(sender=othello, sending_client=get_client("test"), realm=realm)
+        content = "@**King Hamlet** see #**Denmark**, CVE-2024, and https://zulip.com"
+
+        with mock.patch("zerver.lib.markdown.unsafe_timeout", wraps=unsafe_timeout) as m:
+            rendering_result = render_message_markdown(msg, content)
+            self.assertEqual(m.call_count, 1)
+
+            # Rendering the same content again is a cache hit, which
+            # also sets the message's has_* flags.
+            msg.has_link = False
+            self.assertEqual(render_message_markdown(msg, content), rendering_result)
+            self.assertEqual(m.call_count, 1)
+            self.assertTrue(msg.has_link)
+
+            # Mentions of a renamed user no longer match.
+            do_change_full_name(hamlet, "Prince Hamlet", acting_user=None)
+            renamed_rendering_result = render_message_markdown(msg, content)
+            self.assertEqual(m.call_count, 2)
+            self.assertEqual(renamed_rendering_result.mentions_user_ids, set())
+
+            # Changes to linkifiers replace the realm's epoch.
+            RealmFilter(
+                realm=realm,
+                pattern=r"CVE-(?P<id>[0-9]+)",
+                url_template=r"https://cve.example.com/{id}",
+            ).save()
+            render_message_markdown(msg, content)
+            self.assertEqual(m.call_count, 3)
+            render_message_markdown(msg, content)
+            self.assertEqual(m.call_count, 3)
+
+            # We never cache renderings with URL previews.
+            render_message_markdown(msg, content, url_embed_data={})
+            self.assertEqual(m.call_count, 4)
+
+            # Code blocks without a language depend on the realm's
+            # default code block language.
+            code_content = "```\nprint(1)\n```"
+            plain_rendering_result = render_message_markdown(msg, code_content)
+            self.assertEqual(m.call_count, 5)
+            do_set_realm_property(realm, "default_code_block_language", "python", acting_user=None)
+            python_rendering_result = render_message_markdown(msg, code_content)
+            self.assertEqual(m.call_count, 6)
+            self.assertNotEqual(
+                python_rendering_result.rendered_content, plain_rendering_result.rendered_content
+            )
+            self.assertIn('data-code-language="Python"', python_rendering_result.rendered_content)
+
     def test_is_status_message(self) -> None:
         user_profile = self.example_user("othello")
         msg = Message(
@@ -3311,6 +3417,40 @@ class MarkdownErrorTests(ZulipTestCase):
             with self.assertRaises(MarkdownRenderingError):
                 markdown_convert_wrapper(msg)
 
+    def test_markdown_rendering_pool(self) -> None:
+        def simulated_markdown_convert(content: str, **kwargs: Any) -> mock.Mock:
+            if content == "slow":
+                time.sleep(60)
+            if content == "broken":
+                raise MarkdownRenderingError
+            # The workers fetch the mention data with their own
+            # long-lived MentionBackend.
+            assert isinstance(kwargs["mention_data"], MentionData)
+            return mock.Mock(rendered_content=f"<p>{content}</p>")
+
+        jobs = [
+            MarkdownRenderingJob(content=content, sent_by_bot=False, translate_emoticons=False)
+            for content in ["first", "slow", "broken", "last"]
+        ]
+        # The pool's workers are forked, and so inherit these mocks.
+        with mock.patch("zerver.lib.markdown.pool.close_connections_before_fork"), mock.patch(
+            "zerver.lib.markdown.pool.markdown_convert", side_effect=simulated_markdown_convert
+        ):
+            with self.assertLogs(level="WARNING") as m, MarkdownRenderingPool(
+                get_realm("zulip"), processes=2, timeout=1
+            ) as pool:
+                self.assertEqual(pool.render(jobs), ["<p>first</p>", None, None, "<p>last</p>"])
+                self.assert_length(pool.workers, 2)
+                self.assertTrue(all(worker.process.is_alive() for worker in pool.workers))
+
+                self.assertEqual(pool.render(jobs[:1]), ["<p>first</p>"])
+
+        self.assertEqual(
+            m.output,
+            ["WARNING:root:Timed out rendering Markdown; input (sanitized) was: 'xxxx'"],
+        )
+        self.assertEqual(pool.workers, [])
+
     def test_curl_code_block_validation(self) -> None:
         processor = SimulatedFencedBlockPreprocessor(Markdown())
         processor.run_content_validators = True
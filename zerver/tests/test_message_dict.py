@@ -3,14 +3,22 @@ from unittest import mock
 
 from django.utils.timezone import now as timezone_now
 
-from zerver.lib.cache import cache_delete, to_dict_cache_key_id
+from zerver.actions.user_settings import do_change_full_name
+from zerver.lib.avatar import get_avatar_field
+from zerver.lib.cache import (
+    cache_delete,
+    get_local_cache_hits,
+    message_dict_epoch_cache_key,
+    message_dict_local_cache,
+    to_dict_cache_key_id,
+)
 from zerver.lib.display_recipient import get_display_recipient
 from zerver.lib.markdown import version as markdown_version
 from zerver.lib.message import messages_for_ids
 from zerver.lib.message_cache import MessageDict, sew_messages_and_reactions
 from zerver.lib.per_request_cache import flush_per_request_caches
 from zerver.lib.test_classes import ZulipTestCase
-from zerver.lib.test_helpers import make_client
+from zerver.lib.test_helpers import cache_tries_captured, make_client
 from zerver.lib.topic import TOPIC_LINKS
 from zerver.lib.types import DisplayRecipientT, UserDisplayRecipient
 from zerver.models import Message, Reaction, Realm, RealmFilter, Recipient, Stream, UserProfile
@@ -170,13 +178,18 @@ class MessageDictTest(ZulipTestCase):
         num_ids = len(ids)
         self.assertTrue(num_ids >= 600)
 
-        with self.assert_database_query_count(7):
+        with self.assert_database_query_count(7), mock.patch(
+            "zerver.lib.message_cache.get_avatar_field", wraps=get_avatar_field
+        ) as avatar_mock:
             objs = MessageDict.ids_to_dict(ids)
             MessageDict.post_process_dicts(
                 objs, apply_markdown=False, client_gravatar=False, realm=realm
             )
 
         self.assert_length(objs, num_ids)
+        # The avatar URL is computed once per sender, not per message.
+        avatar_mock.assert_called_once()
+        self.assert_length({obj["avatar_url"] for obj in objs}, 1)
 
     def test_applying_markdown(self) -> None:
         sender = self.example_user("othello")
@@ -431,6 +444,92 @@ class MessageHydrationTest(ZulipTestCase):
         self.assertIn('class="user-mention"', new_message["content"])
         self.assertEqual(new_message["flags"], ["mentioned"])
 
+    def test_messages_for_ids_local_cache(self) -> None:
+        hamlet = self.example_user("hamlet")
+        self.login_user(hamlet)
+        message_id = self.send_stream_message(hamlet, "Denmark", content="foo")
+
+        def fetch_content() -> str:
+            messages = messages_for_ids(
+                message_ids=[message_id],
+                user_message_flags={message_id: ["read"]},
+                search_fields={},
+                apply_markdown=False,
+                client_gravatar=True,
+                allow_edit_history=False,
+                user_profile=hamlet,
+                realm=hamlet.realm,
+            )
+            return messages[0]["content"]
+
+        self.assertEqual(fetch_content(), "foo")
+
+        # Once a message dict is in the local cache, we only fetch its
+        # epoch from memcached.
+        local_cache_hits = get_local_cache_hits()
+        with cache_tries_captured() as cache_tries:
+            self.assertEqual(fetch_content(), "foo")
+        self.assertEqual(get_local_cache_hits(), local_cache_hits + 1)
+        self.assertIn(("getmany", [message_dict_epoch_cache_key(message_id)], None), cache_tries)
+        message_dict_key = to_dict_cache_key_id(message_id)
+        self.assertFalse(any(message_dict_key in keys for method, keys, cache_name in cache_tries))
+
+        # Editing the message, as any process could, replaces the
+        # epoch, so the local copy is no longer used.
+        result = self.client_patch(f"/json/messages/{message_id}", {"content": "bar"})
+        self.assert_json_success(result)
+        self.assertEqual(fetch_content(), "bar")
+        self.assertEqual(get_local_cache_hits(), local_cache_hits + 1)
+
+        # With the local cache disabled, we don't fetch the epochs.
+        with self.settings(MESSAGE_DICT_LOCAL_CACHE_SIZE=0), cache_tries_captured() as cache_tries:
+            self.assertEqual(fetch_content(), "bar")
+            self.assertEqual(fetch_content(), "bar")
+        self.assertEqual(get_local_cache_hits(), local_cache_hits + 1)
+        self.assertEqual(message_dict_local_cache.entries, {})
+        epoch_key = message_dict_epoch_cache_key(message_id)
+        self.assertFalse(any(epoch_key in keys for method, keys, cache_name in cache_tries))
+
+    def test_messages_for_ids_finalized_templates(self) -> None:
+        hamlet = self.example_user("hamlet")
+        message_id = self.send_stream_message(hamlet, "Denmark", content="foo")
+
+        def fetch_message() -> Dict[str, Any]:
+            messages = messages_for_ids(
+                message_ids=[message_id],
+                user_message_flags={message_id: ["read"]},
+                search_fields={},
+                apply_markdown=True,
+                client_gravatar=False,
+                allow_edit_history=False,
+                user_profile=hamlet,
+                realm=hamlet.realm,
+            )
+            return messages[0]
+
+        message = fetch_message()
+        self.assertEqual(message["content"], "<p>foo</p>")
+        self.assertEqual(message["flags"], ["read"])
+
+        # Fetching the message again reuses its finalized template,
+        # but returns a new dict, which the caller may modify.
+        with mock.patch.object(
+            MessageDict, "finalize_payload", wraps=MessageDict.finalize_payload
+        ) as finalize_payload:
+            self.assertEqual(fetch_message(), message)
+            message["content"] = "modified"
+            self.assertEqual(fetch_message()["content"], "<p>foo</p>")
+        finalize_payload.assert_not_called()
+
+        # Changes to the sender, which are not part of the cached
+        # message dict, are still picked up.
+        do_change_full_name(hamlet, "Prince Hamlet", acting_user=None)
+        with mock.patch.object(
+            MessageDict, "finalize_payload", wraps=MessageDict.finalize_payload
+        ) as finalize_payload:
+            self.assertEqual(fetch_message()["sender_full_name"], "Prince Hamlet")
+        finalize_payload.assert_called_once()
+
     def test_message_for_ids_for_restricted_user_access(self) -> None:
         self.set_up_db_for_testing_user_access()
         hamlet = self.example_user("hamlet")
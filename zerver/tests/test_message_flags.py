@@ -8,6 +8,11 @@ from typing_extensions import override
 from zerver.actions.message_flags import do_update_message_flags
 from zerver.actions.streams import do_change_stream_permission
 from zerver.actions.user_topics import do_set_user_topic_visibility_policy
+from zerver.lib.cache import (
+    cache_get,
+    get_unread_message_metadata_epoch,
+    unread_message_metadata_cache_key,
+)
 from zerver.lib.fix_unreads import fix, fix_unsubscribed
 from zerver.lib.message import (
     MessageDetailsDict,
@@ -23,6 +28,13 @@ from zerver.lib.message import (
     get_raw_unread_data,
 )
 from zerver.lib.message_cache import MessageDict
+from zerver.lib.narrow import (
+    LARGER_THAN_MAX_MESSAGE_ID,
+    find_first_unread_anchor,
+    get_first_unread_anchor_cache_narrow_key,
+    query_first_unread_anchor,
+)
+from zerver.lib.sqlalchemy_utils import get_sqlalchemy_connection
 from zerver.lib.test_classes import ZulipTestCase
 from zerver.lib.test_helpers import get_subscription
 from zerver.lib.user_message import DEFAULT_HISTORICAL_FLAGS, create_historical_user_messages
@@ -164,6 +176,97 @@ class FirstUnreadAnchorTests(ZulipTestCase):
             messages = self.get_messages(anchor="first_unread", num_before=0, num_after=1)
         self.assert_length(messages, 1)
 
+    def test_first_unread_anchor_cache(self) -> None:
+        hamlet = self.example_user("hamlet")
+        othello = self.example_user("othello")
+        stream = get_stream("Verona", hamlet.realm)
+        message_ids = [
+            self.send_stream_message(othello, "Verona", topic_name="lunch") for i in range(3)
+        ]
+        narrow = [dict(operator="channel", operand="Verona")]
+
+        def find_anchor() -> int:
+            with get_sqlalchemy_connection() as sa_conn:
+                return find_first_unread_anchor(sa_conn, hamlet, narrow)
+
+        with mock.patch(
+            "zerver.lib.narrow.query_first_unread_anchor", wraps=query_first_unread_anchor
+        ) as mock_query:
+            self.assertEqual(find_anchor(), message_ids[0])
+            self.assertEqual(find_anchor(), message_ids[0])
+            self.assertEqual(mock_query.call_count, 1)
+
+            # Reading the cached anchor makes us look for the next one.
+            do_update_message_flags(hamlet, "add", "read", message_ids[:1])
+            self.assertEqual(find_anchor(), message_ids[1])
+            self.assertEqual(mock_query.call_count, 2)
+
+            # Marking an earlier message as unread flushes the cache.
+            with self.captureOnCommitCallbacks(execute=True):
+                do_update_message_flags(hamlet, "remove", "read", message_ids[:1])
+            self.assertEqual(find_anchor(), message_ids[0])
+            self.assertEqual(mock_query.call_count, 3)
+
+            # So does muting the topic; and we don't cache the absence of
+            # unread messages, since new messages don't flush the cache.
+            with self.captureOnCommitCallbacks(execute=True):
+                do_set_user_topic_visibility_policy(
+                    hamlet, stream, "lunch", visibility_policy=UserTopic.VisibilityPolicy.MUTED
+                )
+            self.assertEqual(find_anchor(), LARGER_THAN_MAX_MESSAGE_ID)
+            self.assertEqual(find_anchor(), LARGER_THAN_MAX_MESSAGE_ID)
+            self.assertEqual(mock_query.call_count, 5)
+
+        # Narrows whose first unread message can change without a flush
+        # are never cached.
+        for term in [
+            dict(operator="search", operand="lunch"),
+            dict(operator="is", operand="starred"),
+            dict(operator="channel", operand="Verona", negated=True),
+        ]:
+            self.assertIsNone(get_first_unread_anchor_cache_narrow_key([term]))
+        self.assertEqual(
+            get_first_unread_anchor_cache_narrow_key(
+                [
+                    dict(operator="topic", operand="lunch"),
+                    dict(operator="channel", operand="Verona"),
+                ]
+            ),
+            get_first_unread_anchor_cache_narrow_key(
+                [
+                    dict(operator="channel", operand="Verona"),
+                    dict(operator="topic", operand="lunch"),
+                ]
+            ),
+        )
+
+    def test_first_unread_anchor_cache_after_move(self) -> None:
+        hamlet = self.example_user("hamlet")
+        othello = self.example_user("othello")
+        lunch_message_id = self.send_stream_message(othello, "Verona", topic_name="lunch")
+        dinner_message_id = self.send_stream_message(othello, "Verona", topic_name="dinner")
+        narrow = [
+            dict(operator="channel", operand="Verona"),
+            dict(operator="topic", operand="dinner"),
+        ]
+
+        def find_anchor() -> int:
+            with get_sqlalchemy_connection() as sa_conn:
+                return find_first_unread_anchor(sa_conn, hamlet, narrow)
+
+        self.assertEqual(find_anchor(), dinner_message_id)
+
+        # Moving an earlier unread message into the narrow flushes the
+        # cache for the users who have not read it.
+        self.login_user(othello)
+        with self.captureOnCommitCallbacks(execute=True):
+            result = self.client_patch(
+                f"/json/messages/{lunch_message_id}",
+                {"topic": "dinner", "propagate_mode": "change_one"},
+            )
+        self.assert_json_success(result)
+        self.assertEqual(find_anchor(), lunch_message_id)
+
 
 class UnreadCountTests(ZulipTestCase):
     @override
@@ -1169,6 +1272,88 @@ class GetUnreadMsgsTest(ZulipTestCase):
             dict(other_user_id=hamlet.id),
         )
 
+    def test_raw_unread_data_cache(self) -> None:
+        cordelia = self.example_user("cordelia")
+        hamlet = self.example_user("hamlet")
+        othello = self.example_user("othello")
+        self.subscribe(hamlet, "Denmark")
+        self.subscribe(cordelia, "Denmark")
+        self.unsubscribe(othello, "Denmark")
+
+        message_ids = [
+            self.send_stream_message(cordelia, "Denmark", topic_name="lunch") for i in range(3)
+        ]
+
+        # The first call populates the cache of message metadata.
+        with self.assert_database_query_count(5):
+            raw_unread_data = get_raw_unread_data(hamlet)
+        self.assertEqual(set(raw_unread_data["stream_dict"]), set(message_ids))
+
+        # Now we only need to query UserMessage to find the unread messages.
+        with self.assert_database_query_count(4):
+            raw_unread_data = get_raw_unread_data(hamlet)
+        self.assertEqual(set(raw_unread_data["stream_dict"]), set(message_ids))
+
+        # Reading and receiving messages does not require invalidation.
+        do_update_message_flags(hamlet, "add", "read", message_ids[:1])
+        new_message_id = self.send_stream_message(cordelia, "Denmark", topic_name="lunch")
+        raw_unread_data = get_raw_unread_data(hamlet)
+        self.assertEqual(
+            set(raw_unread_data["stream_dict"]), {*message_ids[1:], new_message_id}
+        )
+
+        # Moving messages to another topic invalidates the cache, but
+        # only for users who have received them.
+        othello_epoch = get_unread_message_metadata_epoch(othello.id)
+        self.login("cordelia")
+        with self.captureOnCommitCallbacks(execute=True):
+            result = self.client_patch(
+                f"/json/messages/{message_ids[1]}",
+                {
+                    "topic": "dinner",
+                    "propagate_mode": "change_all",
+                    "send_notification_to_old_thread": "false",
+                    "send_notification_to_new_thread": "false",
+                },
+            )
+        self.assert_json_success(result)
+        raw_unread_data = get_raw_unread_data(hamlet)
+        self.assertEqual(
+            {message_id: row["topic"] for message_id, row in raw_unread_data["stream_dict"].items()},
+            {message_ids[1]: "dinner", message_ids[2]: "dinner", new_message_id: "dinner"},
+        )
+        self.assertEqual(get_unread_message_metadata_epoch(othello.id), othello_epoch)
+
+        # That includes messages which were read at the time.
+        do_update_message_flags(hamlet, "remove", "read", message_ids[:1])
+        raw_unread_data = get_raw_unread_data(hamlet)
+        self.assertEqual(raw_unread_data["stream_dict"][message_ids[0]]["topic"], "dinner")
+
+    def test_raw_unread_data_cache_size_limit(self) -> None:
+        cordelia = self.example_user("cordelia")
+        hamlet = self.example_user("hamlet")
+        self.subscribe(hamlet, "Denmark")
+        self.subscribe(cordelia, "Denmark")
+        message_ids = [
+            self.send_stream_message(cordelia, "Denmark", topic_name="lunch") for i in range(3)
+        ]
+
+        with mock.patch("zerver.lib.message.UNREAD_MESSAGE_METADATA_CACHE_MAX_MESSAGES", 2):
+            raw_unread_data = get_raw_unread_data(hamlet)
+            self.assertEqual(set(raw_unread_data["stream_dict"]), set(message_ids))
+
+            # Only the most recent unread messages are cached.
+            cached = cache_get(unread_message_metadata_cache_key(hamlet.id))
+            assert cached is not None
+            self.assertEqual(set(cached[0]["messages"]), set(message_ids[1:]))
+
+            # The oldest message is fetched from the database every
+            # time, but the cache is not rewritten.
+            with mock.patch("zerver.lib.message.cache_set") as mock_cache_set:
+                raw_unread_data = get_raw_unread_data(hamlet)
+            mock_cache_set.assert_not_called()
+            self.assertEqual(set(raw_unread_data["stream_dict"]), set(message_ids))
+
     def test_unread_msgs(self) -> None:
         sender = self.example_user("cordelia")
         sender_id = sender.id
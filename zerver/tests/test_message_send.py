@@ -1,6 +1,6 @@
 from datetime import timedelta
 from email.headerregistry import Address
-from typing import Any, Optional, Set
+from typing import Any, Optional, Set, Tuple
 from unittest import mock
 
 import orjson
@@ -18,6 +18,7 @@ from zerver.actions.message_send import (
     do_send_messages,
     extract_private_recipients,
     extract_stream_indicator,
+    get_recipient_info,
     internal_prep_private_message,
     internal_prep_stream_message_by_name,
     internal_send_huddle_message,
@@ -47,6 +48,7 @@ from zerver.lib.test_helpers import (
     reset_email_visibility_to_everyone_in_zulip_realm,
 )
 from zerver.lib.timestamp import datetime_to_timestamp
+from zerver.lib.user_message import UserMessageLite, bulk_insert_ums
 from zerver.models import (
     Message,
     NamedUserGroup,
@@ -1454,6 +1456,66 @@ class MessagePOSTTest(ZulipTestCase):
         result = self.api_post(sender, "/api/v1/messages", payload)
         self.assert_json_success(result)
 
+    def test_send_messages_batch(self) -> None:
+        hamlet = self.example_user("hamlet")
+        othello = self.example_user("othello")
+        stream = get_stream("Verona", hamlet.realm)
+        messages = [
+            dict(type="stream", to="Verona", topic="builds", content="Build #1 passed."),
+            dict(type="channel", to=stream.id, topic="builds", content="Build #2 failed."),
+            dict(type="direct", to=[othello.id], content="Build #2 failed."),
+            dict(type="stream", to="Verona", topic="builds", content="Build #3 passed."),
+            dict(type="private", to=[othello.email], content="Build #3 passed."),
+        ]
+
+        with mock.patch(
+            "zerver.actions.message_send.get_recipient_info", wraps=get_recipient_info
+        ) as m:
+            result = self.api_post(
+                hamlet, "/api/v1/messages/batch", {"messages": orjson.dumps(messages).decode()}
+            )
+        # Messages to the same topic or the same direct message
+        # conversation share a lookup.
+        self.assertEqual(m.call_count, 2)
+
+        message_ids = self.assert_json_success(result)["ids"]
+        sent_messages = Message.objects.filter(id__in=message_ids).order_by("id")
+        self.assertEqual(
+            [message.content for message in sent_messages],
+            [message["content"] for message in messages],
+        )
+        self.assertEqual([message.id for message in sent_messages], message_ids)
+        self.assertEqual(
+            UserMessage.objects.filter(message_id=message_ids[0]).count(),
+            UserMessage.objects.filter(message_id=message_ids[3]).count(),
+        )
+        self.assertEqual(sent_messages[2].recipient.type_id, othello.id)
+        self.assertEqual(sent_messages[4].recipient, sent_messages[2].recipient)
+
+        messages_to_list = [dict(type="stream", to=["Verona"], topic="builds", content="Hi")]
+        result = self.api_post(
+            hamlet, "/api/v1/messages/batch", {"messages": orjson.dumps(messages_to_list).decode()}
+        )
+        self.assert_json_error(result, "Invalid data type for channel")
+
+        # If any message is invalid, none of them are sent.
+        last_message_id = self.get_last_message().id
+        messages.append(dict(type="stream", to="nonexistent", topic="builds", content="Hi"))
+        result = self.api_post(
+            hamlet, "/api/v1/messages/batch", {"messages": orjson.dumps(messages).decode()}
+        )
+        self.assert_json_error(result, "Channel 'nonexistent' does not exist")
+        self.assertEqual(self.get_last_message().id, last_message_id)
+
+        messages = [
+            dict(type="stream", to="Verona", topic="builds", content=f"Build #{i} passed.")
+            for i in range(101)
+        ]
+        result = self.api_post(
+            hamlet, "/api/v1/messages/batch", {"messages": orjson.dumps(messages).decode()}
+        )
+        self.assert_json_error(result, "Too many messages; the maximum is 100.")
+
 
 class StreamMessagesTest(ZulipTestCase):
     def assert_stream_message(
@@ -2303,6 +2365,50 @@ class StreamMessagesTest(ZulipTestCase):
         )
         self.assertEqual(recent_conversation["max_message_id"], message2_id)
 
+    def test_bulk_insert_ums_with_copy(self) -> None:
+        hamlet = self.example_user("hamlet")
+        cordelia = self.example_user("cordelia")
+        othello = self.example_user("othello")
+        content = "@**Cordelia, Lear's daughter**"
+
+        def user_message_rows(message_id: int) -> Set[Tuple[int, int]]:
+            return set(
+                UserMessage.objects.filter(message_id=message_id).values_list(
+                    "user_profile_id", "flags"
+                )
+            )
+
+        with mock.patch("zerver.lib.user_message.BULK_INSERT_UMS_COPY_THRESHOLD", 1):
+            message_id = self.send_stream_message(hamlet, "Verona", content)
+        # The rows are the same as if they were inserted without COPY.
+        self.assertEqual(
+            user_message_rows(message_id),
+            user_message_rows(self.send_stream_message(hamlet, "Verona", content)),
+        )
+        cordelia_user_message = UserMessage.objects.get(
+            message_id=message_id, user_profile=cordelia
+        )
+        self.assertTrue(cordelia_user_message.flags.mentioned)
+        self.assertFalse(cordelia_user_message.flags.read)
+
+        # Existing rows are left unchanged.
+        UserMessage.objects.filter(message_id=message_id, user_profile=othello).delete()
+        with mock.patch("zerver.lib.user_message.BULK_INSERT_UMS_COPY_THRESHOLD", 1):
+            bulk_insert_ums(
+                [
+                    UserMessageLite(user_profile_id=cordelia.id, message_id=message_id, flags=0),
+                    UserMessageLite(
+                        user_profile_id=othello.id,
+                        message_id=message_id,
+                        flags=int(UserMessage.flags.read),
+                    ),
+                ]
+            )
+        cordelia_user_message.refresh_from_db()
+        self.assertTrue(cordelia_user_message.flags.mentioned)
+        othello_user_message = UserMessage.objects.get(message_id=message_id, user_profile=othello)
+        self.assertEqual(othello_user_message.flags_list(), ["read"])
+
 
 class PersonalMessageSendTest(ZulipTestCase):
     def test_personal_to_self(self) -> None:
@@ -1,10 +1,13 @@
+from typing import Dict, List, Tuple
 from unittest import mock
 
+from django.db import connection
 from django.utils.timezone import now as timezone_now
 
+from zerver.actions.message_delete import do_delete_messages
 from zerver.actions.streams import do_change_stream_permission
 from zerver.lib.test_classes import ZulipTestCase
-from zerver.models import Message, UserMessage
+from zerver.models import Message, StreamTopic, UserMessage
 from zerver.models.clients import get_client
 from zerver.models.realms import get_realm
 from zerver.models.streams import get_stream
@@ -154,6 +157,124 @@ class TopicHistoryTest(ZulipTestCase):
         self.assertNotIn("topic1", [topic["name"] for topic in history])
         self.assertNotIn("topic2", [topic["name"] for topic in history])
 
+    def test_stream_topic_summaries(self) -> None:
+        iago = self.example_user("iago")
+        self.login_user(iago)
+        stream = self.make_stream("summaries")
+        self.subscribe(iago, stream.name)
+
+        def get_summaries() -> List[Tuple[str, bool, int, int]]:
+            return list(
+                StreamTopic.objects.filter(recipient_id=stream.recipient_id)
+                .order_by("-max_message_id")
+                .values_list("topic_name", "is_resolved", "max_message_id", "message_count")
+            )
+
+        # New messages are only added to the summaries when the
+        # transaction commits, which tests emulate by making the
+        # deferred trigger run immediately.
+        with connection.cursor() as cursor:
+            cursor.execute("SET CONSTRAINTS zerver_streamtopic_apply_changes_trigger DEFERRED")
+        first_id = self.send_stream_message(iago, stream.name, topic_name="lunch")
+        self.assertEqual(get_summaries(), [])
+        with connection.cursor() as cursor:
+            cursor.execute("SET CONSTRAINTS zerver_streamtopic_apply_changes_trigger IMMEDIATE")
+        self.assertEqual(get_summaries(), [("lunch", False, first_id, 1)])
+
+        second_id = self.send_stream_message(iago, stream.name, topic_name="LUNCH")
+        other_id = self.send_stream_message(iago, stream.name, topic_name="dinner")
+        self.assertEqual(
+            get_summaries(),
+            [("dinner", False, other_id, 1), ("LUNCH", False, second_id, 2)],
+        )
+
+        # Deleting the most recent message in a topic reverts to the
+        # case of the message before it.
+        do_delete_messages(iago.realm, [Message.objects.get(id=second_id)])
+        self.assertEqual(
+            get_summaries(),
+            [("dinner", False, other_id, 1), ("lunch", False, first_id, 1)],
+        )
+
+        # Resolving a topic moves all its messages to a new topic name.
+        result = self.client_patch(
+            f"/json/messages/{first_id}",
+            {"topic": "✔ lunch", "propagate_mode": "change_all"},
+        )
+        self.assert_json_success(result)
+        self.assertEqual(
+            get_summaries(),
+            [("dinner", False, other_id, 1), ("✔ lunch", True, first_id, 1)],
+        )
+
+        # Moving a topic to another stream removes it from this one.
+        other_stream = self.make_stream("other summaries")
+        self.subscribe(iago, other_stream.name)
+        result = self.client_patch(
+            f"/json/messages/{other_id}",
+            {"stream_id": other_stream.id, "propagate_mode": "change_all"},
+        )
+        self.assert_json_success(result)
+        self.assertEqual(get_summaries(), [("✔ lunch", True, first_id, 1)])
+        self.assertEqual(
+            list(
+                StreamTopic.objects.filter(recipient_id=other_stream.recipient_id).values_list(
+                    "topic_name", "max_message_id", "message_count"
+                )
+            ),
+            [("dinner", other_id, 1)],
+        )
+
+        # A summary whose message_count is wrong is deleted once its
+        # topic has no messages left.
+        StreamTopic.objects.filter(recipient_id=stream.recipient_id).update(message_count=2)
+        do_delete_messages(iago.realm, [Message.objects.get(id=first_id)])
+        self.assertEqual(get_summaries(), [])
+
+    def test_topics_history_search_and_pagination(self) -> None:
+        iago = self.example_user("iago")
+        self.login_user(iago)
+        stream = self.make_stream("topic search")
+        self.subscribe(iago, stream.name)
+
+        topic_ids = {}
+        for topic_name in ["Design review", "lunch", "design docs", "release"]:
+            topic_ids[topic_name] = self.send_stream_message(
+                iago, stream.name, topic_name=topic_name
+            )
+
+        endpoint = f"/json/users/me/{stream.id}/topics"
+
+        def get_topic_names(params: Dict[str, object]) -> List[str]:
+            result = self.client_get(endpoint, params)
+            return [topic["name"] for topic in self.assert_json_success(result)["topics"]]
+
+        self.assertEqual(
+            get_topic_names({}), ["release", "design docs", "lunch", "Design review"]
+        )
+        self.assertEqual(get_topic_names({"query": "DESIGN"}), ["design docs", "Design review"])
+        self.assertEqual(get_topic_names({"query": "design", "limit": 1}), ["design docs"])
+        self.assertEqual(get_topic_names({"limit": 2}), ["release", "design docs"])
+        self.assertEqual(
+            get_topic_names({"limit": 2, "before_max_id": topic_ids["design docs"]}),
+            ["lunch", "Design review"],
+        )
+
+        # Streams with protected history filter the topics the user
+        # has access to in the same way.
+        do_change_stream_permission(
+            stream,
+            invite_only=True,
+            history_public_to_subscribers=False,
+            is_web_public=False,
+            acting_user=iago,
+        )
+        self.assertEqual(get_topic_names({"query": "DESIGN"}), ["design docs", "Design review"])
+        self.assertEqual(
+            get_topic_names({"limit": 2, "before_max_id": topic_ids["design docs"]}),
+            ["lunch", "Design review"],
+        )
+
     def test_bad_stream_id(self) -> None:
         self.login("iago")
 
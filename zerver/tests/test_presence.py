@@ -231,6 +231,48 @@ class UserPresenceTests(ZulipTestCase):
             othello_info["active_timestamp"],
         )
 
+    def test_last_update_id(self) -> None:
+        hamlet = self.example_user("hamlet")
+        othello = self.example_user("othello")
+
+        self.login_user(hamlet)
+        params = dict(status="idle", slim_presence="true", last_update_id="-1")
+        result = self.client_post("/json/users/me/presence", params)
+        json = self.assert_json_success(result)
+        self.assertEqual(set(json["presences"].keys()), {str(hamlet.id)})
+        last_update_id = json["presence_last_update_id"]
+        self.assertEqual(
+            last_update_id, UserPresence.objects.get(user_profile=hamlet).last_update_id
+        )
+
+        # Nothing has changed since the last request.
+        params = dict(status="idle", slim_presence="true", last_update_id=str(last_update_id))
+        result = self.client_post("/json/users/me/presence", params)
+        json = self.assert_json_success(result)
+        self.assertEqual(json["presences"], {})
+        self.assertEqual(json["presence_last_update_id"], last_update_id)
+
+        self.login_user(othello)
+        result = self.client_post("/json/users/me/presence", dict(status="active"))
+        self.assert_json_success(result)
+
+        # Only othello's presence is sent again.
+        self.login_user(hamlet)
+        result = self.client_post("/json/users/me/presence", params)
+        json = self.assert_json_success(result)
+        self.assertEqual(set(json["presences"].keys()), {str(othello.id)})
+        self.assertGreater(json["presence_last_update_id"], last_update_id)
+        self.assertEqual(
+            json["presence_last_update_id"],
+            UserPresence.objects.get(user_profile=othello).last_update_id,
+        )
+
+        # Without the parameter, all presence data is sent as before.
+        result = self.client_post("/json/users/me/presence", dict(status="idle"))
+        json = self.assert_json_success(result)
+        self.assertEqual(set(json["presences"].keys()), {hamlet.email, othello.email})
+        self.assertNotIn("presence_last_update_id", json)
+
     @mock.patch("stripe.Customer.list", return_value=[])
     def test_new_user_input(self, unused_mock: mock.Mock) -> None:
         """Mostly a test for UserActivityInterval"""
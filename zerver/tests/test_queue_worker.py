@@ -18,12 +18,17 @@ from typing_extensions import TypeAlias, override
 from zerver.lib.email_mirror import RateLimitedRealmMirror
 from zerver.lib.email_mirror_helpers import encode_email_address
 from zerver.lib.queue import MAX_REQUEST_RETRIES
-from zerver.lib.rate_limiter import RateLimiterLockingError
 from zerver.lib.remote_server import PushNotificationBouncerRetryLaterError
 from zerver.lib.send_email import EmailNotDeliveredError, FromAddress
 from zerver.lib.test_classes import ZulipTestCase
 from zerver.lib.test_helpers import mock_queue_publish
-from zerver.models import ScheduledMessageNotificationEmail, UserActivity, UserProfile
+from zerver.models import (
+    ScheduledMessageNotificationEmail,
+    UserActivity,
+    UserActivityInterval,
+    UserPresence,
+    UserProfile,
+)
 from zerver.models.clients import get_client
 from zerver.models.realms import get_realm
 from zerver.models.scheduled_jobs import NotificationTriggers
@@ -36,6 +41,8 @@ from zerver.worker.embed_links import FetchLinksEmbedData
 from zerver.worker.missedmessage_emails import MissedMessageWorker
 from zerver.worker.missedmessage_mobile_notifications import PushNotificationsWorker
 from zerver.worker.user_activity import UserActivityWorker
+from zerver.worker.user_activity_interval import UserActivityIntervalWorker
+from zerver.worker.user_presence import UserPresenceWorker
 
 Event: TypeAlias = Dict[str, Any]
 
@@ -211,6 +218,138 @@ class WorkerTest(ZulipTestCase):
             activity_records[4].last_visit, datetime.fromtimestamp(now + 45, tz=timezone.utc)
         )
 
+    def test_user_presence_worker(self) -> None:
+        fake_client = FakeClient()
+
+        hamlet = self.example_user("hamlet")
+        iago = self.example_user("iago")
+        now = datetime(year=2024, month=1, day=1, tzinfo=timezone.utc)
+        UserPresence.objects.filter(user_profile=hamlet).delete()
+        UserPresence.objects.update_or_create(
+            user_profile=iago,
+            defaults=dict(
+                realm_id=iago.realm_id,
+                last_active_time=now - timedelta(hours=1),
+                last_connected_time=now - timedelta(hours=1),
+            ),
+        )
+
+        # Hamlet has no presence row yet, and sends several updates,
+        # only some of which are far enough apart to be recorded.
+        for seconds, status in [
+            (0, UserPresence.LEGACY_STATUS_ACTIVE_INT),
+            (10, UserPresence.LEGACY_STATUS_IDLE_INT),
+            (100, UserPresence.LEGACY_STATUS_ACTIVE_INT),
+        ]:
+            fake_client.enqueue(
+                "user_presence",
+                dict(
+                    user_profile_id=hamlet.id,
+                    client="website",
+                    time=(now + timedelta(seconds=seconds)).timestamp(),
+                    status=status,
+                ),
+            )
+        # Iago comes back online after an hour away.
+        fake_client.enqueue(
+            "user_presence",
+            dict(
+                user_profile_id=iago.id,
+                client="website",
+                time=now.timestamp(),
+                status=UserPresence.LEGACY_STATUS_ACTIVE_INT,
+            ),
+        )
+
+        # Besides fetching the users and their presence rows, this is
+        # a single upsert statement.
+        with simulated_queue_client(fake_client):
+            worker = UserPresenceWorker()
+            worker.setup()
+            with self.capture_send_event_calls(expected_num_events=2) as events:
+                with self.assert_database_query_count(3):
+                    worker.start()
+        self.assertEqual({event["event"]["user_id"] for event in events}, {hamlet.id, iago.id})
+
+        hamlet_presence = UserPresence.objects.get(user_profile=hamlet)
+        self.assertEqual(hamlet_presence.last_active_time, now + timedelta(seconds=100))
+        self.assertEqual(hamlet_presence.last_connected_time, now + timedelta(seconds=100))
+        iago_presence = UserPresence.objects.get(user_profile=iago)
+        self.assertEqual(iago_presence.last_active_time, now)
+        self.assertEqual(iago_presence.last_connected_time, now)
+
+        # An update that is too soon after the last one changes nothing.
+        fake_client.enqueue(
+            "user_presence",
+            dict(
+                user_profile_id=iago.id,
+                client="website",
+                time=(now + timedelta(seconds=10)).timestamp(),
+                status=UserPresence.LEGACY_STATUS_ACTIVE_INT,
+            ),
+        )
+        with simulated_queue_client(fake_client):
+            worker = UserPresenceWorker()
+            worker.setup()
+            with self.capture_send_event_calls(expected_num_events=0):
+                with self.assert_database_query_count(2):
+                    worker.start()
+        iago_presence = UserPresence.objects.get(user_profile=iago)
+        self.assertEqual(iago_presence.last_active_time, now)
+
+    def test_user_activity_interval_worker(self) -> None:
+        fake_client = FakeClient()
+
+        hamlet = self.example_user("hamlet")
+        iago = self.example_user("iago")
+        now = datetime(year=2024, month=1, day=1, tzinfo=timezone.utc)
+        UserActivityInterval.objects.filter(user_profile_id__in=[hamlet.id, iago.id]).delete()
+        UserActivityInterval.objects.create(
+            user_profile=hamlet, start=now - timedelta(minutes=10), end=now + timedelta(minutes=5)
+        )
+
+        # Hamlet's first two events extend the existing interval, and
+        # the last starts a new one; Iago's events, queued out of
+        # order, make a single new interval.
+        for user_profile, minutes in [
+            (hamlet, 0),
+            (iago, 1),
+            (hamlet, 10),
+            (iago, 0),
+            (hamlet, 180),
+        ]:
+            fake_client.enqueue(
+                "user_activity_interval",
+                dict(
+                    user_profile_id=user_profile.id,
+                    time=(now + timedelta(minutes=minutes)).timestamp(),
+                ),
+            )
+
+        with simulated_queue_client(fake_client):
+            worker = UserActivityIntervalWorker()
+            worker.setup()
+            with self.assert_database_query_count(3):
+                worker.start()
+
+        self.assertEqual(
+            list(
+                UserActivityInterval.objects.filter(user_profile=hamlet)
+                .order_by("start")
+                .values_list("start", "end")
+            ),
+            [
+                (now - timedelta(minutes=10), now + timedelta(minutes=25)),
+                (now + timedelta(minutes=180), now + timedelta(minutes=195)),
+            ],
+        )
+        self.assertEqual(
+            list(
+                UserActivityInterval.objects.filter(user_profile=iago).values_list("start", "end")
+            ),
+            [(now, now + timedelta(minutes=16))],
+        )
+
     def test_missed_message_worker(self) -> None:
         cordelia = self.example_user("cordelia")
         hamlet = self.example_user("hamlet")
@@ -621,28 +760,12 @@ class WorkerTest(ZulipTestCase):
                 fake_client.enqueue("email_mirror", data[0])
                 worker.start()
                 self.assertEqual(mock_mirror_email.call_count, 4)
-
-                # If RateLimiterLockingError is thrown, we rate-limit the new message:
-                with patch(
-                    "zerver.lib.rate_limiter.RedisRateLimiterBackend.incr_ratelimit",
-                    side_effect=RateLimiterLockingError,
-                ):
-                    with self.assertLogs("zerver.lib.rate_limiter", "WARNING") as mock_warn:
-                        fake_client.enqueue("email_mirror", data[0])
-                        worker.start()
-                        self.assertEqual(mock_mirror_email.call_count, 4)
-                        self.assertEqual(
-                            mock_warn.output,
-                            [
-                                "WARNING:zerver.lib.rate_limiter:Deadlock trying to incr_ratelimit for RateLimitedRealmMirror:zulip"
-                            ],
-                        )
         self.assertEqual(
             warn_logs.output,
             [
                 "WARNING:zerver.worker.email_mirror:MirrorWorker: Rejecting an email from: None to realm: zulip - rate limited."
             ]
-            * 5,
+            * 4,
         )
 
     def test_email_sending_worker_retries(self) -> None:
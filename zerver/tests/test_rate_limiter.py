@@ -13,6 +13,7 @@ from zerver.lib.rate_limiter import (
     RateLimiterBackend,
     RedisRateLimiterBackend,
     TornadoInMemoryRateLimiterBackend,
+    client,
 )
 from zerver.lib.test_classes import ZulipTestCase
 from zerver.lib.test_helpers import ratelimit_rule
@@ -182,6 +183,18 @@ class RedisRateLimiterBackendTest(RateLimiterBackendBase):
         obj.block_access(1)
         self.make_request(obj, expect_ratelimited=True, verify_api_calls_left=False)
 
+    def test_script_reloaded(self) -> None:
+        obj = self.create_object("test", [(2, 5)])
+        start_time = time.time()
+        with mock.patch("time.time", return_value=start_time):
+            self.make_request(obj)
+
+        # If Redis restarts, it forgets the script, which is then
+        # loaded again.
+        client.script_flush()
+        with mock.patch("time.time", return_value=start_time + 0.1):
+            self.make_request(obj)
+
 
 class TornadoInMemoryRateLimiterBackendTest(RateLimiterBackendBase):
     backend = TornadoInMemoryRateLimiterBackend
@@ -225,6 +238,48 @@ class TornadoInMemoryRateLimiterBackendTest(RateLimiterBackendBase):
         with mock.patch("time.time", return_value=start_time + 1.01):
             self.make_request(obj, expect_ratelimited=False, verify_api_calls_left=False)
 
+    @mock.patch.object(TornadoInMemoryRateLimiterBackend, "GC_BATCH_SIZE", 2)
+    @mock.patch.object(TornadoInMemoryRateLimiterBackend, "reset_times", {})
+    def test_garbage_collection(self) -> None:
+        objs = [self.create_object(f"test{i}", [(2, 5)]) for i in range(3)]
+        start_time = time.time()
+        for i, obj in enumerate(objs):
+            with mock.patch("time.time", return_value=start_time + i * 0.1):
+                self.make_request(obj)
+
+        # Collection stops at the first key which has not expired.
+        with mock.patch("time.time", return_value=start_time + 0.45):
+            self.make_request(objs[0])
+        reset_times = TornadoInMemoryRateLimiterBackend.reset_times[(2, 5)]
+        self.assertEqual(list(reset_times), [objs[1].key(), objs[2].key(), objs[0].key()])
+
+        # All three keys have expired, but each request only collects
+        # up to GC_BATCH_SIZE of them.
+        with mock.patch("time.time", return_value=start_time + 1):
+            self.make_request(objs[2])
+        self.assertEqual(list(reset_times), [objs[0].key(), objs[2].key()])
+
+    @mock.patch.object(TornadoInMemoryRateLimiterBackend, "MAX_KEYS_PER_RULE", 2)
+    @mock.patch.object(TornadoInMemoryRateLimiterBackend, "OVERFLOW_BUCKETS", 1)
+    @mock.patch.object(TornadoInMemoryRateLimiterBackend, "reset_times", {})
+    def test_max_keys_per_rule(self) -> None:
+        objs = [self.create_object(f"test{i}", [(3, 3)]) for i in range(4)]
+        start_time = time.time()
+        with mock.patch("time.time", return_value=start_time):
+            self.make_request(objs[0])
+            self.make_request(objs[1])
+
+            # Further keys share the single overflow bucket.
+            self.make_request(objs[2], verify_api_calls_left=False)
+            self.make_request(objs[3], verify_api_calls_left=False)
+            self.make_request(objs[3], verify_api_calls_left=False)
+            self.make_request(objs[2], expect_ratelimited=True, verify_api_calls_left=False)
+            self.assertEqual(objs[3].api_calls_left(), (0, 3.0))
+
+            self.make_request(objs[0])
+        reset_times = TornadoInMemoryRateLimiterBackend.reset_times[(3, 3)]
+        self.assertEqual(list(reset_times), [objs[1].key(), "overflow:0", objs[0].key()])
+
 
 class RateLimitedObjectsTest(ZulipTestCase):
     def test_user_rate_limits(self) -> None:
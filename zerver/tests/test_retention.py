@@ -17,6 +17,7 @@ from zerver.lib.retention import (
     archive_messages,
     clean_archived_data,
     get_realms_and_streams_for_archiving,
+    move_expired_messages_to_archive_by_recipient,
     move_messages_to_archive,
     restore_all_data_from_archive,
     restore_retention_policy_deletions_for_stream,
@@ -361,6 +362,41 @@ class TestArchiveMessagesGeneral(ArchiveMessagesTestingBase):
                 set(expired_usermsg_ids),
             )
 
+    def test_resuming_interrupted_archiving(self) -> None:
+        expired_mit_msg_ids = self._make_mit_messages(
+            5,
+            timezone_now() - timedelta(days=MIT_REALM_DAYS + 1),
+        )
+        expired_zulip_msg_ids = self._make_expired_zulip_messages(7)
+        expired_msg_ids = expired_mit_msg_ids + expired_zulip_msg_ids
+        expired_usermsg_ids = self._get_usermessage_ids(expired_msg_ids)
+        stream_count = sum(len(streams) for _, streams in get_realms_and_streams_for_archiving())
+
+        # Interrupt the run at the first realm's personal messages,
+        # which are archived after that realm's streams.
+        with mock.patch(
+            "zerver.lib.retention.move_expired_personal_and_huddle_messages_to_archive",
+            side_effect=Exception("interrupted"),
+        ), self.assertRaisesRegex(Exception, r"^interrupted$"):
+            archive_messages()
+
+        with mock.patch(
+            "zerver.lib.retention.move_expired_messages_to_archive_by_recipient",
+            wraps=move_expired_messages_to_archive_by_recipient,
+        ) as m, self.assertLogs("zulip.retention", level="INFO") as logs:
+            archive_messages()
+        self.assertLess(m.call_count, stream_count)
+        self.assertIn("Resuming interrupted archiving run", logs.output[1])
+        self._verify_archive_data(expired_msg_ids, expired_usermsg_ids)
+
+        # The run finished, so the next one starts from scratch.
+        with mock.patch(
+            "zerver.lib.retention.move_expired_messages_to_archive_by_recipient",
+            wraps=move_expired_messages_to_archive_by_recipient,
+        ) as m:
+            archive_messages()
+        self.assertEqual(m.call_count, stream_count)
+
     def test_archive_message_tool(self) -> None:
         """End-to-end test of the archiving tool, directly calling
         archive_messages."""
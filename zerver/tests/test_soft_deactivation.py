@@ -1,12 +1,21 @@
-from typing import AbstractSet
+from typing import AbstractSet, Any
 from unittest import mock
 
+import orjson
+from django.db import connection, transaction
 from django.utils.timezone import now as timezone_now
 
 from zerver.actions.alert_words import do_add_alert_words
+from zerver.actions.streams import (
+    do_change_stream_permission,
+    do_change_stream_sparse_user_messages,
+)
 from zerver.lib.mention import stream_wildcards
+from zerver.lib.narrow import FetchedMessages, fetch_messages
 from zerver.lib.soft_deactivation import (
+    SPARSE_STREAM_MATERIALIZATION_MARGIN,
     add_missing_messages,
+    add_missing_sparse_stream_messages,
     do_auto_soft_deactivate_users,
     do_catch_up_soft_deactivated_users,
     do_soft_activate_users,
@@ -200,6 +209,34 @@ class UserSoftDeactivationTests(ZulipTestCase):
             self.assertTrue(user.long_term_idle)
             self.assertEqual(user.last_active_message_id, message_id)
 
+    def test_do_catch_up_users_in_background(self) -> None:
+        stream = "Verona"
+        hamlet = self.example_user("hamlet")
+        iago = self.example_user("iago")
+        for user in [hamlet, iago]:
+            self.subscribe(user, stream)
+
+        with self.assertLogs(logger_string, level="INFO"):
+            do_soft_deactivate_users([iago])
+        message_id = self.send_stream_message(hamlet, stream, "Hello world!")
+        self.assertFalse(
+            UserMessage.objects.filter(user_profile=iago, message_id=message_id).exists()
+        )
+
+        # In tests, the deferred_work queue processor runs immediately.
+        with self.assertLogs(logger_string, level="INFO") as m:
+            users_queued = do_catch_up_soft_deactivated_users([hamlet, iago], in_background=True)
+        self.assertEqual(users_queued, [iago])
+        self.assertEqual(
+            m.output, [f"INFO:{logger_string}:Queued catching up 1 soft-deactivated users"]
+        )
+        self.assertTrue(
+            UserMessage.objects.filter(user_profile=iago, message_id=message_id).exists()
+        )
+        iago.refresh_from_db()
+        self.assertTrue(iago.long_term_idle)
+        self.assertEqual(iago.last_active_message_id, message_id)
+
     def test_do_auto_soft_deactivate_users(self) -> None:
         users = [
             self.example_user("iago"),
@@ -322,7 +359,7 @@ class SoftDeactivationMessageTest(ZulipTestCase):
         idle_user_msg_list = get_user_messages(long_term_idle_user)
         idle_user_msg_count = len(idle_user_msg_list)
         self.assertNotEqual(idle_user_msg_list[-1].content, message)
-        with self.assert_database_query_count(7):
+        with self.assert_database_query_count(4):
             reactivate_user_if_soft_deactivated(long_term_idle_user)
         self.assertFalse(long_term_idle_user.long_term_idle)
         self.assertEqual(
@@ -383,7 +420,7 @@ class SoftDeactivationMessageTest(ZulipTestCase):
         idle_user_msg_list = get_user_messages(long_term_idle_user)
         idle_user_msg_count = len(idle_user_msg_list)
         self.assertNotEqual(idle_user_msg_list[-1], sent_message)
-        with self.assert_database_query_count(5):
+        with self.assert_database_query_count(2):
             add_missing_messages(long_term_idle_user)
         idle_user_msg_list = get_user_messages(long_term_idle_user)
         self.assert_length(idle_user_msg_list, idle_user_msg_count + 1)
@@ -399,7 +436,7 @@ class SoftDeactivationMessageTest(ZulipTestCase):
         idle_user_msg_list = get_user_messages(long_term_idle_user)
         idle_user_msg_count = len(idle_user_msg_list)
         self.assertNotEqual(idle_user_msg_list[-1], sent_message)
-        with self.assert_database_query_count(5):
+        with self.assert_database_query_count(2):
             add_missing_messages(long_term_idle_user)
         idle_user_msg_list = get_user_messages(long_term_idle_user)
         self.assert_length(idle_user_msg_list, idle_user_msg_count + 1)
@@ -423,7 +460,7 @@ class SoftDeactivationMessageTest(ZulipTestCase):
         idle_user_msg_count = len(idle_user_msg_list)
         for sent_message in sent_message_list:
             self.assertNotEqual(idle_user_msg_list.pop(), sent_message)
-        with self.assert_database_query_count(5):
+        with self.assert_database_query_count(2):
             add_missing_messages(long_term_idle_user)
         idle_user_msg_list = get_user_messages(long_term_idle_user)
         self.assert_length(idle_user_msg_list, idle_user_msg_count + 2)
@@ -454,7 +491,7 @@ class SoftDeactivationMessageTest(ZulipTestCase):
         idle_user_msg_count = len(idle_user_msg_list)
         for sent_message in sent_message_list:
             self.assertNotEqual(idle_user_msg_list.pop(), sent_message)
-        with self.assert_database_query_count(5):
+        with self.assert_database_query_count(2):
             add_missing_messages(long_term_idle_user)
         idle_user_msg_list = get_user_messages(long_term_idle_user)
         self.assert_length(idle_user_msg_list, idle_user_msg_count + 2)
@@ -486,9 +523,9 @@ class SoftDeactivationMessageTest(ZulipTestCase):
         idle_user_msg_list = get_user_messages(long_term_idle_user)
         idle_user_msg_count = len(idle_user_msg_list)
         self.assertEqual(idle_user_msg_list[-1].id, sent_message_id)
-        # There are no streams to fetch missing messages from, so
-        # the Message.objects query will be avoided.
-        with self.assert_database_query_count(3):
+        # There are no messages to add, so we don't need to update
+        # last_active_message_id.
+        with self.assert_database_query_count(1):
             add_missing_messages(long_term_idle_user)
         idle_user_msg_list = get_user_messages(long_term_idle_user)
         # No new UserMessage rows should have been created.
@@ -514,7 +551,7 @@ class SoftDeactivationMessageTest(ZulipTestCase):
         idle_user_msg_count = len(idle_user_msg_list)
         for sent_message in sent_message_list:
             self.assertNotEqual(idle_user_msg_list.pop(), sent_message)
-        with self.assert_database_query_count(5):
+        with self.assert_database_query_count(2):
             add_missing_messages(long_term_idle_user)
         idle_user_msg_list = get_user_messages(long_term_idle_user)
         self.assert_length(idle_user_msg_list, idle_user_msg_count + 2)
@@ -551,7 +588,8 @@ class SoftDeactivationMessageTest(ZulipTestCase):
 
         idle_user_msg_list = get_user_messages(long_term_idle_user)
         idle_user_msg_count = len(idle_user_msg_list)
-        with self.assert_database_query_count(9):
+        # Each batch of 2 rows takes an INSERT and an UPDATE.
+        with self.assert_database_query_count(6):
             add_missing_messages(long_term_idle_user)
         idle_user_msg_list = get_user_messages(long_term_idle_user)
         self.assert_length(idle_user_msg_list, idle_user_msg_count + num_new_messages)
@@ -780,3 +818,208 @@ class SoftDeactivationMessageTest(ZulipTestCase):
         # Sanity check after removing the alert word for Hamlet.
         AlertWord.objects.filter(user_profile=long_term_idle_user).delete()
         assert_stream_message_not_sent_to_idle_user("no alert words")
+
+    def test_sparse_user_messages(self) -> None:
+        hamlet = self.example_user("hamlet")
+        cordelia = self.example_user("cordelia")
+        othello = self.example_user("othello")
+        iago = self.example_user("iago")
+        stream_name = "Announcements"
+        stream = self.make_stream(stream_name)
+        for user_profile in [hamlet, cordelia, iago]:
+            self.subscribe(user_profile, stream_name)
+        assert stream.recipient_id is not None
+
+        dense_message_id = self.send_stream_message(iago, stream_name)
+        do_change_stream_sparse_user_messages(stream, True, acting_user=None)
+
+        # Only rows with nondefault flags are created at send time.
+        message_ids = [
+            self.send_stream_message(iago, stream_name, "Welcome"),
+            self.send_stream_message(iago, stream_name, "Hi @**King Hamlet**"),
+        ]
+        self.assertFalse(
+            UserMessage.objects.filter(user_profile=cordelia, message_id__in=message_ids).exists()
+        )
+        self.assertEqual(
+            UserMessage.objects.get(user_profile=hamlet, message_id=message_ids[1]).flags_list(),
+            ["mentioned"],
+        )
+        self.assertFalse(
+            UserMessage.objects.filter(user_profile=hamlet, message_id=message_ids[0]).exists()
+        )
+
+        # A late subscriber doesn't get rows for earlier messages.
+        self.subscribe(othello, stream_name)
+        later_message_id = self.send_stream_message(iago, stream_name, "Later")
+
+        add_missing_sparse_stream_messages(hamlet)
+        self.assertEqual(
+            UserMessage.objects.get(user_profile=hamlet, message_id=message_ids[0]).flags_list(),
+            [],
+        )
+        self.assertEqual(
+            UserMessage.objects.get(user_profile=hamlet, message_id=message_ids[1]).flags_list(),
+            ["mentioned"],
+        )
+        # Recent messages are checked again on later calls, in case
+        # one with a lower ID was still being sent.
+        self.assertEqual(
+            get_subscription(stream_name, hamlet).last_materialized_message_id, dense_message_id
+        )
+        Message.objects.filter(recipient_id=stream.recipient_id).update(
+            date_sent=timezone_now() - SPARSE_STREAM_MATERIALIZATION_MARGIN
+        )
+        add_missing_sparse_stream_messages(hamlet)
+        self.assertEqual(
+            get_subscription(stream_name, hamlet).last_materialized_message_id, later_message_id
+        )
+        # With nothing new to add, this is just a few reads.
+        with self.assert_database_query_count(3):
+            add_missing_sparse_stream_messages(hamlet)
+
+        add_missing_sparse_stream_messages(othello)
+        self.assertEqual(
+            set(
+                UserMessage.objects.filter(
+                    user_profile=othello, message__recipient_id=stream.recipient_id
+                ).values_list("message_id", flat=True)
+            ),
+            {later_message_id},
+        )
+
+        # Missing rows are unread, rather than historical, when
+        # changing flags.
+        result = self.api_post(
+            cordelia,
+            "/api/v1/messages/flags",
+            {"messages": orjson.dumps(message_ids).decode(), "op": "add", "flag": "read"},
+        )
+        self.assert_json_success(result)
+        for message_id in message_ids:
+            self.assertEqual(
+                UserMessage.objects.get(user_profile=cordelia, message_id=message_id).flags_list(),
+                ["read"],
+            )
+
+        # Turning the mode off queues creating any remaining deferred
+        # rows; until then, they are still created on demand.
+        last_message_id = self.send_stream_message(iago, stream_name, "Last")
+        with mock.patch("zerver.actions.streams.queue_event_on_commit") as m:
+            do_change_stream_sparse_user_messages(stream, False, acting_user=None)
+        m.assert_called_once_with(
+            "deferred_work", {"type": "materialize_sparse_stream_messages", "stream_id": stream.id}
+        )
+        self.assertTrue(stream.has_deferred_user_messages)
+        self.assertFalse(
+            UserMessage.objects.filter(user_profile=hamlet, message_id=last_message_id).exists()
+        )
+        add_missing_sparse_stream_messages(hamlet)
+        self.assertTrue(
+            UserMessage.objects.filter(user_profile=hamlet, message_id=last_message_id).exists()
+        )
+
+        # Turning the mode back on before then keeps track of the
+        # rows which are still deferred.
+        do_change_stream_sparse_user_messages(stream, True, acting_user=None)
+        cordelia_subscription = get_subscription(stream_name, cordelia)
+        assert cordelia_subscription.last_materialized_message_id is not None
+        self.assertLess(cordelia_subscription.last_materialized_message_id, last_message_id)
+
+        # The deferred_work queue creates the rest of the rows.
+        with self.captureOnCommitCallbacks(execute=True):
+            do_change_stream_sparse_user_messages(stream, False, acting_user=None)
+        stream.refresh_from_db()
+        self.assertFalse(stream.has_deferred_user_messages)
+        for user_profile in [hamlet, cordelia, othello]:
+            self.assertTrue(
+                UserMessage.objects.filter(
+                    user_profile=user_profile, message_id=last_message_id
+                ).exists()
+            )
+            subscription = get_subscription(stream_name, user_profile)
+            self.assertIsNone(subscription.last_materialized_message_id)
+        self.assertTrue(
+            UserMessage.objects.filter(user_profile=cordelia, message_id=dense_message_id).exists()
+        )
+
+        # Realms without sparse streams only need to check the cache.
+        add_missing_sparse_stream_messages(hamlet)
+        with self.assert_database_query_count(0):
+            add_missing_sparse_stream_messages(hamlet)
+
+        # Making the stream's history private turns the mode off.
+        do_change_stream_sparse_user_messages(stream, True, acting_user=None)
+        do_change_stream_permission(
+            stream,
+            invite_only=True,
+            history_public_to_subscribers=False,
+            is_web_public=False,
+            acting_user=iago,
+        )
+        stream.refresh_from_db()
+        self.assertFalse(stream.sparse_user_messages)
+
+    def test_sparse_user_messages_moved_out_of_stream(self) -> None:
+        cordelia = self.example_user("cordelia")
+        iago = self.example_user("iago")
+        stream_name = "Announcements"
+        stream = self.make_stream(stream_name)
+        new_stream = self.make_stream("Archive")
+        for user_profile in [cordelia, iago]:
+            self.subscribe(user_profile, stream_name)
+            self.subscribe(user_profile, new_stream.name)
+        do_change_stream_sparse_user_messages(stream, True, acting_user=None)
+        message_id = self.send_stream_message(iago, stream_name, "Welcome")
+        self.assertFalse(
+            UserMessage.objects.filter(user_profile=cordelia, message_id=message_id).exists()
+        )
+
+        # The deferred rows are created before the message leaves the
+        # stream, so it is still unread in its new stream.
+        result = self.api_patch(
+            iago,
+            f"/api/v1/messages/{message_id}",
+            {"stream_id": new_stream.id, "propagate_mode": "change_all"},
+        )
+        self.assert_json_success(result)
+        self.assertEqual(
+            UserMessage.objects.get(user_profile=cordelia, message_id=message_id).flags_list(),
+            [],
+        )
+
+    def test_sparse_user_messages_fetched_outside_read_only_transaction(self) -> None:
+        hamlet = self.example_user("hamlet")
+        iago = self.example_user("iago")
+        stream_name = "Announcements"
+        stream = self.make_stream(stream_name)
+        for user_profile in [hamlet, iago]:
+            self.subscribe(user_profile, stream_name)
+        do_change_stream_sparse_user_messages(stream, True, acting_user=None)
+        message_id = self.send_stream_message(iago, stream_name, "Welcome")
+        self.assertFalse(
+            UserMessage.objects.filter(user_profile=hamlet, message_id=message_id).exists()
+        )
+
+        # In production, fetch_messages runs in a read-only
+        # transaction, which tests otherwise skip; so we make it
+        # read-only here, which fails if it writes anything.
+        def read_only_fetch_messages(**kwargs: Any) -> FetchedMessages:
+            with transaction.atomic():
+                with connection.cursor() as cursor:
+                    cursor.execute("SET TRANSACTION READ ONLY")
+                query_info = fetch_messages(**kwargs)
+                transaction.set_rollback(True)
+            return query_info
+
+        self.login_user(hamlet)
+        with mock.patch(
+            "zerver.views.message_fetch.fetch_messages", side_effect=read_only_fetch_messages
+        ) as m:
+            messages = self.get_messages(anchor=message_id, num_before=0, num_after=0)
+        m.assert_called_once()
+        self.assertEqual([message["id"] for message in messages], [message_id])
+        self.assertEqual(messages[0]["flags"], [])
+        self.assertTrue(
+            UserMessage.objects.filter(user_profile=hamlet, message_id=message_id).exists()
+        )
@@ -4,6 +4,7 @@ import copy
 import logging
 import os
 import random
+import struct
 import time
 import traceback
 import uuid
@@ -11,6 +12,7 @@ from collections import deque
 from contextlib import suppress
 from functools import cache
 from typing import (
+    IO,
     AbstractSet,
     Any,
     Callable,
@@ -18,6 +20,7 @@ from typing import (
     Deque,
     Dict,
     Iterable,
+    Iterator,
     List,
     Literal,
     Mapping,
@@ -42,7 +45,12 @@ from version import API_FEATURE_LEVEL, ZULIP_MERGE_BASE, ZULIP_VERSION
 from zerver.lib.exceptions import JsonableError
 from zerver.lib.message_cache import MessageDict
 from zerver.lib.narrow_helpers import narrow_dataclasses_from_tuples
-from zerver.lib.narrow_predicate import build_narrow_predicate
+from zerver.lib.narrow_predicate import (
+    NarrowIndexKey,
+    build_narrow_predicate,
+    get_narrow_index_key,
+    get_stream_message_index_keys,
+)
 from zerver.lib.notification_data import UserMessageNotificationsData
 from zerver.lib.queue import queue_json_publish, retry_event
 from zerver.middleware import async_request_timer_restart
@@ -70,6 +78,14 @@ MAX_QUEUE_TIMEOUT_SECS = 7 * 24 * 60 * 60
 # wireless routers that kill "inactive" http connections.
 HEARTBEAT_MIN_FREQ_SECS = 45
 
+# Event queues are persisted across restarts as a stream of
+# length-prefixed records, one per client, following this magic
+# header.  This lets us write and read the snapshot incrementally,
+# rather than serializing every queue into a single giant JSON blob.
+# Files without the header are in the legacy single-JSON-array format.
+EVENT_QUEUE_SNAPSHOT_MAGIC = b"ZULIPEQ\x01"
+EVENT_QUEUE_SNAPSHOT_RECORD_HEADER = struct.Struct("!I")
+
 
 def create_heartbeat_event() -> Dict[str, str]:
     return dict(type="heartbeat")
@@ -119,6 +135,7 @@ class ClientDescriptor:
         self._timeout_handle: Any = None  # TODO: should be return type of ioloop.call_later
         self.narrow = narrow
         self.narrow_predicate = build_narrow_predicate(modern_narrow)
+        self.narrow_index_key = get_narrow_index_key(modern_narrow)
         self.bulk_message_deletion = bulk_message_deletion
         self.stream_typing_notifications = stream_typing_notifications
         self.user_settings_object = user_settings_object
@@ -265,6 +282,7 @@ class ClientDescriptor:
         self.current_client_name = client_name
         set_descriptor_by_handler_id(handler_id, self)
         self.last_connection_time = time.time()
+        note_event_queue_changed(self.event_queue.id)
 
         def timeout_callback() -> None:
             self._timeout_handle = None
@@ -325,6 +343,11 @@ class EventQueue:
         self.newest_pruned_id: Optional[int] = -1
         self.id: str = id
         self.virtual_events: Dict[str, Dict[str, Any]] = {}
+        # Index of the pending flag updates stored in virtual_events:
+        # maps each flag to {message_id: full event type of the last
+        # update to that flag for that message}.  This is derived from
+        # virtual_events, and thus not serialized.
+        self.virtual_flag_updates: Dict[str, Dict[int, str]] = {}
 
     def to_dict(self) -> Dict[str, Any]:
         # If you add a new key to this dict, make sure you add appropriate
@@ -347,6 +370,11 @@ class EventQueue:
         ret.newest_pruned_id = d.get("newest_pruned_id")
         ret.queue = deque(d["queue"])
         ret.virtual_events = d.get("virtual_events", {})
+        for virtual_event in sorted(ret.virtual_events.values(), key=lambda e: e["id"]):
+            flag_updates = ret.virtual_flag_updates.setdefault(virtual_event["flag"], {})
+            full_event_type = compute_full_event_type(virtual_event)
+            for message_id in virtual_event["messages"]:
+                flag_updates[message_id] = full_event_type
         return ret
 
     def push(self, orig_event: Mapping[str, Any]) -> None:
@@ -359,37 +387,120 @@ class EventQueue:
         event = dict(orig_event)
         event["id"] = self.next_event_id
         self.next_event_id += 1
+        note_event_queue_changed(self.id)
         full_event_type = compute_full_event_type(event)
-        if full_event_type.startswith("flags/") and not full_event_type.startswith(
-            "flags/remove/read"
-        ):
-            # virtual_events are an optimization that allows certain
-            # simple events, such as update_message_flags events that
-            # simply contain a list of message IDs to operate on, to
-            # be compressed together. This is primarily useful for
-            # flags/add/read, where normal Zulip usage will result in
-            # many small flags/add/read events as users scroll.
-            #
-            # We need to exclude flags/remove/read, because it has an
-            # extra message_details field that cannot be compressed.
-            #
-            # BUG: This compression algorithm is incorrect in the
-            # presence of mark-as-unread, since it does not respect
-            # the ordering of "mark as read" and "mark as unread"
-            # updates for a given message.
-            if full_event_type not in self.virtual_events:
-                self.virtual_events[full_event_type] = copy.deepcopy(event)
-                return
-
-            # Update the virtual event with the values from the event
-            virtual_event = self.virtual_events[full_event_type]
-            virtual_event["id"] = event["id"]
-            virtual_event["messages"] += event["messages"]
-            if "timestamp" in event:
-                virtual_event["timestamp"] = event["timestamp"]
+        if full_event_type.startswith("flags/"):
+            self.push_virtual_flag_event(full_event_type, event)
+            return
 
-        else:
-            self.queue.append(event)
+        if full_event_type.startswith("all_flags/"):
+            # An update to every message must be ordered after any
+            # pending per-message updates to the same flag, so we
+            # place those into the queue proper before this event.
+            self.merge_virtual_events(
+                [
+                    f"flags/add/{event['flag']}",
+                    f"flags/remove/{event['flag']}",
+                ]
+            )
+        elif full_event_type in ("update_message", "delete_message"):
+            # flags/remove/read events carry the stream and topic of
+            # each message, which clients use to file the unread
+            # messages; so pending updates to the read flag must be
+            # delivered before any later move or deletion of messages,
+            # rather than being collapsed past it.
+            self.merge_virtual_events(["flags/add/read", "flags/remove/read"])
+        self.queue.append(event)
+
+    def push_virtual_flag_event(self, full_event_type: str, event: Dict[str, Any]) -> None:
+        # virtual_events are an optimization that allows
+        # update_message_flags events, which simply contain a list of
+        # message IDs to operate on, to be compressed together.  This
+        # is primarily useful for flags/add/read, where normal Zulip
+        # usage will result in many small flags/add/read events as
+        # users scroll.
+        #
+        # We keep at most one pending "add" and one pending "remove"
+        # event for each flag.  Each message ID appears in at most one
+        # of them: the one for the most recent update to that flag for
+        # that message, so interleaved "mark as read" and "mark as
+        # unread" updates are resolved in order, and the size of the
+        # pending events is bounded by the number of distinct messages.
+        flag = event["flag"]
+        flag_updates = self.virtual_flag_updates.setdefault(flag, {})
+        new_messages: List[int] = []
+        overridden_messages: Set[int] = set()
+        for message_id in event["messages"]:
+            previous_event_type = flag_updates.get(message_id)
+            if previous_event_type == full_event_type:
+                continue
+            if previous_event_type is not None:
+                overridden_messages.add(message_id)
+            flag_updates[message_id] = full_event_type
+            new_messages.append(message_id)
+
+        if overridden_messages:
+            opposite_operation = "remove" if event["operation"] == "add" else "add"
+            opposite_event = self.virtual_events[f"flags/{opposite_operation}/{flag}"]
+            opposite_event["messages"] = [
+                message_id
+                for message_id in opposite_event["messages"]
+                if message_id not in overridden_messages
+            ]
+            # flags/remove/read events carry details on each message
+            # needed by clients to update their unread counts.
+            if "message_details" in opposite_event:
+                for message_id in overridden_messages:
+                    opposite_event["message_details"].pop(str(message_id), None)
+
+        if full_event_type not in self.virtual_events:
+            virtual_event = dict(event)
+            virtual_event["messages"] = new_messages
+            if "message_details" in event:
+                virtual_event["message_details"] = dict(event["message_details"])
+            self.virtual_events[full_event_type] = virtual_event
+            return
+
+        # Update the virtual event with the values from the event
+        virtual_event = self.virtual_events[full_event_type]
+        virtual_event["id"] = event["id"]
+        virtual_event["messages"] += new_messages
+        if "message_details" in event:
+            virtual_event["message_details"].update(event["message_details"])
+        if "timestamp" in event:
+            virtual_event["timestamp"] = event["timestamp"]
+
+    def merge_virtual_events(self, full_event_types: Iterable[str]) -> None:
+        """Moves the given virtual events into their final place in the
+        queue, after which they can no longer be collapsed with
+        subsequent events."""
+        popped_events = [
+            self.virtual_events.pop(full_event_type)
+            for full_event_type in full_event_types
+            if full_event_type in self.virtual_events
+        ]
+        for virtual_event in popped_events:
+            self.virtual_flag_updates.pop(virtual_event["flag"], None)
+
+        # Every message in an event may have been overridden by a later
+        # update to the same flag; such events are dropped.
+        virtual_events = sorted(
+            (virtual_event for virtual_event in popped_events if virtual_event["messages"]),
+            key=lambda event: event["id"],
+        )
+        if not virtual_events:
+            return
+
+        contents: List[Dict[str, Any]] = []
+        index = 0
+        length = len(virtual_events)
+        for event in self.queue:
+            while index < length and virtual_events[index]["id"] < event["id"]:
+                contents.append(virtual_events[index])
+                index += 1
+            contents.append(event)
+        contents.extend(virtual_events[index:])
+        self.queue = deque(contents)
 
     # Note that pop ignores virtual events.  This is fine in our
     # current usage since virtual events should always be resolved to
@@ -402,31 +513,14 @@ class EventQueue:
 
     # See the comment on pop; that applies here as well
     def prune(self, through_id: int) -> None:
+        note_event_queue_changed(self.id)
         while len(self.queue) != 0 and self.queue[0]["id"] <= through_id:
             self.newest_pruned_id = self.queue[0]["id"]
             self.pop()
 
     def contents(self, include_internal_data: bool = False) -> List[Dict[str, Any]]:
-        contents: List[Dict[str, Any]] = []
-        virtual_id_map: Dict[str, Dict[str, Any]] = {}
-        for event_type in self.virtual_events:
-            virtual_id_map[self.virtual_events[event_type]["id"]] = self.virtual_events[event_type]
-        virtual_ids = sorted(virtual_id_map.keys())
-
-        # Merge the virtual events into their final place in the queue
-        index = 0
-        length = len(virtual_ids)
-        for event in self.queue:
-            while index < length and virtual_ids[index] < event["id"]:
-                contents.append(virtual_id_map[virtual_ids[index]])
-                index += 1
-            contents.append(event)
-        while index < length:
-            contents.append(virtual_id_map[virtual_ids[index]])
-            index += 1
-
-        self.virtual_events = {}
-        self.queue = deque(contents)
+        self.merge_virtual_events(list(self.virtual_events))
+        contents = list(self.queue)
 
         if include_internal_data:
             return contents
@@ -436,12 +530,21 @@ class EventQueue:
 def prune_internal_data(events: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
     """Prunes the internal_data data structures, which are not intended to
     be exposed to API clients.
+
+    Events in a queue are never mutated once they are in the queue
+    proper, and the message payloads inside them are shared between
+    every queue that received the message, so we only make a shallow
+    copy of the events we need to modify, rather than deep-copying
+    (potentially large) message content for every long-poll.
     """
-    events = copy.deepcopy(events)
-    for event in events:
-        if event["type"] == "message" and "internal_data" in event:
-            del event["internal_data"]
-    return events
+    return [
+        (
+            {key: value for key, value in event.items() if key != "internal_data"}
+            if event["type"] == "message" and "internal_data" in event
+            else event
+        )
+        for event in events
+    ]
 
 
 # Queue-ids which still need to be sent a web_reload_client event.
@@ -455,6 +558,11 @@ clients: Dict[str, ClientDescriptor] = {}
 user_clients: Dict[int, List[ClientDescriptor]] = {}
 # maps realm id to list of client descriptors with all_public_streams=True
 realm_clients_all_streams: Dict[int, List[ClientDescriptor]] = {}
+# maps realm id to narrow index key to list of client descriptors in
+# realm_clients_all_streams with that key; see get_narrow_index_key.
+realm_clients_all_streams_index: Dict[
+    int, Dict[Optional[NarrowIndexKey], List[ClientDescriptor]]
+] = {}
 
 # list of registered gc hooks.
 # each one will be called with a user profile id, queue, and bool
@@ -470,7 +578,9 @@ def clear_client_event_queues_for_testing() -> None:
     web_reload_clients.clear()
     user_clients.clear()
     realm_clients_all_streams.clear()
+    realm_clients_all_streams_index.clear()
     gc_hooks.clear()
+    reset_event_queue_checkpoint_state()
 
 
 def add_client_gc_hook(hook: Callable[[int, ClientDescriptor, bool], None]) -> None:
@@ -500,10 +610,27 @@ def get_client_descriptors_for_realm_all_streams(realm_id: int) -> List[ClientDe
     return realm_clients_all_streams.get(realm_id, [])
 
 
+def get_client_descriptors_for_stream_message(
+    realm_id: int, message: Dict[str, Any]
+) -> List[ClientDescriptor]:
+    """Returns the subset of get_client_descriptors_for_realm_all_streams
+    whose narrow could match the given stream message."""
+    index = realm_clients_all_streams_index.get(realm_id)
+    if index is None:
+        return []
+    client_descriptors = list(index.get(None, []))
+    for key in get_stream_message_index_keys(message):
+        client_descriptors += index.get(key, [])
+    return client_descriptors
+
+
 def add_to_client_dicts(client: ClientDescriptor) -> None:
     user_clients.setdefault(client.user_profile_id, []).append(client)
     if client.all_public_streams or client.narrow != []:
         realm_clients_all_streams.setdefault(client.realm_id, []).append(client)
+        realm_clients_all_streams_index.setdefault(client.realm_id, {}).setdefault(
+            client.narrow_index_key, []
+        ).append(client)
 
 
 def allocate_client_descriptor(new_queue_data: MutableMapping[str, Any]) -> ClientDescriptor:
@@ -511,6 +638,7 @@ def allocate_client_descriptor(new_queue_data: MutableMapping[str, Any]) -> Clie
     new_queue_data["event_queue"] = EventQueue(queue_id).to_dict()
     client = ClientDescriptor.from_dict(new_queue_data)
     clients[queue_id] = client
+    note_event_queue_changed(queue_id)
     add_to_client_dicts(client)
     return client
 
@@ -535,6 +663,16 @@ def do_gc_event_queues(
 
     for realm_id in affected_realms:
         filter_client_dict(realm_clients_all_streams, realm_id)
+        if realm_id in realm_clients_all_streams_index:
+            realm_index = realm_clients_all_streams_index[realm_id]
+            for key in list(realm_index):
+                new_client_list = [c for c in realm_index[key] if c.event_queue.id not in to_remove]
+                if len(new_client_list) == 0:
+                    del realm_index[key]
+                else:
+                    realm_index[key] = new_client_list
+            if len(realm_index) == 0:
+                del realm_clients_all_streams_index[realm_id]
 
     for id in to_remove:
         if id in web_reload_clients:
@@ -546,6 +684,7 @@ def do_gc_event_queues(
                 clients[id].user_profile_id not in user_clients,
             )
         del clients[id]
+        note_event_queue_changed(id)
 
 
 def gc_event_queues(port: int) -> None:
@@ -590,41 +729,211 @@ def persistent_queue_filename(port: int, last: bool = False) -> str:
     return settings.JSON_PERSISTENT_QUEUE_FILENAME_PATTERN % ("." + str(port),)
 
 
+def checkpoint_queue_filename(port: int) -> str:
+    return persistent_queue_filename(port) + ".checkpoint"
+
+
+def delta_queue_filename(port: int) -> str:
+    return persistent_queue_filename(port) + ".delta"
+
+
+def encode_event_queue_snapshot_record(qid: str, client: Optional[ClientDescriptor]) -> bytes:
+    # A record for a queue without a client records, in a delta, that
+    # the queue was garbage-collected since the checkpoint.
+    record = orjson.dumps((qid, client.to_dict() if client is not None else None))
+    return EVENT_QUEUE_SNAPSHOT_RECORD_HEADER.pack(len(record)) + record
+
+
+def write_event_queue_snapshot(
+    stored_queues: IO[bytes], items: Iterable[Tuple[str, Optional[ClientDescriptor]]]
+) -> int:
+    stored_queues.write(EVENT_QUEUE_SNAPSHOT_MAGIC)
+    count = 0
+    for qid, client in items:
+        stored_queues.write(encode_event_queue_snapshot_record(qid, client))
+        count += 1
+    return count
+
+
+def read_event_queue_snapshot(
+    stored_queues: IO[bytes],
+) -> Iterator[Tuple[str, Optional[Dict[str, Any]]]]:
+    magic = stored_queues.read(len(EVENT_QUEUE_SNAPSHOT_MAGIC))
+    if magic != EVENT_QUEUE_SNAPSHOT_MAGIC:
+        # Legacy format, from before we switched to streaming
+        # snapshots; this has to be read into memory in one go.
+        stored_queues.seek(0)
+        yield from orjson.loads(stored_queues.read())
+        return
+
+    header_size = EVENT_QUEUE_SNAPSHOT_RECORD_HEADER.size
+    while header := stored_queues.read(header_size):
+        if len(header) != header_size:
+            raise EOFError("Truncated event queue snapshot header")
+        (length,) = EVENT_QUEUE_SNAPSHOT_RECORD_HEADER.unpack(header)
+        record = stored_queues.read(length)
+        if len(record) != length:
+            raise EOFError("Truncated event queue snapshot record")
+        qid, client_dict = orjson.loads(record)
+        yield qid, client_dict
+
+
+def write_event_queue_file(
+    filename: str, items: Iterable[Tuple[str, Optional[ClientDescriptor]]]
+) -> int:
+    # Write to a temporary file and rename it into place, so that a
+    # crash partway through never leaves a truncated file where a
+    # complete one used to be.
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, "wb") as stored_queues:
+        count = write_event_queue_snapshot(stored_queues, items)
+    os.replace(tmp_filename, filename)
+    return count
+
+
+# Periodic checkpoints encode this many queues at a time on the
+# ioloop, and write them to disk from a thread, so a checkpoint only
+# ever pauses long-polls for as long as encoding one batch takes.
+EVENT_QUEUE_CHECKPOINT_BATCH_SIZE = 100
+
+# The ids of the queues which were allocated, modified, or
+# garbage-collected since the last completed checkpoint; None if this
+# process has not completed a checkpoint.  Shutting down once a
+# checkpoint exists only writes these queues, as a delta on top of it.
+queues_changed_since_checkpoint: Optional[Set[str]] = None
+# While a checkpoint is being written, the queues changed since it
+# started; these become queues_changed_since_checkpoint once the
+# checkpoint is in place.
+queues_changed_during_checkpoint: Optional[Set[str]] = None
+
+
+def note_event_queue_changed(queue_id: str) -> None:
+    if queues_changed_since_checkpoint is not None:
+        queues_changed_since_checkpoint.add(queue_id)
+    if queues_changed_during_checkpoint is not None:
+        queues_changed_during_checkpoint.add(queue_id)
+
+
+def reset_event_queue_checkpoint_state() -> None:
+    global queues_changed_since_checkpoint, queues_changed_during_checkpoint
+    queues_changed_since_checkpoint = None
+    queues_changed_during_checkpoint = None
+
+
 def dump_event_queues(port: int) -> None:
     start = time.perf_counter()
 
-    with open(persistent_queue_filename(port), "wb") as stored_queues:
-        stored_queues.write(
-            orjson.dumps([(qid, client.to_dict()) for (qid, client) in clients.items()])
+    if queues_changed_since_checkpoint is None:
+        count = write_event_queue_file(persistent_queue_filename(port), clients.items())
+        description = "event queues"
+    else:
+        # Only the queues changed since the last checkpoint need to be
+        # written; the delta also marks the checkpoint as belonging to
+        # a clean shutdown.
+        count = write_event_queue_file(
+            delta_queue_filename(port),
+            ((qid, clients.get(qid)) for qid in queues_changed_since_checkpoint),
         )
+        description = "changed event queues since the last checkpoint"
 
-    if len(clients) > 0 or settings.PRODUCTION:
+    if count > 0 or settings.PRODUCTION:
         logging.info(
-            "Tornado %d dumped %d event queues in %.3fs",
+            "Tornado %d dumped %d %s in %.3fs",
             port,
-            len(clients),
+            count,
+            description,
             time.perf_counter() - start,
         )
 
 
-def load_event_queues(port: int) -> None:
-    global clients
-    start = time.perf_counter()
+async def checkpoint_event_queues(port: int) -> None:
+    """Writes the same snapshot as dump_event_queues, but without
+    blocking the ioloop for the whole time, so that shutting down only
+    has to write the queues changed since.  Each queue is encoded as it
+    is when the checkpoint reaches it; any queue changed after the
+    checkpoint started is in the delta, which takes precedence."""
+    global queues_changed_since_checkpoint, queues_changed_during_checkpoint
+    if queues_changed_during_checkpoint is not None:
+        return
+    queues_changed_during_checkpoint = set()
+    try:
+        start = time.perf_counter()
+        ioloop = tornado.ioloop.IOLoop.current()
+        filename = checkpoint_queue_filename(port)
+        tmp_filename = filename + ".tmp"
+        items = list(clients.items())
+        with open(tmp_filename, "wb") as stored_queues:
+            await ioloop.run_in_executor(None, stored_queues.write, EVENT_QUEUE_SNAPSHOT_MAGIC)
+            for i in range(0, len(items), EVENT_QUEUE_CHECKPOINT_BATCH_SIZE):
+                # Encoding has to happen on the ioloop, since that is
+                # where the queues are modified.
+                chunk = b"".join(
+                    encode_event_queue_snapshot_record(qid, client)
+                    for qid, client in items[i : i + EVENT_QUEUE_CHECKPOINT_BATCH_SIZE]
+                )
+                await ioloop.run_in_executor(None, stored_queues.write, chunk)
+        await ioloop.run_in_executor(None, os.replace, tmp_filename, filename)
+        queues_changed_since_checkpoint = queues_changed_during_checkpoint
+
+        logging.info(
+            "Tornado %d checkpointed %d event queues in %.3fs",
+            port,
+            len(items),
+            time.perf_counter() - start,
+        )
+    finally:
+        queues_changed_during_checkpoint = None
 
+
+def read_event_queue_file(
+    port: int, filename: str, loaded_clients: Dict[str, ClientDescriptor]
+) -> None:
     try:
-        with open(persistent_queue_filename(port), "rb") as stored_queues:
-            data = orjson.loads(stored_queues.read())
+        with open(filename, "rb") as stored_queues:
+            for qid, client_dict in read_event_queue_snapshot(stored_queues):
+                if client_dict is None:
+                    loaded_clients.pop(qid, None)
+                else:
+                    loaded_clients[qid] = ClientDescriptor.from_dict(client_dict)
     except FileNotFoundError:
         pass
-    except orjson.JSONDecodeError:
-        logging.exception("Tornado %d could not deserialize event queues", port, stack_info=True)
-    else:
-        try:
-            clients = {qid: ClientDescriptor.from_dict(client) for (qid, client) in data}
-        except Exception:
-            logging.exception(
-                "Tornado %d could not deserialize event queues", port, stack_info=True
-            )
+    except Exception:
+        # Since the snapshot is read incrementally, we keep whatever
+        # queues we managed to deserialize before hitting the error.
+        logging.exception(
+            "Tornado %d could not deserialize event queues; loaded %d",
+            port,
+            len(loaded_clients),
+            stack_info=True,
+        )
+
+
+def load_event_queues(port: int) -> None:
+    global clients
+    start = time.perf_counter()
+
+    loaded_clients: Dict[str, ClientDescriptor] = {}
+    if os.path.exists(persistent_queue_filename(port)):
+        read_event_queue_file(port, persistent_queue_filename(port), loaded_clients)
+    elif os.path.exists(delta_queue_filename(port)):
+        read_event_queue_file(port, checkpoint_queue_filename(port), loaded_clients)
+        read_event_queue_file(port, delta_queue_filename(port), loaded_clients)
+    elif os.path.exists(checkpoint_queue_filename(port)):
+        # A checkpoint without a delta was left by a crash, and is
+        # missing the events since it was written; rather than
+        # silently restoring queues with gaps, we drop them, so that
+        # their clients get BAD_EVENT_QUEUE_ID and register anew.
+        logging.warning(
+            "Tornado %d did not shut down cleanly; discarding its checkpointed event queues",
+            port,
+        )
+    clients = loaded_clients
+
+    # The checkpoint and delta only apply on top of each other, so
+    # neither may outlive this load.
+    for filename in [checkpoint_queue_filename(port), delta_queue_filename(port)]:
+        with suppress(FileNotFoundError):
+            os.unlink(filename)
 
     mark_clients_to_reload(clients.keys())
 
@@ -698,6 +1007,16 @@ async def setup_event_queue(
     pc = tornado.ioloop.PeriodicCallback(lambda: gc_event_queues(port), EVENT_QUEUE_GC_FREQ_MSECS)
     pc.start()
 
+    # Optionally checkpoint the event queues to disk periodically, so
+    # that an unclean shutdown only loses the events since the last
+    # checkpoint, rather than every queue on the shard.
+    if settings.EVENT_QUEUE_CHECKPOINT_FREQ_SECS is not None and not settings.TEST_SUITE:
+        checkpoint = tornado.ioloop.PeriodicCallback(
+            lambda: checkpoint_event_queues(port),
+            settings.EVENT_QUEUE_CHECKPOINT_FREQ_SECS * 1000,
+        )
+        checkpoint.start()
+
     send_restart_events()
     if send_reloads:
         send_web_reload_client_events(immediate=settings.DEVELOPMENT)
@@ -1009,10 +1328,12 @@ def get_client_info_for_message_event(
         return (sender_queue_id is not None) and client.event_queue.id == sender_queue_id
 
     # If we're on a public stream, look for clients (typically belonging to
-    # bots) that are registered to get events for ALL streams.
+    # bots) that are registered to get events for ALL streams, using
+    # the narrow index to skip clients whose narrow cannot match.
     if "stream_name" in event_template and not event_template.get("invite_only"):
         realm_id = event_template["realm_id"]
-        for client in get_client_descriptors_for_realm_all_streams(realm_id):
+        message_dict = event_template["message_dict"]
+        for client in get_client_descriptors_for_stream_message(realm_id, message_dict):
             send_to_clients[client.event_queue.id] = dict(
                 client=client,
                 flags=[],
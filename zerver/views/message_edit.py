@@ -22,6 +22,7 @@ from zerver.lib.message import (
 )
 from zerver.lib.request import RequestNotes
 from zerver.lib.response import json_success
+from zerver.lib.soft_deactivation import add_missing_sparse_stream_messages
 from zerver.lib.timestamp import datetime_to_timestamp
 from zerver.lib.typed_endpoint import OptionalTopic, PathOnly, typed_endpoint
 from zerver.lib.types import EditHistoryEvent, FormattedEditHistoryEvent
@@ -202,6 +203,7 @@ def json_fetch_raw_message(
         message = access_web_public_message(realm, message_id)
         user_profile = None
     else:
+        add_missing_sparse_stream_messages(maybe_user_profile)
         (message, user_message) = access_message_and_usermessage(maybe_user_profile, message_id)
         user_profile = maybe_user_profile
 
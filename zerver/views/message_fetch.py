@@ -6,6 +6,7 @@ from django.db import connection, transaction
 from django.http import HttpRequest, HttpResponse
 from django.utils.html import escape as escape_html
 from django.utils.translation import gettext as _
+from sqlalchemy.engine import Connection
 from sqlalchemy.sql import and_, column, join, literal, literal_column, select, table
 from sqlalchemy.types import Integer, Text
 
@@ -16,13 +17,16 @@ from zerver.lib.narrow import (
     OptionalNarrowListT,
     add_narrow_conditions,
     fetch_messages,
+    get_search_operand,
     is_spectator_compatible,
     is_web_public_narrow,
     narrow_parameter,
     parse_anchor_value,
+    search_highlight_query,
 )
 from zerver.lib.request import REQ, RequestNotes, has_request_variables
 from zerver.lib.response import json_success
+from zerver.lib.soft_deactivation import add_missing_sparse_stream_messages
 from zerver.lib.sqlalchemy_utils import get_sqlalchemy_connection
 from zerver.lib.topic import DB_TOPIC_NAME, MATCH_TOPIC
 from zerver.lib.topic_sqlalchemy import topic_column_sa
@@ -81,6 +85,24 @@ def get_search_fields(
     }
 
 
+def get_search_fields_for_messages(
+    sa_conn: Connection, message_ids: List[int], search_operand: str
+) -> Dict[int, Dict[str, str]]:
+    search_fields: Dict[int, Dict[str, str]] = {}
+    if not message_ids:
+        return search_fields
+
+    query = search_highlight_query(message_ids, search_operand)
+    for row in sa_conn.execute(query).mappings():
+        search_fields[row["message_id"]] = get_search_fields(
+            row["rendered_content"],
+            row[DB_TOPIC_NAME],
+            row["content_matches"],
+            row["topic_matches"],
+        )
+    return search_fields
+
+
 def clean_narrow_for_web_public_api(narrow: OptionalNarrowListT) -> OptionalNarrowListT:
     if narrow is None:
         return None
@@ -109,6 +131,7 @@ def get_messages_backend(
     ),
     client_gravatar: bool = REQ(json_validator=check_bool, default=True),
     apply_markdown: bool = REQ(json_validator=check_bool, default=True),
+    highlight_search_results: bool = REQ(json_validator=check_bool, default=True),
 ) -> HttpResponse:
     anchor = parse_anchor_value(anchor_val, use_first_unread_anchor_val)
     if num_before + num_after > MAX_MESSAGES_PER_FETCH:
@@ -172,6 +195,11 @@ def get_messages_backend(
         assert log_data is not None
         log_data["extra"] = "[{}]".format(",".join(verbose_operators))
 
+    if user_profile is not None:
+        # This writes any UserMessage rows deferred for sparse streams,
+        # so it must happen before the read-only transaction below.
+        add_missing_sparse_stream_messages(user_profile)
+
     with transaction.atomic(durable=True):
         # We're about to perform a search, and then get results from
         # it; this is done across multiple queries.  To prevent race
@@ -249,12 +277,12 @@ def get_messages_backend(
                 message_ids.append(message_id)
 
         search_fields: Dict[int, Dict[str, str]] = {}
-        if is_search:
-            for row in rows:
-                message_id = row[0]
-                (topic_name, rendered_content, content_matches, topic_matches) = row[-4:]
-                search_fields[message_id] = get_search_fields(
-                    rendered_content, topic_name, content_matches, topic_matches
+        if is_search and highlight_search_results:
+            search_operand = get_search_operand(narrow)
+            assert search_operand is not None
+            with get_sqlalchemy_connection() as sa_conn:
+                search_fields = get_search_fields_for_messages(
+                    sa_conn, message_ids, search_operand
                 )
 
         message_list = messages_for_ids(
@@ -321,22 +349,25 @@ def messages_in_narrow_backend(
     )
 
     if not is_search:
-        # `add_narrow_conditions` adds the following columns only if narrow has search operands.
+        # For search narrows, these are fetched along with the match
+        # positions by get_search_fields_for_messages.
         query = query.add_columns(topic_column_sa(), column("rendered_content", Text))
 
     search_fields = {}
     with get_sqlalchemy_connection() as sa_conn:
-        for row in sa_conn.execute(query).mappings():
-            message_id = row["message_id"]
-            topic_name: str = row[DB_TOPIC_NAME]
-            rendered_content: str = row["rendered_content"]
-            content_matches = row.get("content_matches", [])
-            topic_matches = row.get("topic_matches", [])
-            search_fields[str(message_id)] = get_search_fields(
-                rendered_content,
-                topic_name,
-                content_matches,
-                topic_matches,
-            )
+        rows = sa_conn.execute(query).mappings().all()
+        if is_search:
+            search_operand = get_search_operand(narrow)
+            assert search_operand is not None
+            message_ids = [row["message_id"] for row in rows]
+            for message_id, fields in get_search_fields_for_messages(
+                sa_conn, message_ids, search_operand
+            ).items():
+                search_fields[str(message_id)] = fields
+        else:
+            for row in rows:
+                search_fields[str(row["message_id"])] = get_search_fields(
+                    row["rendered_content"], row[DB_TOPIC_NAME], [], []
+                )
 
     return json_success(request, data={"messages": search_fields})
@@ -14,6 +14,7 @@ from zerver.lib.exceptions import JsonableError
 from zerver.lib.narrow import NarrowParameter, fetch_messages, parse_anchor_value
 from zerver.lib.request import RequestNotes
 from zerver.lib.response import json_success
+from zerver.lib.soft_deactivation import add_missing_sparse_stream_messages
 from zerver.lib.streams import access_stream_by_id
 from zerver.lib.topic import user_message_exists_for_topic
 from zerver.lib.typed_endpoint import (
@@ -97,6 +98,7 @@ def update_message_flags_for_narrow(
     else:
         narrow_dict = None
 
+    add_missing_sparse_stream_messages(user_profile)
     query_info = fetch_messages(
         narrow=narrow_dict,
         user_profile=user_profile,
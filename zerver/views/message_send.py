@@ -1,24 +1,31 @@
 from email.headerregistry import Address
-from typing import Dict, Iterable, Optional, Sequence, Union, cast
+from typing import Dict, Iterable, List, Literal, Optional, Sequence, Tuple, Union, cast
 
 from django.core import validators
 from django.core.exceptions import ValidationError
 from django.http import HttpRequest, HttpResponse
 from django.utils.translation import gettext as _
+from pydantic import BaseModel, ConfigDict, Json
 
 from zerver.actions.message_send import (
     check_send_message,
+    check_send_messages,
     compute_irc_user_fullname,
     compute_jabber_user_fullname,
     create_mirror_user_if_needed,
     extract_private_recipients,
     extract_stream_indicator,
+    get_validated_emails,
+    get_validated_user_ids,
 )
+from zerver.lib.addressee import Addressee
 from zerver.lib.exceptions import JsonableError
 from zerver.lib.markdown import render_message_markdown
+from zerver.lib.rate_limiter import rate_limit_user
 from zerver.lib.request import REQ, RequestNotes, has_request_variables
 from zerver.lib.response import json_success
 from zerver.lib.topic import REQ_topic
+from zerver.lib.typed_endpoint import typed_endpoint
 from zerver.lib.validator import check_bool, check_string_in, to_float
 from zerver.lib.zcommand import process_zcommands
 from zerver.lib.zephyr import compute_mit_user_fullname
@@ -258,6 +265,82 @@ def send_message_backend(
     return json_success(request, data=data)
 
 
+MAX_MESSAGES_PER_BATCH = 100
+
+
+class BatchMessageParameter(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+
+    type: Literal["direct", "private", "stream", "channel"]
+    # A channel ID or name, or the user IDs or emails of the
+    # recipients of a direct message.
+    to: Union[int, str, List[int], List[str]]
+    topic: Optional[str] = None
+    content: str
+
+
+@typed_endpoint
+def send_messages_backend(
+    request: HttpRequest,
+    user_profile: UserProfile,
+    *,
+    messages: Json[List[BatchMessageParameter]],
+    read_by_sender: Json[Optional[bool]] = None,
+) -> HttpResponse:
+    if len(messages) > MAX_MESSAGES_PER_BATCH:
+        raise JsonableError(
+            _("Too many messages; the maximum is {max_messages}.").format(
+                max_messages=MAX_MESSAGES_PER_BATCH
+            )
+        )
+
+    # The request itself was charged once against the user's API rate
+    # limit; charge each further message too, so that batching does
+    # not multiply the rate at which a user can send messages.
+    for _ in messages[1:]:
+        rate_limit_user(request, user_profile, domain="api_by_user")
+
+    client = RequestNotes.get_notes(request).client
+    assert client is not None
+
+    addressed_messages: List[Tuple[Addressee, str]] = []
+    for message in messages:
+        message_to: Union[Sequence[int], Sequence[str]]
+        if message.type in ["stream", "channel"]:
+            recipient_type_name = "stream"
+            if isinstance(message.to, list):
+                raise JsonableError(_("Invalid data type for channel"))
+            # For legacy reasons check_send_message expects a list of
+            # streams, instead of a single stream; the cast is needed
+            # since mypy cannot narrow an int-or-str list to either.
+            message_to = cast(Union[Sequence[int], Sequence[str]], [message.to])
+        else:
+            recipient_type_name = "private"
+            if isinstance(message.to, int):
+                message_to = [message.to]
+            elif isinstance(message.to, str):
+                message_to = get_validated_emails(message.to.split(","))
+            elif message.to and isinstance(message.to[0], str):
+                message_to = get_validated_emails(cast(List[str], message.to))
+            else:
+                message_to = get_validated_user_ids(cast(List[int], message.to))
+
+        addressee = Addressee.legacy_build(
+            user_profile, recipient_type_name, message_to, message.topic
+        )
+        addressed_messages.append((addressee, message.content))
+
+    if read_by_sender is None:
+        read_by_sender = client.default_read_by_sender()
+
+    sent_message_results = check_send_messages(
+        user_profile, client, addressed_messages, read_by_sender=read_by_sender
+    )
+    return json_success(
+        request, data={"ids": [result.message_id for result in sent_message_results]}
+    )
+
+
 @has_request_variables
 def zcommand_backend(
     request: HttpRequest, user_profile: UserProfile, command: str = REQ("command")
@@ -146,6 +146,7 @@ def update_active_status_backend(
     ping_only: Json[bool] = False,
     new_user_input: Json[bool] = False,
     slim_presence: Json[bool] = False,
+    last_update_id: Optional[Json[int]] = None,
 ) -> HttpResponse:
     status_val = UserPresence.status_from_string(status)
     if status_val is None:
@@ -158,7 +159,7 @@ def update_active_status_backend(
     if ping_only:
         ret: Dict[str, Any] = {}
     else:
-        ret = get_presence_response(user_profile, slim_presence)
+        ret = get_presence_response(user_profile, slim_presence, last_update_id)
 
     if user_profile.realm.is_zephyr_mirror_realm:
         # In zephyr mirroring realms, users can't see the presence of other
@@ -873,6 +873,9 @@ def get_topics_backend(
     request: HttpRequest,
     maybe_user_profile: Union[UserProfile, AnonymousUser],
     stream_id: int = REQ(converter=to_non_negative_int, path_only=True),
+    query: Optional[str] = REQ(default=None),
+    before_max_id: Optional[int] = REQ(converter=to_non_negative_int, default=None),
+    limit: Optional[int] = REQ(converter=to_non_negative_int, default=None),
 ) -> HttpResponse:
     if not maybe_user_profile.is_authenticated:
         is_web_public_query = True
@@ -887,7 +890,11 @@ def get_topics_backend(
         realm = get_valid_realm_from_request(request)
         stream = access_web_public_stream(stream_id, realm)
         result = get_topic_history_for_public_stream(
-            realm_id=realm.id, recipient_id=assert_is_not_none(stream.recipient_id)
+            realm_id=realm.id,
+            recipient_id=assert_is_not_none(stream.recipient_id),
+            query=query,
+            before_max_id=before_max_id,
+            limit=limit,
         )
 
     else:
@@ -900,6 +907,9 @@ def get_topics_backend(
             user_profile=user_profile,
             recipient_id=stream.recipient_id,
             public_history=stream.is_history_public_to_subscribers(),
+            query=query,
+            before_max_id=before_max_id,
+            limit=limit,
         )
 
     return json_success(request, data=dict(topics=result))
@@ -23,7 +23,11 @@ from zerver.lib.remote_server import (
     PushNotificationBouncerRetryLaterError,
     send_server_data_to_push_bouncer,
 )
-from zerver.lib.soft_deactivation import reactivate_user_if_soft_deactivated
+from zerver.lib.soft_deactivation import (
+    add_missing_messages,
+    do_materialize_sparse_stream_messages,
+    reactivate_user_if_soft_deactivated,
+)
 from zerver.lib.upload import handle_reupload_emojis_event
 from zerver.models import Message, Realm, RealmAuditLog, Stream, UserMessage
 from zerver.models.users import get_system_bot, get_user_profile_by_id
@@ -214,6 +218,20 @@ class DeferredWorker(QueueProcessingWorker):
             )
             user_profile = get_user_profile_by_id(event["user_profile_id"])
             reactivate_user_if_soft_deactivated(user_profile)
+        elif event["type"] == "soft_catch_up":
+            logger.info(
+                "Starting soft catch-up for user_profile_id %s",
+                event["user_profile_id"],
+            )
+            user_profile = get_user_profile_by_id(event["user_profile_id"])
+            # The user may have returned since this was queued, in
+            # which case they've already been caught up.
+            if user_profile.long_term_idle:
+                add_missing_messages(user_profile)
+        elif event["type"] == "materialize_sparse_stream_messages":
+            logger.info("Creating deferred UserMessage rows for stream_id %s", event["stream_id"])
+            stream = Stream.objects.get(id=event["stream_id"])
+            do_materialize_sparse_stream_messages(stream)
         elif event["type"] == "push_bouncer_update_for_realm":
             # In the future we may use the realm_id to send only that single realm's info.
             realm_id = event["realm_id"]
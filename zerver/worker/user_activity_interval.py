@@ -1,21 +1,24 @@
 # Documented in https://zulip.readthedocs.io/en/latest/subsystems/queuing.html
 import logging
-from typing import Any, Mapping
+from typing import Any, Dict, List
 
 from typing_extensions import override
 
-from zerver.actions.user_activity import do_update_user_activity_interval
+from zerver.actions.user_activity import do_update_user_activity_intervals
 from zerver.lib.timestamp import timestamp_to_datetime
-from zerver.models.users import get_user_profile_by_id
-from zerver.worker.base import QueueProcessingWorker, assign_queue
+from zerver.worker.base import LoopQueueProcessingWorker, assign_queue
 
 logger = logging.getLogger(__name__)
 
 
 @assign_queue("user_activity_interval")
-class UserActivityIntervalWorker(QueueProcessingWorker):
+class UserActivityIntervalWorker(LoopQueueProcessingWorker):
+    """Like UserPresenceWorker, we process these in batches, since
+    active users send one roughly every minute; the events for each
+    user are merged into intervals in memory before being written."""
+
     @override
-    def consume(self, event: Mapping[str, Any]) -> None:
-        user_profile = get_user_profile_by_id(event["user_profile_id"])
-        log_time = timestamp_to_datetime(event["time"])
-        do_update_user_activity_interval(user_profile, log_time)
+    def consume_batch(self, events: List[Dict[str, Any]]) -> None:
+        do_update_user_activity_intervals(
+            [(event["user_profile_id"], timestamp_to_datetime(event["time"])) for event in events]
+        )
@@ -0,0 +1,102 @@
+import time
+from functools import partial
+from timeit import timeit
+from typing import Any, Dict, List, Optional, Tuple, Type
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandParser
+from typing_extensions import override
+
+from zerver.lib.rate_limiter import RateLimiterBackend, RedisRateLimiterBackend, client
+
+
+class PipelinedRedisRateLimiterBackend(RedisRateLimiterBackend):
+    """For reference, the previous implementation, which checks the
+    rules and then records the request with separate pipelines, in a
+    WATCH transaction."""
+
+    @classmethod
+    @override
+    def rate_limit_entity(
+        cls, entity_key: str, rules: List[Tuple[int, int]], max_api_calls: int, max_api_window: int
+    ) -> Tuple[bool, float]:
+        list_key, set_key, blocking_key = cls.get_keys(entity_key)
+        with client.pipeline() as pipe:
+            for _, request_count in rules:
+                pipe.lindex(list_key, request_count - 1)
+            pipe.get(blocking_key)
+            pipe.ttl(blocking_key)
+            rule_timestamps: List[Optional[bytes]] = pipe.execute()
+
+        blocking_ttl = rule_timestamps.pop()
+        if rule_timestamps.pop() is not None:
+            return True, int(blocking_ttl or 0)
+
+        now = time.time()
+        for timestamp, (range_seconds, _) in zip(rule_timestamps, rules):
+            if timestamp is not None and float(timestamp) + range_seconds >= now:
+                return True, float(timestamp) + range_seconds - now
+
+        with client.pipeline() as pipe:
+            pipe.watch(list_key)
+            last_val = pipe.lindex(list_key, max_api_calls - 1)
+            pipe.multi()
+            pipe.lpush(list_key, now)
+            pipe.ltrim(list_key, 0, max_api_calls - 1)
+            pipe.zadd(set_key, {str(now): now})
+            if last_val is not None:
+                pipe.zrem(set_key, last_val)
+            pipe.expire(list_key, max_api_window)
+            pipe.expire(set_key, max_api_window)
+            pipe.execute()
+        return False, 0.0
+
+
+BACKENDS: Dict[str, Type[RateLimiterBackend]] = {
+    "Pipelines": PipelinedRedisRateLimiterBackend,
+    "Script": RedisRateLimiterBackend,
+}
+
+
+class Command(BaseCommand):
+    help = """Times checking the rate limits for API requests against Redis,
+using the api_by_user rules, spread over a number of users.
+
+This writes rate-limiting history for made-up users to Redis, and
+clears it afterwards."""
+
+    @override
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument(
+            "--requests", help="Number of requests to check", default=20000, type=int
+        )
+        parser.add_argument(
+            "--users", help="Number of users to spread requests over", default=1000, type=int
+        )
+        parser.add_argument("--reps", help="Iterations of each backend", default=3, type=int)
+
+    @override
+    def handle(self, *args: Any, **options: Any) -> None:
+        rules = settings.RATE_LIMITING_RULES["api_by_user"]
+        max_api_window, max_api_calls = rules[-1]
+        entity_keys = [
+            f"RateLimiterBenchmark:{user_id}:api_by_user" for user_id in range(options["users"])
+        ]
+
+        def check_requests(backend: Type[RateLimiterBackend]) -> None:
+            for i in range(options["requests"]):
+                backend.rate_limit_entity(
+                    entity_keys[i % len(entity_keys)], rules, max_api_calls, max_api_window
+                )
+
+        for name, backend in BACKENDS.items():
+            durations: List[float] = []
+            for _ in range(options["reps"]):
+                durations.append(timeit(partial(check_requests, backend), number=1))
+                for entity_key in entity_keys:
+                    backend.clear_history(entity_key)
+            print(
+                f"{name}: best {min(durations):.2f}s, "
+                f"mean {sum(durations) / len(durations):.2f}s, "
+                f"{options['requests'] / min(durations):.0f} requests/s"
+            )
@@ -0,0 +1,110 @@
+import random
+from datetime import datetime, timedelta
+from functools import partial
+from timeit import timeit
+from typing import Any, Callable, Dict, List, Tuple
+
+from django.core.management.base import BaseCommand, CommandParser
+from django.db import transaction
+from django.utils.timezone import now as timezone_now
+from typing_extensions import override
+
+from zerver.actions.user_activity import (
+    do_update_user_activity_interval,
+    do_update_user_activity_intervals,
+)
+from zerver.models import UserActivityInterval, UserProfile
+from zerver.worker.user_activity_interval import UserActivityIntervalWorker
+
+ActivityUpdates = List[Tuple[int, datetime]]
+
+
+def update_one_at_a_time(user_profiles: Dict[int, UserProfile], updates: ActivityUpdates) -> None:
+    for user_id, log_time in updates:
+        do_update_user_activity_interval(user_profiles[user_id], log_time)
+
+
+def update_in_batches(user_profiles: Dict[int, UserProfile], updates: ActivityUpdates) -> None:
+    batch_size = UserActivityIntervalWorker.batch_size
+    for i in range(0, len(updates), batch_size):
+        do_update_user_activity_intervals(updates[i : i + batch_size])
+
+
+STRATEGIES: Dict[str, Callable[[Dict[int, UserProfile], ActivityUpdates], None]] = {
+    "One event at a time": update_one_at_a_time,
+    "Batches": update_in_batches,
+}
+
+
+class Command(BaseCommand):
+    help = """Times processing the events in the user_activity_interval queue,
+one at a time and in batches as the queue worker does.
+
+The events simulate each user having a chance of reporting new input
+every minute, and half of the users having a recent interval already.
+Each run is in a transaction which is then rolled back, so this does
+not modify the database."""
+
+    @override
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument(
+            "--users",
+            help="Number of active users; use populate_db --extra-users to create more",
+            default=10000,
+            type=int,
+        )
+        parser.add_argument("--minutes", help="Minutes of activity", default=10, type=int)
+        parser.add_argument(
+            "--activity",
+            help="Chance that each user reports new input each minute",
+            default=0.3,
+            type=float,
+        )
+        parser.add_argument("--reps", help="Iterations of each strategy", default=3, type=int)
+
+    @override
+    def handle(self, *args: Any, **options: Any) -> None:
+        user_profiles = UserProfile.objects.filter(is_active=True, is_bot=False).order_by("id")[
+            : options["users"]
+        ]
+        user_profiles_by_id = {user_profile.id: user_profile for user_profile in user_profiles}
+        if len(user_profiles_by_id) < options["users"]:
+            print(f"Only {len(user_profiles_by_id)} active users exist; using all of them.")
+
+        rng = random.Random(42)
+        start = timezone_now() - timedelta(minutes=options["minutes"])
+        updates: ActivityUpdates = []
+        for minute in range(options["minutes"]):
+            for user_id in user_profiles_by_id:
+                if rng.random() < options["activity"]:
+                    log_time = start + timedelta(minutes=minute, seconds=rng.uniform(0, 60))
+                    updates.append((user_id, log_time))
+        updates.sort(key=lambda update: update[1])
+        existing_intervals = [
+            UserActivityInterval(
+                user_profile_id=user_id,
+                start=start - timedelta(hours=1),
+                end=start + timedelta(minutes=rng.uniform(-30, 5)),
+            )
+            for user_id in user_profiles_by_id
+            if rng.random() < 0.5
+        ]
+
+        print(f"{len(updates)} events for {len(user_profiles_by_id)} users:")
+        for name, strategy in STRATEGIES.items():
+            durations: List[float] = []
+            for _ in range(options["reps"]):
+                with transaction.atomic():
+                    UserActivityInterval.objects.bulk_create(existing_intervals)
+                    durations.append(
+                        timeit(partial(strategy, user_profiles_by_id, updates), number=1)
+                    )
+                    transaction.set_rollback(True)
+                # bulk_create sets the ids of the rolled-back rows.
+                for interval in existing_intervals:
+                    interval.pk = None
+            print(
+                f"  {name}: best {min(durations):.2f}s, "
+                f"mean {sum(durations) / len(durations):.2f}s, "
+                f"{len(updates) / min(durations):.0f} events/s"
+            )
@@ -0,0 +1,74 @@
+from functools import partial
+from timeit import timeit
+from typing import Any, Callable, Dict, List
+
+from django.core.management.base import BaseCommand, CommandParser
+from django.db import transaction
+from typing_extensions import override
+
+from zerver.lib.user_message import (
+    UserMessageLite,
+    bulk_insert_all_ums,
+    copy_insert_ums,
+    values_insert_ums,
+)
+from zerver.models import Message, UserMessage
+
+
+def unnest_insert_ums(ums: List[UserMessageLite]) -> None:
+    # For reference; this only supports rows for a single message
+    # that all have the same flags.
+    bulk_insert_all_ums([um.user_profile_id for um in ums], [ums[0].message_id], ums[0].flags)
+
+
+STRATEGIES: Dict[str, Callable[[List[UserMessageLite]], None]] = {
+    "INSERT ... VALUES": values_insert_ums,
+    "INSERT ... UNNEST": unnest_insert_ums,
+    "COPY": copy_insert_ums,
+}
+
+
+class Command(BaseCommand):
+    help = """Times the strategies for inserting the UserMessage rows for a
+single message sent to a stream with many subscribers.
+
+Rows are inserted in transactions which are then rolled back, so this
+does not modify the database."""
+
+    @override
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument(
+            "--rows",
+            help="Numbers of UserMessage rows to insert",
+            default=[1000, 10000, 50000],
+            nargs="+",
+            type=int,
+        )
+        parser.add_argument("--reps", help="Iterations of each insert", default=5, type=int)
+
+    @override
+    def handle(self, *args: Any, **options: Any) -> None:
+        # The foreign key constraints on zerver_usermessage are only
+        # checked at commit, so we can use made-up user IDs, for a
+        # message ID beyond any that exists.
+        last_message_id = Message.objects.order_by("-id").values_list("id", flat=True).first()
+        message_id = (last_message_id or 0) + 1
+        flags = int(UserMessage.flags.mentioned)
+
+        for row_count in options["rows"]:
+            ums = [
+                UserMessageLite(user_profile_id=user_id, message_id=message_id, flags=flags)
+                for user_id in range(1, row_count + 1)
+            ]
+            print(f"{row_count} rows:")
+            for name, insert in STRATEGIES.items():
+                durations: List[float] = []
+                for _ in range(options["reps"]):
+                    with transaction.atomic():
+                        durations.append(timeit(partial(insert, ums), number=1))
+                        transaction.set_rollback(True)
+                print(
+                    f"  {name}: best {min(durations) * 1000:.1f}ms, "
+                    f"mean {sum(durations) / len(durations) * 1000:.1f}ms, "
+                    f"{row_count / min(durations):.0f} rows/s"
+                )
@@ -202,6 +202,17 @@ THUMBNAIL_IMAGES = False
 
 TORNADO_PORTS: List[int] = []
 USING_TORNADO = True
+# If set, Tornado writes a checkpoint of its event queues to disk this
+# often, so that on shutdown it only has to write the queues changed
+# since.  These checkpoints are written incrementally, pausing the
+# ioloop only to encode a batch of queues at a time.  Queues are not
+# restored from a checkpoint after a crash, since they would be
+# missing the events since it was written.
+EVENT_QUEUE_CHECKPOINT_FREQ_SECS: Optional[int] = None
+# How many encoded message dicts each Django process keeps in memory,
+# in front of memcached, along with their parsed and finalized forms;
+# 0 disables this local cache.
+MESSAGE_DICT_LOCAL_CACHE_SIZE = 5000
 
 # ToS/Privacy templates
 POLICIES_DIRECTORY: str = "zerver/policies_absent"
@@ -84,7 +84,12 @@ from zerver.views.message_flags import (
     update_message_flags,
     update_message_flags_for_narrow,
 )
-from zerver.views.message_send import render_message_backend, send_message_backend, zcommand_backend
+from zerver.views.message_send import (
+    render_message_backend,
+    send_message_backend,
+    send_messages_backend,
+    zcommand_backend,
+)
 from zerver.views.muted_users import mute_user, unmute_user
 from zerver.views.onboarding_steps import mark_onboarding_step_as_read
 from zerver.views.presence import (
@@ -352,6 +357,7 @@ v1_api_and_json_patterns = [
         PATCH=update_message_backend,
         DELETE=delete_message_backend,
     ),
+    rest_path("messages/batch", POST=(send_messages_backend, {"allow_incoming_webhooks"})),
     rest_path("messages/render", POST=render_message_backend),
     rest_path("messages/flags", POST=update_message_flags),
     rest_path("messages/flags/narrow", POST=update_message_flags_for_narrow),